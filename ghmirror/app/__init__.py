@@ -22,15 +22,40 @@ import flask
 from prometheus_client import generate_latest
 
 from ghmirror.core.constants import GH_API
-from ghmirror.core.mirror_requests import conditional_request
-from ghmirror.core.mirror_response import MirrorResponse
+from ghmirror.core.events import start_events_poller
+from ghmirror.core.mirror_requests import (
+    FORWARDED_HEADERS,
+    collection_request,
+    conditional_request,
+    disk_request,
+    is_disk_cached,
+    start_cache_keys_migration,
+    start_webhooks_listener,
+    webhook_request,
+)
+from ghmirror.core.mirror_response import (
+    STREAM_CHUNK_SIZE,
+    MirrorCollectionResponse,
+    MirrorResponse,
+)
 from ghmirror.data_structures.monostate import StatsCache
-from ghmirror.data_structures.requests_cache import RequestsCache
-from ghmirror.decorators.checks import check_user
+from ghmirror.data_structures.requests_cache import (
+    RequestsCache,
+    start_bodies_collector,
+)
+from ghmirror.decorators.checks import (
+    check_signature,
+    check_user,
+    start_users_revalidator,
+)
 from ghmirror.utils.extensions import session
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 
+# Request bodies larger than that, in bytes, or of unknown size, are sent
+# upstream as they are read from the client instead of being read in full first
+MAX_BUFFERED_BODY = int(os.environ.get("GITHUB_MIRROR_MAX_BUFFERED_BODY", "1048576"))
+
 APP = flask.Flask(__name__)
 
 
@@ -47,6 +72,12 @@ def error_handler(exception):
 APP.config["TRAP_HTTP_EXCEPTIONS"] = True
 APP.register_error_handler(Exception, error_handler)
 
+EVENTS_POLLER = start_events_poller()
+USERS_REVALIDATOR = start_users_revalidator()
+CACHE_KEYS_MIGRATION = start_cache_keys_migration()
+WEBHOOKS_LISTENER = start_webhooks_listener()
+BODIES_COLLECTOR = start_bodies_collector()
+
 
 @APP.route("/healthz", methods=["GET"])
 def healthz():
@@ -64,10 +95,94 @@ def metrics():
 
     stats_cache.set_cache_size(sys.getsizeof(requests_cache))
     stats_cache.set_cached_objects(len(requests_cache))
+    stats_cache.set_dedup_ratio(requests_cache.dedup_ratio())
 
     return flask.Response(generate_latest(registry=stats_cache.registry), 200, headers)
 
 
+def _send_download(resp):
+    """Send a download served from a file, answering Range requests
+
+    The file is handed to the server, which sends it with sendfile when it
+    can. Downloads being stored are sent in full as they are written
+    instead.
+    """
+    mimetype = resp.headers.get("Content-Type", "application/octet-stream")
+    if hasattr(resp.raw, "fileno"):
+        size = os.fstat(resp.raw.fileno()).st_size
+        response = flask.send_file(resp.raw, mimetype=mimetype, etag=False)
+        response.content_length = size
+    else:
+        size = None
+        response = flask.Response(resp.raw, mimetype=mimetype)
+    for header in ("Content-Disposition", "ETag", "Last-Modified", "X-Cache"):
+        if header in resp.headers:
+            response.headers[header] = resp.headers[header]
+    if size is None:
+        return response
+    return response.make_conditional(
+        flask.request, accept_ranges=True, complete_length=size
+    )
+
+
+class StreamedRequestBody:
+    """Body of a client request, read as it is sent upstream.
+
+    :param stream: the body stream of the client request
+    :param length: the length of the body, in bytes
+    """
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        # Makes requests send it with a Content-Length, not chunked
+        self.len = length
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body."""
+        return self._stream.read(size)
+
+
+def _chunked_request_body(stream):
+    """Read the body of a client request one chunk at a time."""
+    while chunk := stream.read(STREAM_CHUNK_SIZE):
+        yield chunk
+
+
+def _request_body():
+    """Get the body of the client request
+
+    Bodies larger than MAX_BUFFERED_BODY are streamed, so they are never
+    held in memory in full, and so are the chunked ones, of unknown size,
+    which are sent upstream chunked as well.
+    """
+    length = flask.request.content_length
+    if length is None:
+        if "chunked" in flask.request.headers.get("Transfer-Encoding", "").lower():
+            return _chunked_request_body(flask.request.stream)
+        return flask.request.get_data()
+    if length <= MAX_BUFFERED_BODY:
+        return flask.request.get_data()
+    return StreamedRequestBody(flask.request.stream, length)
+
+
+def _forwarded_headers():
+    """Get the headers of the client request to forward upstream"""
+    return {
+        name: flask.request.headers[name]
+        for name in FORWARDED_HEADERS
+        if name in flask.request.headers
+    }
+
+
+def _client_timeout():
+    """Get the seconds the client waits for a response, from X-Mirror-Timeout"""
+    try:
+        timeout = float(flask.request.headers.get("X-Mirror-Timeout", ""))
+    except ValueError:
+        return None
+    return timeout if timeout > 0 else None
+
+
 @APP.route("/", defaults={"path": ""})
 @APP.route("/<path:path>", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 @check_user
@@ -81,18 +196,52 @@ def ghmirror(path):
             url += f"{key}={value}&"
         url = url.rstrip("&")
 
-    resp = conditional_request(
+    if flask.request.method == "GET" and is_disk_cached(url):
+        resp = disk_request(
+            session=session,
+            url=url,
+            auth=flask.request.headers.get("Authorization"),
+            headers=_forwarded_headers(),
+        )
+        if resp.status_code == 200:  # noqa: PLR2004
+            return _send_download(resp)
+    else:
+        resp = conditional_request(
+            session=session,
+            method=flask.request.method,
+            url=url,
+            auth=flask.request.headers.get("Authorization"),
+            data=_request_body(),
+            url_params=flask.request.args,
+            timeout=_client_timeout(),
+            stream=True,
+            headers=_forwarded_headers(),
+        )
+
+    gh_mirror_url = os.environ.get("GITHUB_MIRROR_URL", flask.request.host_url)
+    mirror_response = MirrorResponse(
+        original_response=resp, gh_api_url=GH_API, gh_mirror_url=gh_mirror_url
+    )
+
+    return flask.Response(
+        mirror_response.content, mirror_response.status_code, mirror_response.headers
+    )
+
+
+@APP.route("/mirror/collection/<path:path>", methods=["GET"])
+@check_user
+def collection(path):
+    """Serve all the pages of a collection as a single JSON array."""
+    responses = collection_request(
         session=session,
-        method=flask.request.method,
-        url=url,
+        url=f"{GH_API}/{path}",
         auth=flask.request.headers.get("Authorization"),
-        data=flask.request.data,
         url_params=flask.request.args,
     )
 
     gh_mirror_url = os.environ.get("GITHUB_MIRROR_URL", flask.request.host_url)
-    mirror_response = MirrorResponse(
-        original_response=resp, gh_api_url=GH_API, gh_mirror_url=gh_mirror_url
+    mirror_response = MirrorCollectionResponse(
+        original_responses=responses, gh_api_url=GH_API, gh_mirror_url=gh_mirror_url
     )
 
     return flask.Response(
@@ -100,6 +249,17 @@ def ghmirror(path):
     )
 
 
+@APP.route("/mirror/webhook", methods=["POST"])
+@check_signature
+def webhook():
+    """Drop the cached responses made stale by a GitHub webhook delivery."""
+    invalidated = webhook_request(
+        event=flask.request.headers.get("X-GitHub-Event"),
+        payload=flask.request.get_json(silent=True) or {},
+    )
+    return flask.jsonify(invalidated=invalidated)
+
+
 if __name__ == "__main__":  # pragma: no cover
     APP.run(
         host="127.0.0.1",
@@ -18,6 +18,15 @@ GH_API = "https://api.github.com"
 GH_STATUS_API = "https://www.githubstatus.com/api/v2/components.json"
 REQUESTS_TIMEOUT = 10
 STATUS_MAX_RETRIES = 3
-STATUS_SLEEP_TIME = 1
+STATUS_SLEEP_TIME = 0
 STATUS_TIMEOUT = 10
 PER_PAGE_ELEMENTS = 30
+MAX_PER_PAGE_ELEMENTS = 100
+VALIDATIONS_CACHE_SIZE = 10000
+PREFETCHES_CACHE_SIZE = 10000
+COLLECTIONS_CACHE_SIZE = 100
+WEBHOOKS_CACHE_SIZE = 10000
+NEGATIVES_CACHE_SIZE = 10000
+# Headers recorded along with cached responses, describing the page
+PAGE_ELEMENTS_HEADER = "X-Mirror-Page-Elements"
+PAGE_NEXT_HEADER = "X-Mirror-Page-Next"
@@ -0,0 +1,177 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Polls the GitHub Events API to learn about changes"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+from ghmirror.core.constants import (
+    GH_API,
+    MAX_PER_PAGE_ELEMENTS,
+)
+from ghmirror.core.mirror_requests import (
+    online_request,
+    webhook_request,
+)
+from ghmirror.core.scheduler import mark_background
+from ghmirror.data_structures.monostate import WebhooksCache
+from ghmirror.utils.extensions import session
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+# Organizations and repositories, e.g. 'orgs/app-sre' or 'repos/app-sre/foo',
+# whose events are polled
+EVENTS_SOURCES = os.environ.get("GITHUB_MIRROR_EVENTS_SOURCES", "").split()
+EVENTS_TOKEN = os.environ.get("GITHUB_MIRROR_EVENTS_TOKEN")
+# Seconds between polls, unless GitHub asks for a longer interval
+EVENTS_INTERVAL = int(os.environ.get("GITHUB_MIRROR_EVENTS_INTERVAL", "60"))
+
+
+class EventsPoller:
+    """Polls the events of organizations and repositories.
+
+    Each new event is handled as the equivalent webhook delivery would be,
+    dropping the cached responses it made stale. The events are requested
+    through the requests cache, so polls without new events are conditional
+    requests answered with a 304.
+    """
+
+    def __init__(self, sources, auth, interval):
+        self.sources = sources
+        self.auth = auth
+        self.interval = interval
+        self.poll_interval = interval
+        self.last_ids = {}
+
+    @classmethod
+    def create(cls):
+        """Class method to create a new instance from the environment."""
+        auth = None if EVENTS_TOKEN is None else f"Bearer {EVENTS_TOKEN}"
+        return cls(sources=EVENTS_SOURCES, auth=auth, interval=EVENTS_INTERVAL)
+
+    def start(self):
+        """Starting a daemon thread to poll the events.
+
+        daemon is required so the thread is killed when the main
+        thread completes.
+        """
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        """Method to be called in a thread, polling every poll_interval seconds."""
+        mark_background()
+        while True:
+            for source in self.sources:
+                try:
+                    self.poll(source)
+                except Exception:
+                    LOG.exception("EVENTS %s poll failed", source)
+                    WebhooksCache().discard(f"/{source.lower()}")
+            time.sleep(self.poll_interval)
+
+    def poll(self, source):
+        """Poll the events of a source, handling the ones not seen before.
+
+        The first poll only records the latest event. While the polls
+        succeed, the source is considered as notifying its changes, until
+        twice the poll interval passed without one, as when the poller
+        stopped.
+
+        :return: the number of events handled
+        :rtype: int
+        """
+        watched = f"/{source.lower()}"
+        url = f"{GH_API}/{source}/events"
+        try:
+            resp = online_request(
+                session,
+                "GET",
+                f"{url}?per_page={MAX_PER_PAGE_ELEMENTS}",
+                self.auth,
+                url_params={"per_page": str(MAX_PER_PAGE_ELEMENTS)},
+            )
+        except requests.exceptions.RequestException as error:
+            LOG.warning("EVENTS %s poll failed: %s", source, error)
+            WebhooksCache().discard(watched)
+            return 0
+
+        # Responses served from the cache on upstream errors are not current
+        current = resp.headers["X-Cache"].startswith("ONLINE_")
+        if resp.status_code != 200 or not current:  # noqa: PLR2004
+            LOG.warning(
+                "EVENTS %s poll failed: %s %s",
+                source,
+                resp.status_code,
+                resp.headers["X-Cache"],
+            )
+            WebhooksCache().discard(watched)
+            return 0
+
+        self.poll_interval = max(
+            self.interval, int(resp.headers.get("X-Poll-Interval", 0))
+        )
+        events = resp.json()
+        last_id = self.last_ids.get(source)
+        if events:
+            self.last_ids[source] = max(int(event["id"]) for event in events)
+        new_events = [
+            event
+            for event in events
+            if last_id is not None and int(event["id"]) > last_id
+        ]
+        if len(new_events) == MAX_PER_PAGE_ELEMENTS:
+            LOG.warning("EVENTS %s may have been missed for %s", len(events), source)
+
+        # Events are listed from the most recent one
+        for event in reversed(new_events):
+            webhook_request(
+                _webhook_event(event["type"]),
+                {
+                    **event.get("payload", {}),
+                    "repository": {"full_name": event["repo"]["name"]},
+                },
+                polled=True,
+            )
+        WebhooksCache().add(watched, 2 * self.poll_interval)
+        return len(new_events)
+
+
+def _webhook_event(event_type):
+    """Webhook event name of an Events API event type
+
+    E.g. 'pull_request_review' for 'PullRequestReviewEvent'.
+    """
+    name = event_type.removesuffix("Event")
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def start_events_poller():
+    """Start polling the events of EVENTS_SOURCES, if any.
+
+    :return: the poller, or None when there is nothing to poll
+    :rtype: EventsPoller, optional
+    """
+    if not EVENTS_SOURCES:
+        return None
+    poller = EventsPoller.create()
+    poller.start()
+    return poller
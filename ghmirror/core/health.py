@@ -0,0 +1,120 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Tracks the health of the upstream API from the requests sent to it"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
+
+class UpstreamHealth:
+    """Circuit breaker fed by the outcomes of the requests sent upstream.
+
+    Errors, timeouts and responses slower than slow seconds are failures.
+    When at least min_requests of the latest window outcomes are known and
+    the failure ratio reaches threshold, the circuit opens and the upstream
+    is considered offline. While open, one request is let through as a
+    probe every probe interval, starting at min_probe seconds and doubling
+    with each failed probe up to max_probe seconds. The first success
+    closes the circuit.
+
+    :param window: number of latest outcomes considered
+    :param min_requests: outcomes needed to open the circuit, 0 to never
+    :param threshold: failure ratio opening the circuit
+    :param slow: seconds after which a response is a failure, 0 for never
+    :param min_probe: seconds between probes after the circuit opens
+    :param max_probe: seconds between probes at most
+    """
+
+    def __init__(self, window, min_requests, threshold, slow, min_probe, max_probe):
+        self.min_requests = min_requests
+        self.threshold = threshold
+        self.slow = slow
+        self.min_probe = min_probe
+        self.max_probe = max_probe
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._probe_interval = None
+        self._probe_at = None
+
+    @property
+    def online(self):
+        """Whether the circuit is closed"""
+        return self._probe_at is None
+
+    def reset(self):
+        """Close the circuit, forgetting the outcomes seen so far"""
+        with self._lock:
+            self._outcomes.clear()
+            self._probe_interval = None
+            self._probe_at = None
+
+    def available(self):
+        """Check whether a request can be sent upstream
+
+        That is when the circuit is closed, or when a probe is due, the
+        calling request being the probe.
+        """
+        if self._probe_at is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self._probe_at is None or now >= self._probe_at:
+                if self._probe_at is not None:
+                    # Probes sent that never record an outcome, like the
+                    # requests then served from the cache, do not block
+                    # the next ones
+                    self._probe_at = now + self._probe_interval
+                return True
+        return False
+
+    def record(self, success, elapsed=0):
+        """Record the outcome of a request sent upstream
+
+        :param success: whether it got a response that is not a server error
+        :param elapsed: seconds it took
+        """
+        failure = not success or (self.slow and elapsed >= self.slow)
+        with self._lock:
+            if self._probe_at is not None:
+                if failure:
+                    self._probe_interval = min(2 * self._probe_interval, self.max_probe)
+                    self._probe_at = time.monotonic() + self._probe_interval
+                else:
+                    LOG.info("Github API is back online")
+                    self._outcomes.clear()
+                    self._probe_interval = None
+                    self._probe_at = None
+                return
+
+            self._outcomes.append(failure)
+            failures = sum(self._outcomes)
+            if (
+                self.min_requests
+                and len(self._outcomes) >= self.min_requests
+                and failures >= self.threshold * len(self._outcomes)
+            ):
+                LOG.warning(
+                    "Github API is offline, reason: %s failures in the last "
+                    "%s requests",
+                    failures,
+                    len(self._outcomes),
+                )
+                self._probe_interval = self.min_probe
+                self._probe_at = time.monotonic() + self._probe_interval
@@ -16,21 +16,298 @@
 
 # ruff: noqa: PLR2004
 import hashlib
+import json
 import logging
+import math
+import operator
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from urllib.parse import urlsplit
 
 import requests
 
 from ghmirror.core.constants import (
+    GH_API,
+    MAX_PER_PAGE_ELEMENTS,
+    PAGE_ELEMENTS_HEADER,
+    PAGE_NEXT_HEADER,
     PER_PAGE_ELEMENTS,
     REQUESTS_TIMEOUT,
 )
-from ghmirror.data_structures.monostate import GithubStatus
-from ghmirror.data_structures.requests_cache import RequestsCache
+from ghmirror.core.health import UpstreamHealth
+from ghmirror.core.mirror_response import STREAM_CHUNK_SIZE, StreamedBody
+from ghmirror.core.pagination import (
+    build_link_header,
+    canonical_url,
+    is_page_based,
+    link_page,
+    query_parameters,
+    replace_query_parameters,
+)
+from ghmirror.core.retries import (
+    Latencies,
+    RetryBudget,
+)
+from ghmirror.core.scheduler import (
+    DeadlineExceededError,
+    UpstreamBusyError,
+    UpstreamScheduler,
+    deadline,
+    mark_background,
+    time_left,
+)
+from ghmirror.data_structures.disk_cache import DiskCache
+from ghmirror.data_structures.monostate import (
+    CollectionsCache,
+    GithubStatus,
+    NegativesCache,
+    PrefetchesCache,
+    StatsCache,
+    UsersCache,
+    ValidationsCache,
+    WebhooksCache,
+)
+from ghmirror.data_structures.requests_cache import (
+    CACHE_TYPE,
+    RequestsCache,
+    shared_channel,
+)
 from ghmirror.decorators.metrics import requests_metrics
+from ghmirror.utils.extensions import PoolTimeoutError
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 LOG = logging.getLogger(__name__)
 
+# When set, GETs are served from upstream pages of this size, sliced locally
+UPSTREAM_PER_PAGE = min(
+    int(os.environ.get("GITHUB_MIRROR_UPSTREAM_PER_PAGE", "0")),
+    MAX_PER_PAGE_ELEMENTS,
+)
+# Seconds during which an upstream page is sliced without revalidating it
+COALESCE_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_COALESCE_MAX_AGE", "5"))
+# Paths, as regular expressions, of the paginated routes never coalesced, as
+# they wrap their elements in an object, like '{"total_count", "items"}'
+COALESCE_EXCLUDED_ROUTES = [
+    re.compile(route)
+    for route in os.environ.get(
+        "GITHUB_MIRROR_COALESCE_EXCLUDED_ROUTES",
+        "/search/.* /installation/repositories /user/installations(/.*)? "
+        "/repos/[^/]+/[^/]+/actions/.* /repos/[^/]+/[^/]+/commits/[^/]+/check-.*",
+    ).split()
+]
+# Threads of the COLLECTION_EXECUTOR
+_COLLECTION_WORKER = threading.local()
+
+
+def _mark_collection_worker():
+    """Mark the current thread as a COLLECTION_EXECUTOR one"""
+    _COLLECTION_WORKER.active = True
+
+
+# Pages of a collection fetched in parallel, shared by all the requests
+COLLECTION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("GITHUB_MIRROR_COLLECTION_WORKERS", "8")),
+    thread_name_prefix="collection",
+    initializer=_mark_collection_worker,
+)
+COLLECTION_MAX_PAGES = int(os.environ.get("GITHUB_MIRROR_COLLECTION_MAX_PAGES", "100"))
+# When set, the next page of the GETs served is fetched in the background
+PREFETCH_WORKERS = int(os.environ.get("GITHUB_MIRROR_PREFETCH_WORKERS", "0"))
+PREFETCH_EXECUTOR = (
+    ThreadPoolExecutor(
+        max_workers=PREFETCH_WORKERS,
+        thread_name_prefix="prefetch",
+        initializer=mark_background,
+    )
+    if PREFETCH_WORKERS
+    else None
+)
+# Prefetches running or waiting for a worker. Beyond that, they are dropped
+PREFETCH_SLOTS = threading.BoundedSemaphore(2 * PREFETCH_WORKERS or 1)
+# Seconds during which a prefetched page is served without revalidating it
+PREFETCH_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_PREFETCH_MAX_AGE", "10"))
+# Tokens with fewer remaining requests than that are not prefetched for
+PREFETCH_MIN_QUOTA = int(os.environ.get("GITHUB_MIRROR_PREFETCH_MIN_QUOTA", "1000"))
+# Fraction of the rate limit below which the cached responses of a token
+# are served without revalidating them until the reset, 0 for never
+QUOTA_RESERVE = float(os.environ.get("GITHUB_MIRROR_QUOTA_RESERVE", "0"))
+# Paths, as regular expressions, of the collections kept merged and updated
+# with 'since' deltas, instead of being revalidated page by page
+INCREMENTAL_ROUTES = [
+    re.compile(route)
+    for route in os.environ.get("GITHUB_MIRROR_INCREMENTAL_ROUTES", "").split()
+]
+# Seconds during which a merged collection is served without fetching a delta
+INCREMENTAL_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_INCREMENTAL_MAX_AGE", "5"))
+# Seconds after which a merged collection is fetched again in full, as the
+# deltas do not include the deleted elements
+INCREMENTAL_RESYNC = float(os.environ.get("GITHUB_MIRROR_INCREMENTAL_RESYNC", "3600"))
+# Requests in flight upstream per token, 0 for no cap, and how many of them,
+# for how long, can wait for a slot. The client requests waiting are bound
+# by the server threads, the ones of the container image by default
+UPSTREAM_SCHEDULER = UpstreamScheduler(
+    concurrency=int(os.environ.get("GITHUB_MIRROR_UPSTREAM_CONCURRENCY", "0")),
+    queue_size=int(os.environ.get("GITHUB_MIRROR_UPSTREAM_QUEUE_SIZE", "8")),
+    timeout=float(os.environ.get("GITHUB_MIRROR_UPSTREAM_QUEUE_TIMEOUT", "5")),
+    threads=int(os.environ.get("GITHUB_MIRROR_SERVER_THREADS", "8")),
+)
+# Outcomes of the latest requests upstream deciding whether it is offline:
+# how many, how many of them are needed, the failure ratio and the seconds
+# after which a response is a failure. Then the seconds between the probes
+# checking whether it is back online, doubled with each failed one
+UPSTREAM_HEALTH = UpstreamHealth(
+    window=int(os.environ.get("GITHUB_MIRROR_HEALTH_WINDOW", "20")),
+    min_requests=int(os.environ.get("GITHUB_MIRROR_HEALTH_MIN_REQUESTS", "10")),
+    threshold=float(os.environ.get("GITHUB_MIRROR_HEALTH_THRESHOLD", "0.5")),
+    slow=float(os.environ.get("GITHUB_MIRROR_HEALTH_SLOW", "5")),
+    min_probe=float(os.environ.get("GITHUB_MIRROR_HEALTH_MIN_PROBE", "1")),
+    max_probe=float(os.environ.get("GITHUB_MIRROR_HEALTH_MAX_PROBE", "30")),
+)
+# Quantile of the latest upstream latencies after which a GET still without
+# response is sent again, the first response winning, 0 for never
+HEDGE_QUANTILE = float(os.environ.get("GITHUB_MIRROR_HEDGE_QUANTILE", "0"))
+HEDGE_EXECUTOR = (
+    ThreadPoolExecutor(
+        max_workers=int(os.environ.get("GITHUB_MIRROR_HEDGE_WORKERS", "16")),
+        thread_name_prefix="hedge",
+    )
+    if HEDGE_QUANTILE
+    else None
+)
+UPSTREAM_LATENCIES = Latencies(size=1000, min_samples=20)
+# Times a GET failing with a connection error or a RETRY_STATUS_CODES
+# response is sent again, after a jittered exponential backoff starting at
+# RETRY_BACKOFF seconds
+RETRY_ATTEMPTS = int(os.environ.get("GITHUB_MIRROR_RETRY_ATTEMPTS", "0"))
+RETRY_BACKOFF = float(os.environ.get("GITHUB_MIRROR_RETRY_BACKOFF", "0.1"))
+RETRY_STATUS_CODES = {502, 503, 504}
+# Retries and hedges sent per request sent upstream, on top of a few ones
+# per window of 10 seconds
+RETRY_BUDGET = RetryBudget(
+    ratio=float(os.environ.get("GITHUB_MIRROR_RETRY_RATIO", "0.1")),
+    min_extra=int(os.environ.get("GITHUB_MIRROR_RETRY_MIN", "10")),
+    window=10,
+)
+# Seconds within which the requests for some paths, as regular expressions,
+# are answered, as 'route=seconds' entries. Clients can ask for a shorter
+# deadline with the X-Mirror-Timeout header. Upstream requests are given the
+# time left, and are not sent when that is shorter than the usual latency,
+# the cached response being served instead
+DEADLINE_ROUTES = [
+    (re.compile(route), float(seconds))
+    for route, _, seconds in (
+        entry.rpartition("=")
+        for entry in os.environ.get("GITHUB_MIRROR_DEADLINE_ROUTES", "").split()
+    )
+]
+# Successful responses larger than that, in bytes, or of unknown size, are
+# sent to the clients as they arrive from upstream instead of being read in
+# full first, 0 for never
+STREAM_MIN_SIZE = int(os.environ.get("GITHUB_MIRROR_STREAM_MIN_SIZE", "0"))
+# Streamed responses larger than that, in bytes, are not kept aside to be
+# cached, so a single download can not take that much memory
+STREAM_MAX_CACHED_SIZE = int(
+    os.environ.get("GITHUB_MIRROR_STREAM_MAX_CACHED_SIZE", "104857600")
+)
+# Directory where the downloads of DISK_CACHE_ROUTES are kept, unset for
+# never, taking up to GITHUB_MIRROR_DISK_CACHE_SIZE bytes
+DISK_CACHE_DIR = os.environ.get("GITHUB_MIRROR_DISK_CACHE_DIR", "")
+DISK_CACHE = (
+    DiskCache(
+        DISK_CACHE_DIR,
+        max_size=int(os.environ.get("GITHUB_MIRROR_DISK_CACHE_SIZE", str(10 * 2**30))),
+    )
+    if DISK_CACHE_DIR
+    else None
+)
+# Paths, as regular expressions, of the downloads kept on disk
+DISK_CACHE_ROUTES = [
+    re.compile(route)
+    for route in os.environ.get(
+        "GITHUB_MIRROR_DISK_CACHE_ROUTES", "/repos/[^/]+/[^/]+/(tarball|zipball)(/.*)?"
+    ).split()
+]
+# Headers of the downloads kept along with them
+DISK_CACHE_HEADERS = ("Content-Type", "Content-Disposition", "ETag", "Last-Modified")
+# Headers of the client requests forwarded upstream. Responses with other
+# values than the default ones are cached apart
+FORWARDED_HEADERS = os.environ.get(
+    "GITHUB_MIRROR_FORWARDED_HEADERS", "Accept X-GitHub-Api-Version"
+).split()
+# Normalized values of the forwarded headers standing for the default
+# representation of the resources
+DEFAULT_HEADER_VALUES = {
+    "accept": {
+        "",
+        "*/*",
+        "application/json",
+        "application/vnd.github+json",
+        "application/vnd.github.v3+json",
+    },
+    "x-github-api-version": {"2022-11-28"},
+}
+# Default values of the query string parameters, left out of the cache keys
+DEFAULT_PARAMETER_VALUES = {"page": "1", "per_page": str(PER_PAGE_ELEMENTS)}
+# Rate limit resources, other than 'core', of the paths matching the regular
+# expressions, the first match winning
+RATE_LIMIT_RESOURCES = [
+    (re.compile(r"/search/code"), "code_search"),
+    (re.compile(r"/search/.*"), "search"),
+    (re.compile(r"/graphql"), "graphql"),
+]
+# Messages of the errors served for the requests held back by the mirror
+HELD_BACK_MESSAGES = {
+    "COOLDOWN": "API rate limit exceeded, retry later",
+    "BUSY": "Too many concurrent requests for the token, retry later",
+}
+# Element fields of the 'sort' parameter values supported in merged collections
+INCREMENTAL_SORT_FIELDS = {"created": "created_at", "updated": "updated_at"}
+# Parameters of the requests served from merged collections. The 'state'
+# filter is applied by the mirror, the collections holding all the elements
+INCREMENTAL_PARAMETERS = {"page", "per_page", "sort", "direction", "state"}
+# Seconds during which the responses of repositories sending webhook
+# deliveries are served without revalidating them upstream
+WEBHOOK_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_WEBHOOK_MAX_AGE", "0"))
+# Channel sharing the webhook deliveries with all the mirror processes, as
+# each delivery reaches only one of them, None when the cache is not shared
+WEBHOOKS_CHANNEL = shared_channel("webhooks")
+# Seconds before listening to the webhooks channel again once disconnected
+WEBHOOKS_RETRY_INTERVAL = 5
+# Resources changed by each webhook event, relative to the repository
+WEBHOOK_EVENT_PATHS = {
+    "create": ["branches", "tags", "git"],
+    "delete": ["branches", "tags", "git"],
+    "issue_comment": ["issues/{issue[number]}"],
+    "issues": ["issues/{issue[number]}"],
+    "label": ["labels"],
+    "member": ["collaborators"],
+    "milestone": ["milestones/{milestone[number]}"],
+    "pull_request": ["pulls/{pull_request[number]}", "issues/{pull_request[number]}"],
+    "pull_request_review": ["pulls/{pull_request[number]}"],
+    "pull_request_review_comment": ["pulls/{pull_request[number]}"],
+    "push": ["branches", "commits", "contents", "git", "tags"],
+    "release": ["releases"],
+    "repository": [""],
+}
+# Seconds during which not found responses, and the failed authentications
+# of a token, are served without requesting them upstream again, 0 for never
+NEGATIVE_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_NEGATIVE_MAX_AGE", "0"))
+# Paths, as regular expressions, whose not found responses are never kept
+NEGATIVE_EXCLUDED_ROUTES = [
+    re.compile(route)
+    for route in os.environ.get("GITHUB_MIRROR_NEGATIVE_EXCLUDED_ROUTES", "").split()
+]
+# Status codes of the not found responses and failed authentications
+NEGATIVE_STATUS_CODES = {401, 404, 410}
+
 
 def _get_elements_per_page(url_params):
     """Get 'per_page' parameter if present in URL or return None if not present"""
@@ -42,33 +319,243 @@ def _get_elements_per_page(url_params):
     return None
 
 
+def _count_elements(resp):
+    """Count the elements of a JSON list response
+
+    :return: the number of elements, or None when the body is not a JSON list
+    :rtype: int, optional
+    """
+    body = _json_list(resp)
+    return None if body is None else len(body)
+
+
+def _has_next_page(resp):
+    """Check whether the response has a 'next' link"""
+    return bool((links := resp.links) and links.get("next"))
+
+
+def _page_elements(resp):
+    """Number of elements of a (possibly cached) JSON list response
+
+    Uses the value recorded when the response was cached, falling back to
+    parsing the body for entries cached before it was recorded.
+    """
+    elements = resp.headers.get(PAGE_ELEMENTS_HEADER)
+    if elements is None:
+        return _count_elements(resp)
+    return int(elements) if elements else None
+
+
+def _cache_key(url, headers, auth_sha):
+    """Build the key of the cached response for a GET
+
+    The query string of the url is made canonical, so the urls of the same
+    resource share the key. The FORWARDED_HEADERS set to other values than
+    the default ones select another representation of the resource. They
+    are added to the url as a fragment, which is ignored when matching
+    paths, so those variants are cached apart.
+    """
+    url = canonical_url(url, DEFAULT_PARAMETER_VALUES)
+    variant = []
+    for name in FORWARDED_HEADERS:
+        value = headers.get(name)
+        if value is None:
+            continue
+        value = ",".join(
+            sorted("".join(item.split()) for item in value.lower().split(","))
+        )
+        if value not in DEFAULT_HEADER_VALUES.get(name.lower(), ()):
+            variant.append(f"{name.lower()}={value}")
+    if variant:
+        url = f"{url}#{'&'.join(variant)}"
+    return url, auth_sha
+
+
+def migrate_cache_keys(cache):
+    """Move the cached responses to their canonical keys
+
+    The query strings of the keys were kept as sent by the clients before,
+    so the responses cached back then would never be hit again.
+
+    :return: the number of responses moved
+    :rtype: int
+    """
+    moved = 0
+    for key in cache:
+        url, auth_sha = key
+        new_key = _cache_key(url, {}, auth_sha)
+        if new_key != (url, auth_sha):
+            cache.rename(key, new_key)
+            cache.index(new_key, _index_names(url))
+            cache.deindex((url, auth_sha), _index_names(url))
+            moved += 1
+    LOG.info("MIGRATED %s cached responses to canonical keys", moved)
+    return moved
+
+
+def start_cache_keys_migration():
+    """Start moving the responses of the shared cache to canonical keys
+
+    Only the first mirror process to start does, once.
+
+    :return: the thread moving them, or None when there is nothing to move
+    :rtype: threading.Thread, optional
+    """
+    if CACHE_TYPE != "redis":
+        return None
+    cache = RequestsCache()
+    if not cache.claim("canonical-keys"):
+        return None
+    thread = threading.Thread(
+        target=migrate_cache_keys, args=(cache,), name="migration", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _conditional_headers(cached_response):
+    """Build the conditional request headers for a cached response"""
+    headers = {}
+    etag = cached_response.headers.get("ETag")
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    last_mod = cached_response.headers.get("Last-Modified")
+    if last_mod is not None:
+        headers["If-Modified-Since"] = last_mod
+    return headers
+
+
 def _cache_response(resp, cache, cache_key):
     """Cache response if it makes sense
 
     Implements the logic to decide whether or not whe should cache a request acording
-    to the headers and content
+    to the headers and content. The number of elements and the presence of a next
+    page are recorded along with the response, so revalidating it later does not
+    require parsing the body.
     """
     # Caching only makes sense when at least one
-    # of those headers is present
-    if resp.status_code == 200 and any([
-        "ETag" in resp.headers,
-        "Last-Modified" in resp.headers,
-    ]):
+    # of those headers is present, and when the response does not vary
+    # on something else than the request headers
+    if (
+        resp.status_code == 200
+        and any([
+            "ETag" in resp.headers,
+            "Last-Modified" in resp.headers,
+        ])
+        and resp.headers.get("Vary", "").strip() != "*"
+    ):
+        elements = _count_elements(resp)
+        resp.headers[PAGE_ELEMENTS_HEADER] = "" if elements is None else str(elements)
+        resp.headers[PAGE_NEXT_HEADER] = str(_has_next_page(resp)).lower()
         cache[cache_key] = resp
+        cache.index(cache_key, _index_names(cache_key[0]))
+
+
+def _path_prefixes(url):
+    """Paths of the resource at url and of all its parents, deepest first
+
+    They are lowercased, as GitHub user and repository names are case
+    insensitive.
+    """
+    segments = urlsplit(url).path.lower().strip("/").split("/")
+    return ["/" + "/".join(segments[:end]) for end in range(len(segments), 0, -1)]
+
+
+def _index_names(url):
+    """Names of the indexes the response for url is added to
+
+    Those are the path of the resource and of its parents, but the top
+    level ones, like '/repos', which would index most of the cache.
+    """
+    path, *parents = _path_prefixes(url)
+    return [path] + [parent for parent in parents if parent.count("/") > 1]
+
+
+def _drop(cache, key):
+    """Drop a cached response, if present, and remove it from its indexes"""
+    del cache[key]
+    cache.deindex(key, _index_names(key[0]))
+
 
+def _invalidate(url, auth_shas=None):
+    """Drop what a mutation of the resource at url made stale.
 
-def _online_request(
-    session, method, url, cached_response, headers=None, parameters=None
+    That is everything cached under the resource path, including the
+    resource itself, and its parent collection. Cached responses are found
+    through the path prefixes they were indexed by.
+
+    :param auth_shas: the users whose cached responses are dropped, or None
+        for all of them
+    :return: the number of cached responses dropped
+    :rtype: int
+    """
+    cache = RequestsCache()
+    path, *parents = _path_prefixes(url)
+    parent = parents[0] if parents else None
+
+    def _is_stale(key):
+        key_path = urlsplit(key[0]).path.lower().rstrip("/")
+        return (auth_shas is None or key[1] in auth_shas) and (
+            key_path in {parent, path} or key_path.startswith(path + "/")
+        )
+
+    keys = {
+        key
+        for name in {path, parent} - {None}
+        for key in cache.indexed(name)
+        if _is_stale(key)
+    }
+    validations = ValidationsCache()
+    for key in keys:
+        _drop(cache, key)
+        validations.discard(key)
+
+    collections = CollectionsCache()
+    for key in [key for key in collections if _is_stale(key)]:
+        collections.discard(key)
+
+    negatives = NegativesCache()
+    for key in [key for key in negatives if _is_stale(key)]:
+        negatives.discard(key)
+
+    LOG.info("INVALIDATED %s cached responses for %s", len(keys), url)
+    return len(keys)
+
+
+def _online_request(  # noqa: C901, PLR0911
+    session,
+    method,
+    url,
+    cached_response,
+    headers=None,
+    parameters=None,
+    auth_sha=None,
+    *,
+    stream=False,
 ):
-    """Handle API errors on conditional requests and try to serve contents from cache"""
+    """Handle API errors on conditional requests and try to serve contents from cache
+
+    :param stream: whether large successful responses are to be returned
+        before their body is read
+    """
+    resource = _rate_limit_resource(url)
+    cooldown = StatsCache().get_cooldown(auth_sha, resource)
+    if cooldown:
+        return _held_back_response(method, url, "COOLDOWN", cooldown, cached_response)
+
     try:
-        resp = session.request(
+        resp = _upstream_request(
+            session,
+            auth_sha,
             method=method,
             url=url,
             headers=headers,
             timeout=REQUESTS_TIMEOUT,
             params=parameters,
+            **({"stream": True} if stream else {}),
         )
+        StatsCache().set_quota(auth_sha, resp.headers)
+        _update_cooldown(auth_sha, resp, resource)
 
         # When we hit the API limit, or there is a problem with the API
         # let's try to serve from cache
@@ -88,6 +575,17 @@ def _online_request(
         cached_response.headers["X-Cache"] = error_resp_header + "_HIT"
         return cached_response
 
+    except UpstreamBusyError:
+        return _held_back_response(method, url, "BUSY", 1, cached_response)
+
+    except DeadlineExceededError:
+        if cached_response is None:
+            raise
+
+        LOG.info("DEADLINE GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "DEADLINE_HIT"
+        return cached_response
+
     except requests.exceptions.Timeout:
         if cached_response is None:
             raise
@@ -105,6 +603,223 @@ def _online_request(
         return cached_response
 
 
+def _rate_limit_resource(url):
+    """Get the rate limit resource the requests for url count against"""
+    path = urlsplit(url).path
+    return next(
+        (name for route, name in RATE_LIMIT_RESOURCES if route.fullmatch(path)),
+        "core",
+    )
+
+
+def _update_cooldown(auth_sha, resp, resource="core"):
+    """Hold back the requests upstream for a token when GitHub asks to
+
+    That is when a rate limit error comes with a 'Retry-After' header, and
+    when the token has no requests left until the rate limit reset. Only
+    the requests counting against the rate limit resource of the response
+    are held back, the one of the request when it has none.
+    """
+    now = time.time()
+    retry_after = resp.headers.get("Retry-After", "")
+    reset = resp.headers.get("X-RateLimit-Reset", "")
+    if retry_after.isdigit() and _is_rate_limit_error(resp):
+        until = now + int(retry_after)
+    elif resp.headers.get("X-RateLimit-Remaining") == "0" and reset.isdigit():
+        until = int(reset)
+    else:
+        return
+
+    user = None if auth_sha is None else UsersCache().get_by_sha(auth_sha)
+    resource = resp.headers.get("X-RateLimit-Resource", resource)
+    StatsCache().set_cooldown(auth_sha, until, user=user, resource=resource)
+
+
+def _upstream_request(session, auth_sha, **kwargs):
+    """Send a request upstream, in one of the token slots
+
+    GETs are hedged and retried, within RETRY_BUDGET. The outcome of each
+    request sent is recorded in UPSTREAM_HEALTH.
+
+    :raises UpstreamBusyError: when the token had no slot available in time
+    :raises DeadlineExceededError: when it could not be answered in time
+    """
+    timeout = kwargs["timeout"]
+    with UPSTREAM_SCHEDULER.slot(auth_sha):
+        kwargs["timeout"] = _upstream_timeout(timeout)
+        if kwargs["method"] != "GET":
+            return _send_upstream(session, kwargs)
+
+        RETRY_BUDGET.deposit()
+        attempt = 0
+        while True:
+            if attempt:
+                kwargs["timeout"] = _upstream_timeout(timeout)
+            try:
+                resp = _hedged_request(session, kwargs)
+            except requests.exceptions.ConnectionError:
+                if not _backoff(attempt):
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUS_CODES or not _backoff(attempt):
+                    return resp
+            attempt += 1
+
+
+def _upstream_timeout(timeout):
+    """Get the timeout of a request sent upstream within the current deadline
+
+    :param timeout: the timeout when there is no deadline, or a longer one
+    :raises DeadlineExceededError: when the time left is shorter than the
+        median of the latest upstream latencies
+    """
+    left = time_left()
+    if left is None:
+        return timeout
+    typical = UPSTREAM_LATENCIES.quantile(0.5) or 0
+    if left <= typical:
+        raise DeadlineExceededError(f"{left:.3f}s left, usually {typical:.3f}s")
+    return min(timeout, left)
+
+
+def _send_upstream(session, kwargs):
+    """Send a single request upstream, recording its outcome
+
+    Timeouts count as failures only when the full REQUESTS_TIMEOUT was
+    given, so a client asking for a short deadline cannot make the upstream
+    look offline for everyone.
+
+    When streaming, the body of the responses other than a 200 is still
+    read, so the connection is released when they are discarded.
+    """
+    start = time.monotonic()
+    try:
+        resp = session.request(**kwargs)
+        if kwargs.get("stream") and resp.status_code != 200:
+            resp.content  # noqa: B018
+    except PoolTimeoutError:
+        # The mirror ran out of connections, the upstream did not fail
+        raise
+    except requests.exceptions.Timeout:
+        # Timeouts shortened to fit the deadline of a client say nothing
+        # about the upstream, unless they lasted long enough to be slow
+        elapsed = time.monotonic() - start
+        if kwargs["timeout"] >= REQUESTS_TIMEOUT or (
+            UPSTREAM_HEALTH.slow and elapsed >= UPSTREAM_HEALTH.slow
+        ):
+            UPSTREAM_HEALTH.record(success=False)
+        raise
+    except requests.exceptions.ConnectionError:
+        UPSTREAM_HEALTH.record(success=False)
+        raise
+    elapsed = time.monotonic() - start
+    UPSTREAM_HEALTH.record(resp.status_code < 500, elapsed)
+    UPSTREAM_LATENCIES.add(elapsed)
+    return resp
+
+
+def _hedged_request(session, kwargs):
+    """Send a GET upstream, sending it again if it is slower than usual
+
+    The second request is sent once the first one takes longer than the
+    HEDGE_QUANTILE of the latest latencies, if RETRY_BUDGET allows it, and
+    the first response wins. The other one is discarded when it arrives.
+    """
+    delay = UPSTREAM_LATENCIES.quantile(HEDGE_QUANTILE) if HEDGE_QUANTILE else None
+    if delay is None:
+        return _send_upstream(session, kwargs)
+
+    stats_cache = StatsCache()
+    first = HEDGE_EXECUTOR.submit(_send_upstream, session, kwargs)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    if not RETRY_BUDGET.withdraw():
+        stats_cache.count_hedge("denied")
+        return first.result()
+
+    stats_cache.count_hedge("sent")
+    pending = {first, HEDGE_EXECUTOR.submit(_send_upstream, session, kwargs)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # A failure only wins when the other request failed too
+        for future in sorted(done, key=lambda future: future.exception() is not None):
+            if future.exception() is None or not pending:
+                if future is not first:
+                    stats_cache.count_hedge("won")
+                if kwargs.get("stream"):
+                    for other in pending | (done - {future}):
+                        other.add_done_callback(_close_discarded)
+                return future.result()
+
+
+def _close_discarded(future):
+    """Release the connection of a streamed hedged request that lost"""
+    if future.exception() is None:
+        future.result().close()
+
+
+def _is_streamed(resp):
+    """Check whether a response is sent to the client as it arrives
+
+    That is a successful response larger than STREAM_MIN_SIZE bytes, or of
+    unknown size.
+    """
+    if resp.status_code != 200:
+        return False
+    length = resp.headers.get("Content-Length", "")
+    return not length.isdigit() or int(length) > STREAM_MIN_SIZE
+
+
+def _backoff(attempt):
+    """Wait before sending a GET again, if it is to be retried
+
+    :return: whether it is to be retried, after RETRY_ATTEMPTS, within
+        RETRY_BUDGET and with time left for it before the deadline
+    :rtype: bool
+    """
+    if attempt >= RETRY_ATTEMPTS:
+        return False
+    sleep = random.uniform(0, RETRY_BACKOFF * 2**attempt)
+    left = time_left()
+    if left is not None and left <= sleep + (UPSTREAM_LATENCIES.quantile(0.5) or 0):
+        return False
+    if not RETRY_BUDGET.withdraw():
+        StatsCache().count_retry("denied")
+        return False
+    StatsCache().count_retry("sent")
+    time.sleep(sleep)
+    return True
+
+
+def _held_back_response(method, url, reason, retry_after, cached_response=None):
+    """Serve a request the mirror held back, without requesting upstream
+
+    The cached response, when there is one, or else an error telling the
+    client when to retry.
+
+    :param reason: why it was held back, one of HELD_BACK_MESSAGES
+    :param retry_after: seconds after which the client can retry
+    """
+    if cached_response is not None:
+        LOG.info("%s %s CACHE_HIT %s", reason, method, url)
+        cached_response.headers["X-Cache"] = f"{reason}_HIT"
+        return cached_response
+
+    LOG.info("%s %s CACHE_MISS %s", reason, method, url)
+    response = _build_response(
+        429,
+        json.dumps({
+            "message": HELD_BACK_MESSAGES[reason],
+            "documentation_url": "https://docs.github.com/rest/using-the-rest-api/rate-limits-for-the-rest-api",
+        }).encode(),
+        content_type="application/json; charset=utf-8",
+        x_cache=f"{reason}_MISS",
+    )
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
 def _is_last_full_page(cached_response, per_page_elements) -> bool:
     """
     Check if the cached response is the last full page of a paginated response.
@@ -117,11 +832,71 @@ def _is_last_full_page(cached_response, per_page_elements) -> bool:
     * https://docs.github.com/en/rest/using-the-rest-api/getting-started-with-the-rest-api?apiVersion=2022-11-28
     * https://docs.github.com/en/rest/using-the-rest-api/using-pagination-in-the-rest-api?apiVersion=2022-11-28#using-link-headers
     """
-    if len(cached_response.json()) != per_page_elements:
-        return False
-    if (links := cached_response.links) and links.get("next"):  # noqa: SIM103
+    if _page_elements(cached_response) != per_page_elements:
         return False
-    return True
+    has_next = cached_response.headers.get(PAGE_NEXT_HEADER)
+    if has_next is None:
+        return not _has_next_page(cached_response)
+    return has_next != "true"
+
+
+def _is_followed_by_elements(
+    session, headers, url, parameters, per_page_elements, cache, auth_sha
+):
+    """Probe whether any element comes after the last full page.
+
+    The probe asks for the single element right after the page, using
+    'per_page=1'. It is cached like any other response, so from the second
+    time on it is a conditional request that, on a 304, does not count
+    against the rate limit.
+
+    :return: whether there are elements after the page, or None when the
+        probe was not conclusive
+    :rtype: bool, optional
+    """
+    page = _page_number(parameters)
+    if page is None:
+        return None
+    probe_parameters = {
+        **parameters,
+        "page": str(page * per_page_elements + 1),
+        "per_page": "1",
+    }
+    probe_url = replace_query_parameters(url, probe_parameters)
+    probe_key = _cache_key(probe_url, headers, auth_sha)
+    probe_headers = {
+        key: value
+        for key, value in headers.items()
+        if key not in {"If-None-Match", "If-Modified-Since"}
+    }
+
+    cached_probe = cache.get(probe_key)
+    if cached_probe is not None:
+        probe_headers.update(_conditional_headers(cached_probe))
+
+    try:
+        resp = _upstream_request(
+            session,
+            auth_sha,
+            method="GET",
+            url=probe_url,
+            headers=probe_headers,
+            timeout=REQUESTS_TIMEOUT,
+        )
+    except requests.exceptions.RequestException:
+        return None
+
+    if resp.status_code == 304 and cached_probe is not None:
+        resp = cached_probe
+    elif resp.status_code == 200:
+        _cache_response(resp, cache, probe_key)
+    else:
+        return None
+
+    elements = _page_elements(resp)
+    if elements is None:
+        return None
+    return elements > 0
 
 
 def _handle_not_changed(
@@ -143,17 +918,41 @@ def _handle_not_changed(
     conditional headers. Otherwise, we can return the cached response.
     This is to ensure that we are not serving stale data due to weak etag,
     response links header can change even if the content did not change.
+    Before doing so, we cheaply probe for elements after that page: when
+    there are none, the links header is still accurate and the cached
+    response is served.
     """
-    if _is_last_full_page(cached_response, per_page_elements):
+    if _is_last_full_page(cached_response, per_page_elements) and (
+        _is_followed_by_elements(
+            session,
+            headers,
+            url,
+            parameters,
+            per_page_elements,
+            cache,
+            cache_key[1],
+        )
+        is not False
+    ):
         headers.pop("If-None-Match", None)
         headers.pop("If-Modified-Since", None)
-        resp = session.request(
-            method=method,
-            url=url,
-            headers=headers,
-            timeout=REQUESTS_TIMEOUT,
-            params=parameters,
-        )
+        try:
+            resp = _upstream_request(
+                session,
+                cache_key[1],
+                method=method,
+                url=url,
+                headers=headers,
+                timeout=REQUESTS_TIMEOUT,
+                params=parameters,
+            )
+        except UpstreamBusyError:
+            # Just validated, only its links may be outdated
+            return _held_back_response(method, url, "BUSY", 1, cached_response)
+        except DeadlineExceededError:
+            LOG.info("DEADLINE GET CACHE_HIT %s", url)
+            cached_response.headers["X-Cache"] = "DEADLINE_HIT"
+            return cached_response
 
         LOG.info("ONLINE GET CACHE_MISS %s", url)
         resp.headers["X-Cache"] = "ONLINE_MISS"
@@ -166,22 +965,180 @@ def _handle_not_changed(
 
 
 @requests_metrics
-def conditional_request(session, method, url, auth, data=None, url_params=None):
+def conditional_request(
+    session,
+    method,
+    url,
+    auth,
+    data=None,
+    url_params=None,
+    timeout=None,
+    *,
+    stream=False,
+    headers=None,
+):
     """Implements conditional requests.
 
     Checking first whether the upstream API is online of offline to decide which
-    request routine to call.
+    request routine to call. The request is answered within the timeout, in
+    seconds, the client asked for, or the one of its route. With stream, large
+    responses are returned before their body is read from upstream. The
+    headers are the FORWARDED_HEADERS of the client request.
     """
-    if GithubStatus().online:
-        return online_request(session, method, url, auth, data, url_params)
-    return offline_request(method, url, auth)
+    with deadline(_deadline(url, timeout)):
+        return _request(
+            session,
+            method,
+            url,
+            auth,
+            data,
+            url_params,
+            stream=stream,
+            headers=headers,
+        )
 
 
-def online_request(session, method, url, auth, data=None, url_params=None):
-    """Implements conditional requests."""
-    cache = RequestsCache()
-    headers = {}
-    parameters = url_params.to_dict() if url_params is not None else {}
+def _deadline(url, timeout=None):
+    """Get the seconds a request is to be answered within, or None
+
+    That is the shortest of timeout and the seconds of the first
+    DEADLINE_ROUTES entry matching the path.
+    """
+    path = urlsplit(url).path
+    route_timeout = next(
+        (seconds for route, seconds in DEADLINE_ROUTES if route.fullmatch(path)), None
+    )
+    return min(
+        (seconds for seconds in (route_timeout, timeout) if seconds is not None),
+        default=None,
+    )
+
+
+def _request(
+    session,
+    method,
+    url,
+    auth,
+    data=None,
+    url_params=None,
+    *,
+    stream=False,
+    headers=None,
+):
+    """Same as conditional_request, without collecting metrics.
+
+    Safe to be called outside of the flask request context. The upstream
+    is offline when the requests sent to it fail, and, optionally, when
+    the GitHub status page says so.
+    """
+    if GithubStatus().online and UPSTREAM_HEALTH.available():
+        return online_request(
+            session, method, url, auth, data, url_params, stream=stream, headers=headers
+        )
+    return offline_request(method, url, auth, headers=headers)
+
+
+def collection_request(session, url, auth, url_params=None):
+    """Fetch all the pages of a collection.
+
+    The first page is requested as usual, with the largest page size unless
+    the client asked for a specific one. The remaining pages, discovered from
+    its 'last' link, are then requested in parallel. Collections paginated
+    with cursors can only be walked one page after the other.
+
+    :return: the responses for all the pages, in order, or a single error
+        response when any of them fails
+    :rtype: list
+    """
+    parameters = dict(url_params.items()) if url_params is not None else {}
+    parameters.setdefault("per_page", str(MAX_PER_PAGE_ELEMENTS))
+    parameters.pop("page", None)
+
+    def _page_request(page_url):
+        return _request(
+            session, "GET", page_url, auth, url_params=query_parameters(page_url)
+        )
+
+    first = conditional_request(
+        session,
+        "GET",
+        replace_query_parameters(url, parameters),
+        auth,
+        url_params=parameters,
+    )
+    return _collection_pages(first, url, parameters, _page_request)
+
+
+def _collection_pages(first, url, parameters, page_request):
+    """Fetch the pages of a collection following its first one.
+
+    :param first: the response for the first page
+    :param url: the collection url
+    :param parameters: the query string parameters of the first page
+    :param page_request: callable fetching the page at a given url
+
+    :return: the responses for all the pages, in order, or a single error
+        response when any of them fails
+    :rtype: list
+    """
+    responses = [first]
+    if first.status_code != 200 or not _has_next_page(first):
+        return responses
+
+    last = link_page(first.links, "last")
+    if last is not None and is_page_based(first.links):
+        if last > COLLECTION_MAX_PAGES:
+            return [_collection_too_large()]
+        page_urls = [
+            replace_query_parameters(url, {**parameters, "page": str(page)})
+            for page in range(2, last + 1)
+        ]
+        # Collection workers fetching a page, as merged collections do, would
+        # deadlock waiting for pages queued behind them, so they go serially
+        if getattr(_COLLECTION_WORKER, "active", False):
+            responses.extend(map(page_request, page_urls))
+        else:
+            responses.extend(COLLECTION_EXECUTOR.map(page_request, page_urls))
+    else:
+        while _has_next_page(responses[-1]):
+            if len(responses) >= COLLECTION_MAX_PAGES:
+                return [_collection_too_large()]
+            responses.append(page_request(responses[-1].links["next"]["url"]))
+            if responses[-1].status_code != 200:
+                break
+
+    failed = [resp for resp in responses if resp.status_code != 200]
+    return failed[:1] or responses
+
+
+def _collection_too_large():
+    """Response for collections with more than COLLECTION_MAX_PAGES pages"""
+    return _build_response(
+        422,
+        json.dumps({
+            "message": f"Collection has more than {COLLECTION_MAX_PAGES} pages"
+        }).encode(),
+        content_type="application/json; charset=utf-8",
+    )
+
+
+def online_request(
+    session,
+    method,
+    url,
+    auth,
+    data=None,
+    url_params=None,
+    *,
+    stream=False,
+    headers=None,
+):
+    """Implements conditional requests.
+
+    :param headers: the FORWARDED_HEADERS of the client request
+    """
+    headers = dict(headers or {})
+    parameters = dict(url_params.items()) if url_params is not None else {}
 
     per_page_elements = _get_elements_per_page(url_params)
 
@@ -197,8 +1154,278 @@ def online_request(session, method, url, auth, data=None, url_params=None):
 
     # Special case for non-GET requests
     if method != "GET":
-        # Just forward the request with the auth header
-        resp = session.request(
+        return _forward_request(
+            session, method, url, headers, data, parameters, auth_sha
+        )
+
+    if _is_incremental(url, parameters):
+        return _incremental_request(
+            session, url, headers, parameters, per_page_elements, auth_sha
+        )
+
+    if (
+        per_page_elements < UPSTREAM_PER_PAGE
+        and _page_number(parameters) is not None
+        and not any(
+            route.fullmatch(urlsplit(url).path) for route in COALESCE_EXCLUDED_ROUTES
+        )
+    ):
+        return _coalesced_request(
+            session, url, headers, parameters, per_page_elements, auth_sha
+        )
+
+    resp = None
+    cache_key = _cache_key(url, headers, auth_sha)
+    if PREFETCH_EXECUTOR is not None and PrefetchesCache().pop(
+        cache_key, PREFETCH_MAX_AGE
+    ):
+        resp = RequestsCache().get(cache_key)
+        if resp is not None:
+            LOG.info("PREFETCH GET CACHE_HIT %s", url)
+            StatsCache().count_prefetch("used")
+            resp.headers["X-Cache"] = "PREFETCH_HIT"
+
+    if resp is None:
+        resp = _cached_request(
+            session,
+            url,
+            headers,
+            parameters,
+            per_page_elements,
+            auth_sha,
+            max_age=_webhook_max_age(url),
+            stream=stream and STREAM_MIN_SIZE > 0,
+        )
+    if PREFETCH_EXECUTOR is not None and resp.status_code == 200:
+        _prefetch_next_page(session, resp, headers, auth_sha)
+    return resp
+
+
+def is_disk_cached(url):
+    """Check whether the downloads from url are kept in DISK_CACHE"""
+    return DISK_CACHE is not None and any(
+        route.fullmatch(urlsplit(url).path) for route in DISK_CACHE_ROUTES
+    )
+
+
+@requests_metrics
+def disk_request(session, url, auth, headers=None):
+    """Serve a download kept in DISK_CACHE, fetching it upstream when needed
+
+    Downloads of a commit SHA never change, and are served without
+    revalidating them. The others are revalidated with a conditional
+    request, following the redirects to the actual download. Successful
+    responses are served from an open file, as their raw body, or, when
+    fetched upstream, from the bytes written to the file as they arrive.
+
+    :param headers: the FORWARDED_HEADERS of the client request
+    """
+    headers = dict(headers or {})
+    auth_sha = None
+    if auth is not None:
+        auth_sha = hashlib.sha1(auth.encode()).hexdigest()
+        headers["Authorization"] = auth
+
+    variant_url, _ = _cache_key(url, headers, auth_sha)
+    key = f"{auth_sha}:{variant_url}"
+    cached_response = _disk_response(DISK_CACHE.open(key))
+    if cached_response is not None and _is_immutable(url):
+        LOG.info("DISK GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "DISK_HIT"
+        return cached_response
+
+    if not (GithubStatus().online and UPSTREAM_HEALTH.available()):
+        if cached_response is None:
+            return offline_request("GET", url, auth, headers=headers)
+        LOG.info("OFFLINE GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "OFFLINE_HIT"
+        return cached_response
+
+    if cached_response is not None:
+        headers.update(_conditional_headers(cached_response))
+    resp = _online_request(
+        session,
+        "GET",
+        url,
+        cached_response,
+        headers=headers,
+        auth_sha=auth_sha,
+        stream=True,
+    )
+    if resp is cached_response:
+        return resp
+    if resp.status_code == 304:
+        LOG.info("ONLINE GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "ONLINE_HIT"
+        return cached_response
+
+    if cached_response is not None:
+        cached_response.close()
+    LOG.info("ONLINE GET CACHE_MISS %s", url)
+    if resp.status_code == 200:
+        download_headers = {
+            name: resp.headers[name]
+            for name in DISK_CACHE_HEADERS
+            if name in resp.headers
+        }
+        resp = _disk_response((
+            DISK_CACHE.store(key, _download_chunks(resp), download_headers),
+            download_headers,
+        ))
+    resp.headers["X-Cache"] = "ONLINE_MISS"
+    return resp
+
+
+def _is_immutable(url):
+    """Check whether the download at url is the one of a commit SHA"""
+    return (
+        re.fullmatch(r"[0-9a-f]{40}", urlsplit(url).path.rsplit("/", 1)[-1]) is not None
+    )
+
+
+def _download_chunks(resp):
+    """Read the body of a download, closing the connection once done"""
+    try:
+        yield from resp.iter_content(STREAM_CHUNK_SIZE)
+    finally:
+        resp.close()
+
+
+def _disk_response(download):
+    """Build the response for a download kept on disk
+
+    :param download: the open file, or the bytes of the download being
+        stored, and the headers of the download, or None
+    """
+    if download is None:
+        return None
+    file, headers = download
+    response = requests.models.Response()
+    response.status_code = 200
+    response.headers.update(headers)
+    response.raw = file
+    return response
+
+
+def webhook_request(event, payload, *, polled=False):
+    """Drop the cached responses made stale by a webhook delivery.
+
+    The cached responses for the resources in the event are dropped for all
+    the users, as a mutation would. Everything else cached for the
+    repository is revalidated upstream the next time it is requested, by
+    every mirror process the delivery is shared with through
+    WEBHOOKS_CHANNEL. Those processes then serve the repository without
+    revalidating it for WEBHOOK_MAX_AGE seconds. Without the channel, the
+    other processes would not learn about the next deliveries, so it is
+    always revalidated.
+
+    :param event: the event name, from the X-GitHub-Event header
+    :param payload: the delivery payload
+    :param polled: whether the event was polled, as every process does
+
+    :return: the number of cached responses dropped
+    :rtype: int
+    """
+    full_name = (payload.get("repository") or {}).get("full_name")
+    if full_name is None:
+        return 0
+
+    repo_url = f"{GH_API}/repos/{full_name}"
+    invalidated = 0
+    for path in WEBHOOK_EVENT_PATHS.get(event, []):
+        try:
+            resource_url = f"{repo_url}/{path.format_map(payload)}"
+        except (KeyError, TypeError):
+            LOG.info("WEBHOOK %s without %s for %s", event, path, full_name)
+            continue
+        invalidated += _invalidate(resource_url)
+    if polled or WEBHOOKS_CHANNEL is None:
+        _revalidate(repo_url)
+    else:
+        WEBHOOKS_CHANNEL.publish(full_name)
+    return invalidated
+
+
+def _notified(full_name):
+    """Handle a webhook delivery for a repository, shared by any process"""
+    repo_url = f"{GH_API}/repos/{full_name}"
+    WebhooksCache().add(_path_prefixes(repo_url)[0])
+    _revalidate(repo_url)
+
+
+def start_webhooks_listener():
+    """Start handling the webhook deliveries shared by the mirror processes
+
+    :return: the thread handling them, or None when they are not shared
+    :rtype: threading.Thread, optional
+    """
+    if WEBHOOKS_CHANNEL is None:
+        if WEBHOOK_MAX_AGE:
+            LOG.warning("WEBHOOK_MAX_AGE ignored for deliveries without Redis")
+        return None
+    thread = threading.Thread(target=_listen_webhooks, name="webhooks", daemon=True)
+    thread.start()
+    return thread
+
+
+def _listen_webhooks():
+    """Handle the webhook deliveries shared through WEBHOOKS_CHANNEL"""
+    while True:
+        for full_name in WEBHOOKS_CHANNEL.listen():
+            _notified(full_name)
+        # Deliveries may be missed until listening again, so no repository
+        # is served without revalidating it until notified again
+        WebhooksCache().clear()
+        time.sleep(WEBHOOKS_RETRY_INTERVAL)
+
+
+def _revalidate(url):
+    """Make everything cached under url be revalidated when requested next"""
+    path = _path_prefixes(url)[0]
+    validations = ValidationsCache()
+    prefetches = PrefetchesCache()
+    for key in RequestsCache().indexed(path):
+        validations.discard(key)
+        prefetches.pop(key, 0)
+
+    for keys in (CollectionsCache(), NegativesCache()):
+        for key in list(keys):
+            key_path = urlsplit(key[0]).path.lower().rstrip("/")
+            if key_path == path or key_path.startswith(path + "/"):
+                keys.discard(key)
+
+
+def _webhook_max_age(url):
+    """Seconds during which the response for url is served without revalidating
+
+    Only the repositories whose webhook deliveries are shared with this
+    mirror process, or whose events, or their organization ones, it polls
+    are, since they are the ones it learns about the changes of.
+    """
+    if not WEBHOOK_MAX_AGE:
+        return 0
+    segments = urlsplit(url).path.lower().split("/")
+    # The events are how the changes are learnt about, so always revalidated
+    if len(segments) < 4 or segments[1] != "repos" or segments[-1] == "events":
+        return 0
+    webhooks = WebhooksCache()
+    if "/".join(segments[:4]) in webhooks or f"/orgs/{segments[2]}" in webhooks:
+        return WEBHOOK_MAX_AGE
+    return 0
+
+
+def _forward_request(session, method, url, headers, data, parameters, auth_sha):
+    """Forward a non-GET request, invalidating what it made stale on success"""
+    resource = _rate_limit_resource(url)
+    cooldown = StatsCache().get_cooldown(auth_sha, resource)
+    if cooldown:
+        return _held_back_response(method, url, "COOLDOWN", cooldown)
+
+    # Just forward the request with the auth header
+    try:
+        resp = _upstream_request(
+            session,
+            auth_sha,
             method=method,
             url=url,
             headers=headers,
@@ -206,46 +1433,127 @@ def online_request(session, method, url, auth, data=None, url_params=None):
             timeout=REQUESTS_TIMEOUT,
             params=parameters,
         )
+    except UpstreamBusyError:
+        return _held_back_response(method, url, "BUSY", 1)
+    _update_cooldown(auth_sha, resp, resource)
 
-        LOG.info("ONLINE %s CACHE_MISS %s", method, url)
-        # And just forward the response (with the
-        # cache-miss header, for metrics)
-        resp.headers["X-Cache"] = "ONLINE_MISS"
-        return resp
+    LOG.info("ONLINE %s CACHE_MISS %s", method, url)
+    # And just forward the response (with the
+    # cache-miss header, for metrics)
+    resp.headers["X-Cache"] = "ONLINE_MISS"
+    if 200 <= resp.status_code < 300:
+        _invalidate(url, {auth_sha})
+    return resp
+
+
+def _prefetch_next_page(session, resp, headers, auth_sha):
+    """Fetch the next page of a response in the background.
+
+    Clients walking a collection are expected to request it right away,
+    using the url from the 'next' link, so the prefetched page is cached
+    under the same key their request will use.
+    """
+    if not _has_next_page(resp):
+        return
+
+    stats_cache = StatsCache()
+    next_url = resp.links["next"]["url"]
+    next_key = _cache_key(next_url, headers, auth_sha)
+    if PrefetchesCache().is_fresh(next_key, PREFETCH_MAX_AGE):
+        return
+
+    remaining = stats_cache.get_quota(auth_sha)
+    if remaining is not None and remaining < PREFETCH_MIN_QUOTA:
+        stats_cache.count_prefetch("throttled")
+        return
+
+    if not PREFETCH_SLOTS.acquire(blocking=False):
+        stats_cache.count_prefetch("dropped")
+        return
+
+    def _prefetch():
+        try:
+            parameters = query_parameters(next_url)
+            next_resp = _cached_request(
+                session,
+                next_url,
+                headers,
+                parameters,
+                _get_elements_per_page(parameters) or PER_PAGE_ELEMENTS,
+                auth_sha,
+            )
+            if next_resp.status_code == 200 and next_key in RequestsCache():
+                PrefetchesCache().add(next_key)
+        except requests.exceptions.RequestException as error:
+            LOG.info("PREFETCH GET failed %s: %s", next_url, error)
+        finally:
+            PREFETCH_SLOTS.release()
+
+    stats_cache.count_prefetch("scheduled")
+    PREFETCH_EXECUTOR.submit(_prefetch)
 
-    cache_key = (url, auth_sha)
 
-    cached_response = None
-    if cache_key in cache:
-        cached_response = cache[cache_key]
-        etag = cached_response.headers.get("ETag")
-        if etag is not None:
-            headers["If-None-Match"] = etag
-        last_mod = cached_response.headers.get("Last-Modified")
-        if last_mod is not None:
-            headers["If-Modified-Since"] = last_mod
+def _cached_request(
+    session,
+    url,
+    headers,
+    parameters,
+    per_page_elements,
+    auth_sha,
+    max_age=0,
+    *,
+    stream=False,
+):
+    """Implements conditional GET requests, backed by the requests cache.
+
+    :param max_age: seconds during which a cached response is served
+        without revalidating it upstream
+    :param stream: whether large successful responses are returned before
+        their body is read, being cached once the client read it
+    """
+    cache = RequestsCache()
+    validations = ValidationsCache()
+    cache_key = _cache_key(url, headers, auth_sha)
+    headers = dict(headers)
+
+    negative_response = NegativesCache().get(cache_key)
+    if negative_response is not None:
+        LOG.info("NEGATIVE GET CACHE_HIT %s", url)
+        negative_response.headers["X-Cache"] = "NEGATIVE_HIT"
+        return negative_response
+
+    cached_response = cache.get(cache_key)
+    if cached_response is not None:
+        if _is_served_unvalidated(url, cached_response, cache_key, max_age):
+            return cached_response
+        headers.update(_conditional_headers(cached_response))
 
     resp = _online_request(
         session=session,
-        method=method,
+        method="GET",
         url=url,
         headers=headers,
         parameters=parameters,
         cached_response=cached_response,
+        auth_sha=auth_sha,
+        stream=stream,
     )
 
     if resp.status_code == 304:
-        return _handle_not_changed(
+        resp = _handle_not_changed(
             session,
             cached_response,
             per_page_elements,
             headers,
-            method,
+            "GET",
             url,
             parameters,
             cache,
             cache_key,
         )
+        if max_age:
+            validations.mark(cache_key)
+        return resp
 
     # This section covers the log and the headers logic when we don't have
     # any error on the _online_request method, and the response from the
@@ -253,11 +1561,438 @@ def online_request(session, method, url, auth, data=None, url_params=None):
     if "X-Cache" not in resp.headers:
         LOG.info("ONLINE GET CACHE_MISS %s", url)
         resp.headers["X-Cache"] = "ONLINE_MISS"
+        if stream and _stream_into_cache(
+            resp, cache, cache_key, validations if max_age else None
+        ):
+            return resp
         _cache_response(resp, cache, cache_key)
+        if max_age and cache_key in cache:
+            validations.mark(cache_key)
+        _cache_negative_response(resp, cache_key)
 
     return resp
 
 
+def _is_served_unvalidated(url, cached_response, cache_key, max_age):
+    """Check whether a cached response is served without revalidating it
+
+    That is when it was validated less than max_age seconds ago, or when the
+    token is short of quota.
+    """
+    if max_age and ValidationsCache().is_fresh(cache_key, max_age):
+        LOG.info("FRESH GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "FRESH_HIT"
+        return True
+    if StatsCache().get_quota_shortage(cache_key[1], QUOTA_RESERVE):
+        LOG.info("LOW_QUOTA GET CACHE_HIT %s", url)
+        cached_response.headers["X-Cache"] = "LOW_QUOTA_HIT"
+        return True
+    return False
+
+
+def _stream_into_cache(resp, cache, cache_key, validations=None):
+    """Make the body of a response be read as it is sent to the client
+
+    The body is only kept aside when the response is to be cached, and it
+    is cached once fully read, so responses the client stops reading are
+    not cached, and neither are the ones larger than STREAM_MAX_CACHED_SIZE.
+    Responses not to be streamed are read right away instead.
+
+    :param validations: the ValidationsCache to mark the response in
+    :return: whether the response is streamed
+    :rtype: bool
+    """
+    if not _is_streamed(resp):
+        resp.content  # noqa: B018
+        return False
+
+    length = resp.headers.get("Content-Length", "")
+    if ("ETag" not in resp.headers and "Last-Modified" not in resp.headers) or (
+        length.isdigit() and int(length) > STREAM_MAX_CACHED_SIZE
+    ):
+        resp.raw = StreamedBody(resp.raw)
+        return True
+
+    def _complete(content):
+        # Served from memory from now on, the connection being released
+        resp.raw = None
+        resp._content = content  # noqa: SLF001
+        _cache_response(resp, cache, cache_key)
+        if validations is not None:
+            validations.mark(cache_key)
+
+    resp.raw = StreamedBody(resp.raw, _complete, STREAM_MAX_CACHED_SIZE)
+    return True
+
+
+def _cache_negative_response(resp, cache_key):
+    """Keep failed responses for NEGATIVE_MAX_AGE seconds
+
+    Those are the not found responses and the failed authentications, like
+    the ones of revoked tokens validated in check_user, except for the paths
+    in NEGATIVE_EXCLUDED_ROUTES.
+    """
+    if (
+        NEGATIVE_MAX_AGE
+        and resp.status_code in NEGATIVE_STATUS_CODES
+        and not any(
+            route.fullmatch(urlsplit(cache_key[0]).path)
+            for route in NEGATIVE_EXCLUDED_ROUTES
+        )
+    ):
+        NegativesCache().set(cache_key, resp, NEGATIVE_MAX_AGE)
+
+
+def _coalesced_request(session, url, headers, parameters, per_page_elements, auth_sha):
+    """Serve a page by slicing the larger upstream pages that contain it.
+
+    Clients walking a collection with small pages then share the same
+    UPSTREAM_PER_PAGE sized pages, each one fetched and revalidated once per
+    COALESCE_MAX_AGE seconds. The 'Link' header is rebuilt for the requested
+    page size, and the 'ETag' is a weak one derived from the page served, as
+    the upstream validators are the ones of the larger pages. There is no
+    'Last-Modified'. Responses that are not page-based JSON lists are served
+    as they would be without coalescing.
+    """
+    page = _page_number(parameters)
+    first_element = (page - 1) * per_page_elements
+    first_upstream_page = first_element // UPSTREAM_PER_PAGE + 1
+    last_upstream_page = (
+        first_element + per_page_elements - 1
+    ) // UPSTREAM_PER_PAGE + 1
+
+    def _upstream_page(upstream_page):
+        upstream_parameters = {
+            **parameters,
+            "page": str(upstream_page),
+            "per_page": str(UPSTREAM_PER_PAGE),
+        }
+        return _cached_request(
+            session,
+            replace_query_parameters(url, upstream_parameters),
+            headers,
+            upstream_parameters,
+            UPSTREAM_PER_PAGE,
+            auth_sha,
+            max_age=COALESCE_MAX_AGE,
+        )
+
+    elements = []
+    responses = []
+    for upstream_page in range(first_upstream_page, last_upstream_page + 1):
+        resp = _upstream_page(upstream_page)
+        if resp.status_code != 200:
+            return resp
+
+        body = _json_list(resp)
+        if body is None or not is_page_based(resp.links):
+            # Not a collection we know how to slice. An unpaginated
+            # resource is the same regardless of the page size, but
+            # anything else has to be requested as the client did
+            if upstream_page == 1 and "Link" not in resp.headers:
+                return resp
+            return _cached_request(
+                session, url, headers, parameters, per_page_elements, auth_sha
+            )
+
+        responses.append(resp)
+        elements.extend(body)
+        if not _has_next_page(resp):
+            break
+
+    offset = first_element - (first_upstream_page - 1) * UPSTREAM_PER_PAGE
+    total = _collection_total(
+        responses[-1], first_upstream_page, len(elements), _upstream_page
+    )
+    if total is None:
+        has_next = _has_next_page(responses[-1]) or (
+            offset + per_page_elements < len(elements)
+        )
+        last_page = None
+    else:
+        has_next = first_element + per_page_elements < total
+        last_page = max(1, math.ceil(total / per_page_elements))
+
+    content = json.dumps(
+        elements[offset : offset + per_page_elements], separators=(",", ":")
+    ).encode()
+    response = _build_response(
+        200,
+        content,
+        content_type=responses[0].headers.get("Content-Type"),
+        link=build_link_header(url, page, last_page, has_next),
+        x_cache=_combined_x_cache(responses),
+    )
+    response.headers["ETag"] = f'W/"{hashlib.sha1(content).hexdigest()}"'
+    LOG.info("%s GET COALESCED %s", response.headers["X-Cache"], url)
+    return response
+
+
+def _page_number(parameters):
+    """Get the requested page, None when it is not a positive number
+
+    :rtype: int, optional
+    """
+    try:
+        page = int(parameters.get("page", 1))
+    except ValueError:
+        return None
+    return page if page >= 1 else None
+
+
+def _is_incremental(url, parameters):
+    """Check whether a GET is served from a merged collection
+
+    Only the routes in INCREMENTAL_ROUTES are, when explicitly sorted by a
+    field the mirror can sort on, with no other filter than 'state', for a
+    valid page. Other filters, like 'labels', would leave in the collection
+    the elements that stopped matching them, as the deltas do not include
+    those.
+    """
+    return (
+        parameters.get("sort") in INCREMENTAL_SORT_FIELDS
+        and _page_number(parameters) is not None
+        and set(parameters) <= INCREMENTAL_PARAMETERS
+        and any(route.fullmatch(urlsplit(url).path) for route in INCREMENTAL_ROUTES)
+    )
+
+
+def _incremental_request(
+    session, url, headers, parameters, per_page_elements, auth_sha
+):
+    """Serve a page from a collection kept up to date with 'since' deltas.
+
+    The whole collection is fetched once and stored, merged, regardless of
+    the page size and order. From then on, only the elements updated since
+    the latest 'updated_at' seen are fetched and patched into it, so a
+    change costs one small page instead of the whole collection. Pages are
+    then sorted and sliced locally, and the 'Link' header is rebuilt for them.
+    The collection holds the elements in any state, so the ones whose state
+    changed are in the deltas, and the 'state' filter is applied locally,
+    'open' by default like upstream.
+
+    Collections that can not be merged, and failing upstream requests, are
+    served as they would be without it.
+    """
+    collection, x_cache = _refreshed_collection(
+        session,
+        replace_query_parameters(url, {"state": "all"}),
+        headers,
+        auth_sha,
+    )
+    if collection is None:
+        return _cached_request(
+            session, url, headers, parameters, per_page_elements, auth_sha
+        )
+
+    page = _page_number(parameters)
+    elements = _sorted_elements(
+        collection,
+        INCREMENTAL_SORT_FIELDS[parameters["sort"]],
+        parameters.get("direction", "desc") != "asc",
+        parameters.get("state", "open"),
+    )
+    first_element = (page - 1) * per_page_elements
+    response = _build_response(
+        200,
+        json.dumps(
+            elements[first_element : first_element + per_page_elements],
+            separators=(",", ":"),
+        ).encode(),
+        content_type=collection["content_type"],
+        link=build_link_header(
+            url,
+            page,
+            max(1, math.ceil(len(elements) / per_page_elements)),
+            first_element + per_page_elements < len(elements),
+        ),
+        x_cache=x_cache,
+    )
+    LOG.info("%s GET INCREMENTAL %s", x_cache, url)
+    return response
+
+
+def _refreshed_collection(session, collection_url, headers, auth_sha):
+    """Get a merged collection, fetching what changed upstream if needed
+
+    A delta is fetched at most once every INCREMENTAL_MAX_AGE seconds, and
+    the whole collection every INCREMENTAL_RESYNC seconds. The upstream
+    pages are cached and revalidated like any other response, so a delta
+    with no changes is a 304.
+
+    :return: the collection and the X-Cache value, or (None, None) when the
+        collection could not be fetched or merged
+    :rtype: tuple
+    """
+    collections = CollectionsCache()
+    collection_key = _cache_key(collection_url, headers, auth_sha)
+    collection = collections.get(collection_key)
+    now = time.monotonic()
+    if collection is not None:
+        if now - collection["synced"] >= INCREMENTAL_RESYNC:
+            collection = None
+        elif now - collection["refreshed"] < INCREMENTAL_MAX_AGE:
+            return collection, "INCREMENTAL_HIT"
+
+    parameters = {
+        **query_parameters(collection_url),
+        "per_page": str(MAX_PER_PAGE_ELEMENTS),
+    }
+    if collection is not None and collection["high_water"] is not None:
+        parameters["since"] = collection["high_water"]
+
+    def _page_request(page_url):
+        return _cached_request(
+            session,
+            page_url,
+            headers,
+            query_parameters(page_url),
+            MAX_PER_PAGE_ELEMENTS,
+            auth_sha,
+        )
+
+    responses = _collection_pages(
+        _page_request(replace_query_parameters(collection_url, parameters)),
+        collection_url,
+        parameters,
+        _page_request,
+    )
+    if responses[0].status_code != 200:
+        return None, None
+    collection = _merged_collection(collection, responses, now)
+    if collection is None:
+        return None, None
+
+    collections.set(collection_key, collection)
+    if _combined_x_cache(responses).endswith("_MISS"):
+        return collection, "INCREMENTAL_MISS"
+    return collection, "INCREMENTAL_HIT"
+
+
+def _merged_collection(collection, responses, now):
+    """Patch the elements of the responses into a copy of the collection
+
+    Elements are identified by their 'id', and the latest 'updated_at' is
+    kept as the high-water mark for the next delta.
+
+    :param collection: the collection to patch, or None to start a new one
+    :param responses: the upstream pages
+    :param now: the time of the update, from time.monotonic()
+
+    :return: the merged collection, or None when the responses are not
+        JSON lists of elements with 'id', 'created_at' and 'updated_at'
+    :rtype: dict, optional
+    """
+    if collection is None:
+        collection = {"elements": {}, "high_water": None, "synced": now}
+    elements = dict(collection["elements"])
+    high_water = collection["high_water"]
+    for resp in responses:
+        body = _json_list(resp)
+        if body is None:
+            return None
+        for element in body:
+            if not isinstance(element, dict) or any(
+                element.get(field) is None
+                for field in ("id", *INCREMENTAL_SORT_FIELDS.values())
+            ):
+                return None
+            elements[element["id"]] = element
+            high_water = max(high_water or "", element["updated_at"])
+
+    return {
+        "elements": elements,
+        "high_water": high_water,
+        "synced": collection["synced"],
+        "refreshed": now,
+        "content_type": responses[0].headers.get("Content-Type"),
+        "orders": {},
+    }
+
+
+def _sorted_elements(collection, field, reverse, state="all"):
+    """Elements of a merged collection sorted by field, ties broken by id
+
+    Only the elements in the state are kept, unless it is 'all'. Elements
+    without a state, like comments, are always kept. Orders are computed
+    once per version of the collection.
+    """
+    orders = collection["orders"]
+    if (field, reverse, state) not in orders:
+        orders[field, reverse, state] = sorted(
+            (
+                element
+                for element in collection["elements"].values()
+                if state in {"all", element.get("state", state)}
+            ),
+            key=operator.itemgetter(field, "id"),
+            reverse=reverse,
+        )
+    return orders[field, reverse, state]
+
+
+def _json_list(resp):
+    """Get the body of a response if it is a JSON list, or None"""
+    try:
+        body = resp.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, list) else None
+
+
+def _collection_total(last_resp, first_upstream_page, fetched, upstream_page):
+    """Total number of elements of a collection, if it can be known
+
+    :param last_resp: the last upstream page fetched
+    :param first_upstream_page: the first upstream page fetched
+    :param fetched: number of elements fetched from first_upstream_page on
+    :param upstream_page: callable fetching a given upstream page
+
+    :rtype: int, optional
+    """
+    if not _has_next_page(last_resp):
+        # An empty page past the end tells nothing about the total
+        if fetched or first_upstream_page == 1:
+            return (first_upstream_page - 1) * UPSTREAM_PER_PAGE + fetched
+        return None
+
+    last = link_page(last_resp.links, "last")
+    if last is None:
+        return None
+    resp = upstream_page(last)
+    elements = _page_elements(resp)
+    if resp.status_code != 200 or elements is None:
+        return None
+    return (last - 1) * UPSTREAM_PER_PAGE + elements
+
+
+def _combined_x_cache(responses):
+    """X-Cache value summarizing several upstream responses
+
+    A miss on any of them makes the result a miss.
+    """
+    cache_statuses = [resp.headers["X-Cache"] for resp in responses]
+    return next(
+        (status for status in cache_statuses if status.endswith("_MISS")),
+        cache_statuses[0],
+    )
+
+
+def _build_response(status_code, content, content_type=None, link=None, x_cache=None):
+    """Build a response generated by the mirror itself"""
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.encoding = "utf-8"
+    response._content = content  # noqa: SLF001
+    if content_type is not None:
+        response.headers["Content-Type"] = content_type
+    if link is not None:
+        response.headers["Link"] = link
+    if x_cache is not None:
+        response.headers["X-Cache"] = x_cache
+    return response
+
+
 def _should_error_response_be_served_from_cache(response):
     """Parse a response to check if we should serve contents from cache
 
@@ -288,16 +2023,26 @@ def _is_rate_limit_error(response):
         "secondary rate limit",
         "abuse detection mechanism",
     }
+    if response.status_code == 429:
+        return True
     return response.status_code == 403 and any(
         m in response.text for m in rate_limit_messages
     )
 
 
 def offline_request(
-    method, url, auth, error_code=504, error_message=b'{"message": "gateway timeout"}\n'
+    method,
+    url,
+    auth,
+    error_code=504,
+    error_message=b'{"message": "gateway timeout"}\n',
+    headers=None,
 ):
-    """Implements offline requests (serves content from cache, when possible)."""
-    headers = {}
+    """Implements offline requests (serves content from cache, when possible).
+
+    :param headers: the FORWARDED_HEADERS of the client request
+    """
+    headers = dict(headers or {})
     if auth is None:
         auth_sha = None
     else:
@@ -316,14 +2061,12 @@ def offline_request(
         response._content = error_message  # noqa: SLF001
         return response
 
-    cache = RequestsCache()
-    cache_key = (url, auth_sha)
-    if cache_key in cache:
+    cached_response = RequestsCache().get(_cache_key(url, headers, auth_sha))
+    if cached_response is not None:
         LOG.info("OFFLINE GET CACHE_HIT %s", url)
         # This is the best case: upstream is offline
         # but we have the resource in cache for a given
         # user. We then serve from cache.
-        cached_response = cache[cache_key]
         cached_response.headers["X-Cache"] = "OFFLINE_HIT"
         return cached_response
 
@@ -14,6 +14,58 @@
 
 """Module containing all the abstractions around an HTTP response."""
 
+# Bytes read from upstream at a time for the responses sent as they arrive
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class StreamedBody:
+    """Raw body of a response sent to the client as it arrives from upstream.
+
+    Stands for the raw body of a requests.Response, reading the decoded body
+    one chunk at a time. When on_complete is set, the chunks are kept aside
+    and, once the whole body is read, on_complete is called with it. Bodies
+    growing past max_size bytes stop being kept, and on_complete is never
+    called for them.
+
+    :param raw: the raw body of the upstream response
+    :param on_complete: callable taking the whole body, optional
+    :param max_size: the most bytes kept aside, optional
+
+    :type raw: urllib3.response.HTTPResponse
+    :type max_size: int
+    """
+
+    def __init__(self, raw, on_complete=None, max_size=None):
+        self._raw = raw
+        self._on_complete = on_complete
+        self._max_size = max_size
+        self._chunks = []
+        self._size = 0
+
+    def read(self, amt=None, **_kwargs):
+        """Read up to amt bytes of the decoded body, b'' once it is read."""
+        chunk = self._raw.read(amt, decode_content=True)
+        if self._on_complete is not None:
+            if chunk:
+                self._size += len(chunk)
+                if self._max_size is not None and self._size > self._max_size:
+                    self._on_complete, self._chunks = None, []
+                else:
+                    self._chunks.append(chunk)
+            else:
+                on_complete, self._on_complete = self._on_complete, None
+                content, self._chunks = b"".join(self._chunks), []
+                on_complete(content)
+        return chunk
+
+    def close(self):
+        """Close the connection, unless the body was read already."""
+        self._raw.close()
+
+    def release_conn(self):
+        """Release the connection back to its pool."""
+        self._raw.release_conn()
+
 
 class MirrorResponse:
     """Wrapper around the requests.Response.
@@ -70,6 +122,14 @@ class MirrorResponse:
         if etag is not None:
             sanitized_headers["ETag"] = etag
 
+        retry_after = self._original_response.headers.get("Retry-After")
+        if retry_after is not None:
+            sanitized_headers["Retry-After"] = retry_after
+
+        vary = self._original_response.headers.get("Vary")
+        if vary is not None:
+            sanitized_headers["Vary"] = vary
+
         return sanitized_headers
 
     @property
@@ -79,9 +139,13 @@ class MirrorResponse:
         Retrieves the content from the original response and sanitizes
         them so we can impersonate the GitHub API.
 
-        :return: the sanitized content
-        :rtype: bytes
+        :return: the sanitized content, generated as it arrives from
+            upstream for the streamed responses
+        :rtype: bytes or generator
         """
+        if isinstance(getattr(self._original_response, "raw", None), StreamedBody):
+            return self._stream_content()
+
         if self._original_response.content is None:
             return None
 
@@ -89,6 +153,31 @@ class MirrorResponse:
             self._gh_api_url.encode(), self._gh_mirror_url.encode()
         )
 
+    def _stream_content(self):
+        """Sanitize the content one chunk at a time.
+
+        The end of each chunk that may be the start of an url spanning to
+        the next one is held back until that one arrives.
+        """
+        old, new = self._gh_api_url.encode(), self._gh_mirror_url.encode()
+        pending = b""
+        try:
+            for chunk in self._original_response.iter_content(STREAM_CHUNK_SIZE):
+                data = pending + chunk
+                cut = max(0, len(data) - len(old) + 1)
+                spanning = data.find(old, max(0, cut - len(old) + 1))
+                if 0 <= spanning < cut:
+                    cut = spanning
+                pending = data[cut:]
+                if cut:
+                    yield data[:cut].replace(old, new)
+            if pending:
+                yield pending.replace(old, new)
+        finally:
+            # Releases the connection, closing it when the client went away
+            # before the whole body was read
+            self._original_response.close()
+
     @property
     def status_code(self):
         """Convenience method to expose the original response HTTP status code.
@@ -96,3 +185,88 @@ class MirrorResponse:
         :return: the response status code
         """
         return self._original_response.status_code
+
+
+class MirrorCollectionResponse:
+    """Merges the responses for all the pages of a collection.
+
+    The elements of all the pages are served as a single JSON array. When
+    any of the responses is not a successful JSON array, the first such one
+    is served as is.
+
+    :param original_responses: the responses for all the pages, in order
+    :param gh_api_url: the GitHub API url (with the scheme)
+    :param gh_mirror_url: the GitHub Mirror url (with the scheme)
+
+    :type original_responses: list
+    :type gh_api_url: str
+    :type gh_mirror_url: str
+    """
+
+    def __init__(self, original_responses, gh_api_url, gh_mirror_url):
+        self._pages = [
+            MirrorResponse(response, gh_api_url, gh_mirror_url)
+            for response in original_responses
+        ]
+        self._failed = next(
+            (page for page in self._pages if not self._is_array(page)), None
+        )
+
+    @staticmethod
+    def _is_array(page):
+        content = (page.content or b"").strip()
+        return (
+            page.status_code == 200  # noqa: PLR2004
+            and content.startswith(b"[")
+            and content.endswith(b"]")
+        )
+
+    @property
+    def headers(self):
+        """Headers of the first page, without the ones specific to it.
+
+        :return: the sanitized headers
+        :rtype: dict
+        """
+        if self._failed is not None:
+            return self._failed.headers
+
+        headers = self._pages[0].headers
+        for header in ("Link", "ETag", "Last-Modified"):
+            headers.pop(header, None)
+        headers.setdefault("Content-Type", "application/json; charset=utf-8")
+
+        # One cache miss makes the whole collection a miss
+        x_cache = [page.headers.get("X-Cache") for page in self._pages]
+        misses = [item for item in x_cache if item and item.endswith("_MISS")]
+        if misses:
+            headers["X-Cache"] = misses[0]
+        return headers
+
+    @property
+    def content(self):
+        """Elements of all the pages, as a JSON array.
+
+        :return: the sanitized content, generated one page at a time so the
+            merged array is never built as a whole, the pages themselves
+            being held in memory
+        :rtype: bytes or generator
+        """
+        if self._failed is not None:
+            return self._failed.content
+        return self._merge_pages()
+
+    def _merge_pages(self):
+        yield b"["
+        separator = b""
+        for page in self._pages:
+            elements = page.content.strip()[1:-1].strip()
+            if elements:
+                yield separator + elements
+                separator = b","
+        yield b"]"
+
+    @property
+    def status_code(self):
+        """The HTTP status code of the first page, or of the failed one."""
+        return (self._failed or self._pages[0]).status_code
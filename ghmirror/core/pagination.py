@@ -0,0 +1,116 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Helpers to handle the GitHub API pagination"""
+
+import operator
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+    urlsplit,
+    urlunsplit,
+)
+
+
+def query_parameters(url):
+    """Get the query string parameters of an url as a dict"""
+    return dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+
+
+def replace_query_parameters(url, parameters):
+    """Return the url with the query string replaced by the given parameters"""
+    return urlunsplit(urlsplit(url)._replace(query=urlencode(parameters)))
+
+
+def canonical_url(url, defaults=None):
+    """Return the url with a canonical query string
+
+    Repeated parameters with the same value are deduplicated, the ones set
+    to their default value are dropped and the remaining ones are sorted by
+    name, so the urls of the same resource are equal. The values of a
+    parameter given several times keep their order, as it may matter.
+
+    :param defaults: the default values of some parameters, as a dict
+    """
+    defaults = defaults or {}
+    split = urlsplit(url)
+    parameters = dict.fromkeys(
+        (name, value)
+        for name, value in parse_qsl(split.query, keep_blank_values=True)
+        if defaults.get(name) != value
+    )
+    return urlunsplit(
+        split._replace(query=urlencode(sorted(parameters, key=operator.itemgetter(0))))
+    )
+
+
+def link_page(links, rel):
+    """Get the page number of a given relation from parsed 'Link' headers
+
+    :param links: the parsed links, as in requests.Response.links
+    :param rel: the link relation, e.g. "next" or "last"
+
+    :return: the page number, or None when the relation or the 'page'
+        parameter are not present
+    :rtype: int, optional
+    """
+    link = (links or {}).get(rel)
+    if link is None:
+        return None
+    page = query_parameters(link["url"]).get("page")
+    if page is None or not page.isdigit():
+        return None
+    return int(page)
+
+
+def is_page_based(links):
+    """Check whether the 'next' link, if any, paginates by page number
+
+    Some endpoints paginate with cursors (e.g. 'since' or 'after') instead.
+    """
+    link = (links or {}).get("next")
+    return link is None or "page" in query_parameters(link["url"])
+
+
+def build_link_header(url, page, last_page, has_next):
+    """Build a 'Link' header for a page of a collection
+
+    Follows the GitHub API conventions: 'prev' and 'first' are omitted on
+    the first page, 'next' and 'last' are omitted on the last page.
+
+    :param url: the url of the requested page
+    :param page: the requested page number
+    :param last_page: the last page number, when known
+    :param has_next: whether there is a page after the requested one
+
+    :return: the header value, or None when there are no links
+    :rtype: str, optional
+    """
+    parameters = query_parameters(url)
+
+    def _link(target, rel):
+        target_url = replace_query_parameters(url, {**parameters, "page": target})
+        return f'<{target_url}>; rel="{rel}"'
+
+    links = []
+    if page > 1:
+        links.append(_link(page - 1, "prev"))
+    if has_next:
+        links.append(_link(page + 1, "next"))
+        if last_page is not None:
+            links.append(_link(last_page, "last"))
+    if page > 1:
+        links.append(_link(1, "first"))
+
+    return ", ".join(links) or None
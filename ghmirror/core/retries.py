@@ -0,0 +1,84 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Decides on the extra requests, retries and hedges, sent upstream"""
+
+import threading
+import time
+from collections import deque
+
+
+class RetryBudget:
+    """Caps the extra requests sent upstream, retries and hedges alike.
+
+    Within the latest window seconds, at most min_extra requests plus ratio
+    times the requests sent are allowed as extra requests, so an upstream
+    in trouble is not flooded with them.
+
+    :param ratio: extra requests allowed per request sent
+    :param min_extra: extra requests allowed regardless of the requests sent
+    :param window: seconds the requests are accounted for
+    """
+
+    def __init__(self, ratio, min_extra, window):
+        self.ratio = ratio
+        self.min_extra = min_extra
+        self.window = window
+        self._lock = threading.Lock()
+        self._requests = deque()
+        self._extra = deque()
+
+    def deposit(self):
+        """Account for a request sent"""
+        with self._lock:
+            self._requests.append(time.monotonic())
+
+    def withdraw(self):
+        """Check whether an extra request can be sent, accounting for it"""
+        with self._lock:
+            now = time.monotonic()
+            for sent in (self._requests, self._extra):
+                while sent and sent[0] <= now - self.window:
+                    sent.popleft()
+            if len(self._extra) >= self.min_extra + self.ratio * len(self._requests):
+                return False
+            self._extra.append(now)
+            return True
+
+
+class Latencies:
+    """Keeps the latest size latencies, to compute their quantiles
+
+    :param size: number of latencies kept
+    :param min_samples: latencies needed to compute a quantile
+    """
+
+    def __init__(self, size, min_samples):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=size)
+
+    def add(self, seconds):
+        """Record a latency, in seconds"""
+        self._latencies.append(seconds)
+
+    def quantile(self, fraction):
+        """Get the latency below which fraction of the latest ones are
+
+        :return: the latency in seconds, or None with too few samples
+        :rtype: float, optional
+        """
+        latencies = sorted(self._latencies)
+        if not latencies or len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
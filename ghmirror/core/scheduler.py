@@ -0,0 +1,214 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Schedules the requests sent upstream"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import requests
+
+_BACKGROUND = threading.local()
+_DEADLINE = threading.local()
+
+
+class UpstreamBusyError(requests.exceptions.RequestException):
+    """The request could not be sent upstream in time"""
+
+
+class DeadlineExceededError(requests.exceptions.Timeout):
+    """The request could not be answered upstream before its deadline"""
+
+
+def mark_background():
+    """Mark the requests sent from the current thread as background ones"""
+    _BACKGROUND.active = True
+
+
+def is_background():
+    """Check whether the current thread sends background requests"""
+    return getattr(_BACKGROUND, "active", False)
+
+
+@contextmanager
+def deadline(seconds):
+    """Context manager setting a deadline for the requests of the current thread
+
+    :param seconds: seconds from now, or None for no deadline
+    """
+    previous = getattr(_DEADLINE, "at", None)
+    _DEADLINE.at = None if seconds is None else time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        _DEADLINE.at = previous
+
+
+def time_left():
+    """Get the seconds left until the deadline of the current thread, or None"""
+    at = getattr(_DEADLINE, "at", None)
+    return None if at is None else at - time.monotonic()
+
+
+class UpstreamScheduler:
+    """Caps the requests in flight upstream for each token.
+
+    Requests beyond the cap wait in a queue per token, the client ones
+    before the background ones and then in arrival order, so tokens never
+    wait for each other. Requests that can not be queued, because the token
+    queue is full, or that wait for longer than the timeout, or than their
+    deadline, are not sent.
+
+    Client requests waiting hold a server thread each, so, with the number
+    of server threads given, a token can not hold more than half of them,
+    waiting or in flight, and the client requests of all the tokens can not
+    keep more than half of them waiting. A busy token thus always leaves
+    threads for the others.
+
+    :param concurrency: requests in flight per token, 0 for no cap
+    :param queue_size: requests waiting per token
+    :param timeout: seconds a request waits for at most
+    :param threads: server threads handling the client requests, 0 for
+        not bounding the ones waiting
+    """
+
+    def __init__(self, concurrency, queue_size, timeout, threads=0):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.threads = threads
+        self._condition = threading.Condition()
+        self._in_flight = Counter()
+        self._waiting = {}
+        self._tickets = itertools.count()
+
+    @contextmanager
+    def slot(self, auth_sha):
+        """Context manager holding one of the token slots
+
+        :raises UpstreamBusyError: when no slot was available in time
+        :raises DeadlineExceededError: when none was before the deadline
+        """
+        if not self.concurrency:
+            yield
+            return
+
+        self._acquire(auth_sha)
+        try:
+            yield
+        finally:
+            self._release(auth_sha)
+
+    def _acquire(self, auth_sha):
+        ticket = (is_background(), next(self._tickets))
+        left = time_left()
+        timeout = self.timeout if left is None else min(self.timeout, left)
+        give_up = time.monotonic() + timeout
+        with self._condition:
+            waiting = self._waiting.setdefault(auth_sha, [])
+            if self._in_flight[auth_sha] >= self.concurrency and (
+                len(waiting) >= self.queue_size
+                or (not ticket[0] and self._is_crowded(auth_sha))
+            ):
+                self._forget(auth_sha)
+                raise UpstreamBusyError("Too many requests queued for the token")
+
+            heapq.heappush(waiting, ticket)
+            while self._in_flight[auth_sha] >= self.concurrency or waiting[0] != ticket:
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    waiting.remove(ticket)
+                    heapq.heapify(waiting)
+                    self._forget(auth_sha)
+                    # The next ticket may be the head of the queue now
+                    self._condition.notify_all()
+                    if timeout < self.timeout:
+                        raise DeadlineExceededError(
+                            "Deadline reached waiting for a slot"
+                        )
+                    raise UpstreamBusyError("Timed out waiting for a token slot")
+                self._condition.wait(remaining)
+
+            heapq.heappop(waiting)
+            self._in_flight[auth_sha] += 1
+            self._forget(auth_sha)
+            # The next ticket may have a slot too
+            self._condition.notify_all()
+
+    def _release(self, auth_sha):
+        with self._condition:
+            self._in_flight[auth_sha] -= 1
+            self._forget(auth_sha)
+            self._condition.notify_all()
+
+    def _is_crowded(self, auth_sha):
+        """Check whether another client request waiting would hold too many threads"""
+        if not self.threads:
+            return False
+        share = self.threads // 2
+        client_waiting = {
+            token: sum(1 for background, _ in waiting if not background)
+            for token, waiting in self._waiting.items()
+        }
+        return (
+            self._in_flight[auth_sha] + client_waiting[auth_sha] >= share
+            or sum(client_waiting.values()) >= share
+        )
+
+    def _forget(self, auth_sha):
+        """Drop the state of tokens with nothing in flight nor waiting"""
+        if not self._waiting.get(auth_sha):
+            self._waiting.pop(auth_sha, None)
+            if not self._in_flight[auth_sha]:
+                del self._in_flight[auth_sha]
+
+
+class SingleFlight:
+    """Runs a call once for all the threads asking for it at the same time.
+
+    The first thread asking for a key runs the call, and the ones asking for
+    it while it is in flight wait for it, sharing its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function):
+        """Call function, unless a call for key is already in flight
+
+        :return: the result of the call in flight for key
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+
+        if not leader:
+            return flight.result()
+
+        try:
+            flight.set_result(function())
+        except Exception as error:  # noqa: BLE001
+            flight.set_exception(error)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return flight.result()
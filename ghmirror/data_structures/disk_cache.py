@@ -0,0 +1,151 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2020
+# Author: Amador Pahim <apahim@redhat.com>
+
+"""Caching large downloads on disk."""
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+# Temporary files not written for that long, in seconds, are left over by
+# a process that stopped while writing them
+STALE_TEMP_AGE = 3600
+
+
+class DiskCache:
+    """Keeps downloads in files, evicting the least recently used ones.
+
+    Each download is stored in a file named after the hash of its key,
+    along with a JSON file holding its headers. Files are written under a
+    temporary name and renamed once complete, so a download being written
+    is never served. Downloads found in the directory on start are kept,
+    the least recently modified being evicted first, and stale temporary
+    files are removed.
+
+    :param directory: the directory holding the files
+    :param max_size: bytes the downloads take at most
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._sizes = OrderedDict()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            name = entry.name
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if len(name) == 64 and "." not in name:  # noqa: PLR2004
+                entries.append((stat.st_mtime, name, stat.st_size))
+            elif name.startswith("tmp") and stat.st_mtime < (
+                time.time() - STALE_TEMP_AGE
+            ):
+                with contextlib.suppress(FileNotFoundError):
+                    Path(entry.path).unlink()
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+            self.size += size
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def open(self, key):
+        """Open a download, marking it as the most recently used
+
+        :return: the open file and the headers of the download, or None
+        :rtype: tuple, optional
+        """
+        name = self._name(key)
+        with self._lock:
+            if name not in self._sizes:
+                return None
+            try:
+                headers = json.loads(self._path(name, ".json").read_text("utf-8"))
+                file = self._path(name).open("rb")
+            except (OSError, ValueError):
+                self._remove(name)
+                return None
+            self._sizes.move_to_end(name)
+            self._path(name).touch()
+            return file, headers
+
+    def store(self, key, chunks, headers):
+        """Write a download as it is read, evicting the least recently used ones
+
+        The chunks are yielded as they are written, so the download is sent
+        while it is stored. It is only stored once read in full, and the
+        downloads larger than max_size are sent without being stored.
+
+        :param chunks: iterable with the bytes of the download, closed when
+            the download is not read in full
+        :param headers: dict with the headers of the download
+        :return: the bytes of the download
+        :rtype: generator
+        """
+        name = self._name(key)
+        temp = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)  # noqa: SIM115
+        temp_path = Path(temp.name)
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_size and not temp.closed:
+                    temp.close()
+                    temp_path.unlink()
+                if not temp.closed:
+                    temp.write(chunk)
+                yield chunk
+        except BaseException:
+            temp.close()
+            temp_path.unlink(missing_ok=True)
+            if hasattr(chunks, "close"):
+                chunks.close()
+            raise
+        if temp.closed:
+            return
+
+        temp.close()
+        temp_headers = temp_path.with_suffix(".json")
+        temp_headers.write_text(json.dumps(headers), "utf-8")
+        with self._lock:
+            temp_headers.replace(self._path(name, ".json"))
+            temp_path.replace(self._path(name))
+            self.size += size - self._sizes.pop(name, 0)
+            self._sizes[name] = size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._sizes)))
+
+    def _remove(self, name):
+        """Drop a download, the files already open being still readable"""
+        self.size -= self._sizes.pop(name, 0)
+        for suffix in ("", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                self._path(name, suffix).unlink()
+
+    def _path(self, name, suffix=""):
+        return self.directory / f"{name}{suffix}"
+
+    @staticmethod
+    def _name(key):
+        return hashlib.sha256(key.encode()).hexdigest()
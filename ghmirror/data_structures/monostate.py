@@ -16,6 +16,7 @@
 
 import hashlib
 import logging
+import math
 import os
 import pickle
 import sys
@@ -34,13 +35,30 @@ from prometheus_client.utils import INF
 from requests.adapters import HTTPAdapter
 
 from ghmirror.core.constants import (
+    COLLECTIONS_CACHE_SIZE,
     GH_STATUS_API,
+    NEGATIVES_CACHE_SIZE,
+    PREFETCHES_CACHE_SIZE,
     STATUS_MAX_RETRIES,
     STATUS_SLEEP_TIME,
     STATUS_TIMEOUT,
+    VALIDATIONS_CACHE_SIZE,
+    WEBHOOKS_CACHE_SIZE,
 )
 
-__all__ = ["GithubStatus", "InMemoryCache", "StatsCache", "UsersCache"]
+__all__ = [
+    "BoundedCache",
+    "CollectionsCache",
+    "GithubStatus",
+    "InMemoryCache",
+    "LockedState",
+    "NegativesCache",
+    "PrefetchesCache",
+    "StatsCache",
+    "UsersCache",
+    "ValidationsCache",
+    "WebhooksCache",
+]
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
@@ -49,12 +67,19 @@ LOG = logging.getLogger(__name__)
 
 
 class _GithubStatus:
+    """Checks the GitHub status page, every sleep_time seconds, if set.
+
+    It is a secondary signal, the upstream API being considered offline
+    mainly when the requests sent to it fail.
+    """
+
     def __init__(self, sleep_time, timeout, session):
         self.sleep_time = sleep_time
         self.timeout = timeout
         self.session = session
         self.online = True
-        self._start_check()
+        if self.sleep_time:
+            self._start_check()
 
     def _start_check(self):
         """Starting a daemon thread to check the GitHub API status.
@@ -125,6 +150,30 @@ class GithubStatus:
         return cls._instance
 
 
+class LockedState:
+    """Shared state made of dicts, created on first use, and of a lock.
+
+    The '_lock' attribute is a threading.Lock, any other one a dict.
+    """
+
+    _init_lock = threading.Lock()
+
+    def __getattr__(self, item):
+        """Safe class argument initialization.
+
+        We do it here (instead of in the __init__()) so we don't overwrite
+        them when a new instance is created. It is done under a lock, so
+        threads using them first all get the same ones.
+        """
+        with self._init_lock:
+            if item not in self.__dict__:
+                if item == "_lock":
+                    setattr(self, item, threading.Lock())
+                else:
+                    setattr(self, item, {})
+        return self.__dict__[item]
+
+
 class InMemoryCacheBorg:
     """Monostate class for sharing the in-memory requests cache."""
 
@@ -134,17 +183,13 @@ class InMemoryCacheBorg:
         self.__dict__ = self._state
 
 
-class InMemoryCache(InMemoryCacheBorg):
-    """Dictionary-like implementation for caching requests."""
+class InMemoryCache(InMemoryCacheBorg, LockedState):
+    """Dictionary-like implementation for caching requests.
 
-    def __getattr__(self, item):
-        """Safe class argument initialization.
-
-        We do it here (instead of in the __init__()) so we don't overwrite
-        them on when a new instance is created.
-        """
-        setattr(self, item, {})
-        return getattr(self, item)
+    The bodies of the responses are stored once, addressed by the hash of
+    their content, and shared by all the responses with the same content.
+    They are reference counted, being dropped along with their last response.
+    """
 
     def __contains__(self, item):
         return item in self._data
@@ -152,11 +197,48 @@ class InMemoryCache(InMemoryCacheBorg):
     def __getitem__(self, item):
         return self._data[item]["data"]
 
+    def get(self, key):
+        """Get the response cached under key, or None"""
+        entry = self._data.get(key)
+        return None if entry is None else entry["data"]
+
     def __setitem__(self, key, value):
-        """Set the key-value pair as well as their total size"""
+        """Set the key-value pair as well as their total size
+
+        The body is left out of the size, being accounted for once.
+        """
+        content = value.content or b""
+        digest = hashlib.sha256(content).digest()
         key_size = sys.getsizeof(pickle.dumps(key))
-        value_size = sys.getsizeof(pickle.dumps(value))
-        self._data[key] = {"data": value, "size": key_size + value_size}
+        value_size = sys.getsizeof(pickle.dumps(value)) - len(content)
+        with self._lock:
+            body = self._bodies.setdefault(digest, {"content": content, "refs": 0})
+            body["refs"] += 1
+            value._content = body["content"]  # noqa: SLF001
+            self._pop(key)
+            self._data[key] = {
+                "data": value,
+                "size": key_size + value_size,
+                "digest": digest,
+            }
+
+    def __delitem__(self, key):
+        """Drop the key, if present, and its body if no longer used"""
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        """Drop the key, if present, and its body if no longer used
+
+        The lock must be held, as the references to the bodies are counted.
+        """
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        body = self._bodies[entry["digest"]]
+        body["refs"] -= 1
+        if not body["refs"]:
+            del self._bodies[entry["digest"]]
 
     def __iter__(self):
         return iter(self._data)
@@ -166,11 +248,43 @@ class InMemoryCache(InMemoryCacheBorg):
 
     def __sizeof__(self):
         """Calculate the size of the dictionary and all its contents"""
-        total_cache_size = sys.getsizeof(self._data)
-        for value in self._data.values():
-            total_cache_size += value["size"]
+        with self._lock:
+            total_cache_size = sys.getsizeof(self._data)
+            for value in self._data.values():
+                total_cache_size += value["size"]
+            for body in self._bodies.values():
+                total_cache_size += sys.getsizeof(body["content"])
         return total_cache_size
 
+    def dedup_ratio(self):
+        """Get the bytes of the cached bodies per byte actually stored"""
+        with self._lock:
+            bodies = list(self._bodies.values())
+        stored = sum(len(body["content"]) for body in bodies)
+        if not stored:
+            return 1.0
+        cached = sum(len(body["content"]) * body["refs"] for body in bodies)
+        return cached / stored
+
+    def index(self, key, names):
+        """Add the key to each of the named indexes"""
+        with self._lock:
+            for name in names:
+                self._index.setdefault(name, set()).add(key)
+
+    def deindex(self, key, names):
+        """Remove the key from each of the named indexes"""
+        with self._lock:
+            for name in names:
+                keys = self._index.get(name, set())
+                keys.discard(key)
+                if not keys:
+                    self._index.pop(name, None)
+
+    def indexed(self, name):
+        """Get the keys added to the named index"""
+        return set(self._index.get(name, ()))
+
 
 class UsersCacheBorg:
     """Monostate class for sharing the users cache."""
@@ -182,7 +296,12 @@ class UsersCacheBorg:
 
 
 class UsersCache(UsersCacheBorg):
-    """Dict-like implementation for caching users information."""
+    """Dict-like implementation for caching users information.
+
+    Entries expire max_age seconds after they were added. Expired entries
+    are kept, along with when they were last used, so the tokens in use can
+    be validated again in the background.
+    """
 
     def __getattr__(self, item):
         """Safe class argument initialization.
@@ -198,15 +317,221 @@ class UsersCache(UsersCacheBorg):
         return hashlib.sha1(key.encode()).hexdigest()
 
     def __contains__(self, item):
-        return self._sha(item) in self._data
+        """Check whether item has an entry not expired, recording its use"""
+        entry = self._data.get(self._sha(item))
+        now = time.monotonic()
+        if entry is None or entry["expires"] <= now:
+            return False
+        entry["used"] = now
+        return True
+
+    def add(self, key, value=None, max_age=math.inf):
+        """Adding the value to the backing dict, for max_age seconds"""
+        now = time.monotonic()
+        self._data[self._sha(key)] = {
+            "key": key,
+            "value": value,
+            "expires": now + max_age,
+            "used": now,
+        }
+
+    def discard(self, key):
+        """Drop the entry of key, if any"""
+        self._data.pop(self._sha(key), None)
+
+    def get(self, key):
+        """Getting the value from the backing dict, even if expired"""
+        return self.get_by_sha(self._sha(key))
+
+    def get_by_sha(self, sha):
+        """Getting the value from the backing dict, by the key sha"""
+        return self._data.get(sha, {}).get("value")
+
+    def used_since(self, since):
+        """Get the keys used since a given time, from time.monotonic()"""
+        return [
+            entry["key"]
+            for entry in list(self._data.values())
+            if entry["used"] >= since
+        ]
+
+
+class BoundedCache(LockedState):
+    """Dict-like cache kept in memory, per process, and bounded in size.
+
+    Only the most recently stored MAX_SIZE keys are kept, the oldest ones
+    being dropped first. Subclasses set MAX_SIZE, and share their state
+    through a Borg.
+    """
+
+    def __contains__(self, item):
+        return item in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def discard(self, key):
+        """Drop the value stored under key, if any"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop all the values"""
+        with self._lock:
+            self._data.clear()
+
+    def _store(self, key, value):
+        """Store the value under key, as the most recent one"""
+        with self._lock:
+            # Re-inserting keeps the dict ordered by storage time,
+            # so the oldest entries are the first ones to be dropped
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.MAX_SIZE:
+                del self._data[next(iter(self._data))]
+
 
-    def add(self, key, value=None):
-        """Adding the value to the backing dict"""
-        self._data[self._sha(key)] = value
+class ValidationsCacheBorg:
+    """Monostate class for sharing the validations cache."""
+
+    _state = {}
+
+    def __init__(self):
+        self.__dict__ = self._state
+
+
+class ValidationsCache(ValidationsCacheBorg, BoundedCache):
+    """Keeps track of when the cached responses were last validated upstream.
+
+    It is bounded to the most recently validated VALIDATIONS_CACHE_SIZE keys.
+    """
+
+    MAX_SIZE = VALIDATIONS_CACHE_SIZE
+
+    def mark(self, key):
+        """Record that the response cached under key was just validated"""
+        self._store(key, time.monotonic())
+
+    def is_fresh(self, key, max_age):
+        """Check whether key was validated less than max_age seconds ago"""
+        validated = self._data.get(key)
+        return validated is not None and time.monotonic() - validated < max_age
+
+
+class PrefetchesCacheBorg:
+    """Monostate class for sharing the prefetches cache."""
+
+    _state = {}
+
+    def __init__(self):
+        self.__dict__ = self._state
+
+
+class PrefetchesCache(PrefetchesCacheBorg, BoundedCache):
+    """Keeps track of the responses cached ahead of the client requests.
+
+    It is bounded to the most recently prefetched PREFETCHES_CACHE_SIZE keys.
+    """
+
+    MAX_SIZE = PREFETCHES_CACHE_SIZE
+
+    def add(self, key):
+        """Record that the response cached under key was just prefetched"""
+        self._store(key, time.monotonic())
+
+    def is_fresh(self, key, max_age):
+        """Check whether key was prefetched less than max_age seconds ago"""
+        prefetched = self._data.get(key)
+        return prefetched is not None and time.monotonic() - prefetched < max_age
+
+    def pop(self, key, max_age):
+        """Forget key, checking whether it was prefetched less than max_age ago"""
+        with self._lock:
+            prefetched = self._data.pop(key, None)
+        return prefetched is not None and time.monotonic() - prefetched < max_age
+
+
+class CollectionsCacheBorg:
+    """Monostate class for sharing the collections cache."""
+
+    _state = {}
+
+    def __init__(self):
+        self.__dict__ = self._state
+
+
+class CollectionsCache(CollectionsCacheBorg, BoundedCache):
+    """Keeps whole collections, merged from their pages and deltas.
+
+    It is bounded to the most recently stored COLLECTIONS_CACHE_SIZE
+    collections.
+    """
+
+    MAX_SIZE = COLLECTIONS_CACHE_SIZE
 
     def get(self, key):
-        """Getting the value from the backing dict"""
-        return self._data.get(self._sha(key))
+        """Get the collection stored under key, or None"""
+        return self._data.get(key)
+
+    def set(self, key, collection):
+        """Store the collection under key, replacing the previous one"""
+        self._store(key, collection)
+
+
+class WebhooksCacheBorg:
+    """Monostate class for sharing the webhooks cache."""
+
+    _state = {}
+
+    def __init__(self):
+        self.__dict__ = self._state
+
+
+class WebhooksCache(WebhooksCacheBorg, BoundedCache):
+    """Keeps track of the repositories and organizations notifying changes.
+
+    Those are the ones whose webhook deliveries were received, or whose
+    events were polled recently. It is bounded to the most recently notified
+    WEBHOOKS_CACHE_SIZE of them.
+    """
+
+    MAX_SIZE = WEBHOOKS_CACHE_SIZE
+
+    def __contains__(self, item):
+        return self._data.get(item, 0) > time.monotonic()
+
+    def add(self, key, max_age=math.inf):
+        """Record that key notifies its changes, for max_age seconds"""
+        self._store(key, time.monotonic() + max_age)
+
+
+class NegativesCacheBorg:
+    """Monostate class for sharing the negatives cache."""
+
+    _state = {}
+
+    def __init__(self):
+        self.__dict__ = self._state
+
+
+class NegativesCache(NegativesCacheBorg, BoundedCache):
+    """Keeps failures, like not found responses, for a short time.
+
+    It is bounded to the most recently stored NEGATIVES_CACHE_SIZE failures.
+    """
+
+    MAX_SIZE = NEGATIVES_CACHE_SIZE
+
+    def get(self, key):
+        """Get the failure stored under key, or None once it expired"""
+        value, expiration = self._data.get(key, (None, 0))
+        if expiration <= time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, max_age):
+        """Store the failure under key, for max_age seconds"""
+        self._store(key, (value, time.monotonic() + max_age))
 
 
 class StatsCacheBorg:
@@ -221,7 +546,7 @@ class StatsCacheBorg:
 class StatsCache(StatsCacheBorg):
     """Statistics cacher."""
 
-    def __getattr__(self, item):
+    def __getattr__(self, item):  # noqa: C901
         """Safe class argument initialization.
 
         We do it here (instead of in the __init__()) so we don't overwrite
@@ -290,6 +615,17 @@ class StatsCache(StatsCacheBorg):
                 ),
             )
 
+        elif item == "gauge_dedup_ratio":
+            setattr(
+                self,
+                item,
+                Gauge(
+                    name="github_mirror_cache_dedup_ratio",
+                    documentation="bytes of the cached bodies per byte stored",
+                    registry=self.registry,
+                ),
+            )
+
         elif item == "gauge_cached_objects":
             setattr(
                 self,
@@ -301,6 +637,63 @@ class StatsCache(StatsCacheBorg):
                 ),
             )
 
+        elif item == "counter_prefetch":
+            setattr(
+                self,
+                item,
+                Counter(
+                    name="github_mirror_prefetch",
+                    labelnames=("result",),
+                    documentation="next pages prefetched, by result",
+                    registry=self.registry,
+                ),
+            )
+
+        elif item == "counter_extra":
+            setattr(
+                self,
+                item,
+                Counter(
+                    name="github_mirror_extra_requests",
+                    labelnames=("kind", "result"),
+                    documentation="GETs hedged or retried upstream, by result",
+                    registry=self.registry,
+                ),
+            )
+
+        elif item == "histogram_pool_wait":
+            setattr(
+                self,
+                item,
+                Histogram(
+                    name="github_mirror_pool_wait_seconds",
+                    labelnames=("connection",),
+                    documentation="time waited for an upstream connection, "
+                    "by whether it was reused or new",
+                    registry=self.registry,
+                    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, INF),
+                ),
+            )
+
+        elif item == "counter_cooldown":
+            setattr(
+                self,
+                item,
+                Counter(
+                    name="github_mirror_cooldown_seconds",
+                    labelnames=("user",),
+                    documentation="seconds the requests upstream were held back for",
+                    registry=self.registry,
+                ),
+            )
+
+        elif item in {"cooldowns", "quotas"}:
+            # Time until which each token should not be used upstream, and
+            # latest rate limit information seen for each token, as
+            # (remaining, limit, reset) tuples, indexed by the token sha and
+            # the rate limit resource
+            setattr(self, item, {})
+
         else:
             raise AttributeError(f"object has no attribute {item}'")
 
@@ -323,3 +716,80 @@ class StatsCache(StatsCacheBorg):
     def set_cached_objects(self, value):
         """Convenience method to set the Gauge."""
         self.gauge_cached_objects.set(value)
+
+    def set_dedup_ratio(self, value):
+        """Convenience method to set the Gauge."""
+        self.gauge_dedup_ratio.set(value)
+
+    def count_prefetch(self, result):
+        """Convenience method to increment the prefetch counter."""
+        self.counter_prefetch.labels(result=result).inc(1)
+
+    def observe_pool_wait(self, value, reused):
+        """Convenience method to populate the pool wait histogram."""
+        self.histogram_pool_wait.labels(
+            connection="reused" if reused else "new"
+        ).observe(value)
+
+    def count_hedge(self, result):
+        """Convenience method to increment the hedge counter."""
+        self.counter_extra.labels(kind="hedge", result=result).inc(1)
+
+    def count_retry(self, result):
+        """Convenience method to increment the retry counter."""
+        self.counter_extra.labels(kind="retry", result=result).inc(1)
+
+    def set_quota(self, auth_sha, headers):
+        """Record the rate limit information from upstream response headers.
+
+        It is recorded for the rate limit resource of the response, 'core'
+        when not told.
+        """
+        remaining = headers.get("X-RateLimit-Remaining")
+        limit = headers.get("X-RateLimit-Limit")
+        reset = headers.get("X-RateLimit-Reset")
+        resource = headers.get("X-RateLimit-Resource", "core")
+        if remaining is not None and reset is not None:
+            self.quotas[auth_sha, resource] = (
+                int(remaining),
+                None if limit is None else int(limit),
+                int(reset),
+            )
+
+    def get_quota(self, auth_sha, resource="core"):
+        """Get the remaining requests for a token, or None if unknown.
+
+        Once the reset time is reached, the quota is no longer known.
+        """
+        remaining, _, reset = self.quotas.get((auth_sha, resource), (None, None, 0))
+        if reset <= time.time():
+            return None
+        return remaining
+
+    def get_quota_shortage(self, auth_sha, reserve, resource="core"):
+        """Get the seconds left until the quota reset of a token, or 0
+
+        Only while the remaining requests of the token are below the
+        reserve, a fraction of its limit.
+        """
+        remaining, limit, reset = self.quotas.get((auth_sha, resource), (None, None, 0))
+        if limit is None or remaining >= reserve * limit:
+            return 0
+        return max(0, reset - time.time())
+
+    def set_cooldown(self, auth_sha, until, user=None, resource="core"):
+        """Hold back the requests upstream for a token until a given time.
+
+        Cooldowns are only ever extended, and the time they are extended
+        by is counted for the token user. They only apply to the requests
+        counting against the same rate limit resource, like 'core' or
+        'search'.
+        """
+        current = max(self.cooldowns.get((auth_sha, resource), 0), time.time())
+        if until > current:
+            self.counter_cooldown.labels(user=user).inc(until - current)
+            self.cooldowns[auth_sha, resource] = until
+
+    def get_cooldown(self, auth_sha, resource="core"):
+        """Get the seconds left in the cooldown of a token, or 0"""
+        return max(0, self.cooldowns.get((auth_sha, resource), 0) - time.time())
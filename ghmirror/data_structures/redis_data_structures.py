@@ -15,7 +15,10 @@
 """Caching data in Redis."""
 
 import base64
+import hashlib
 import json
+import logging
+import math
 import os
 from random import randint
 
@@ -29,42 +32,235 @@ READER_ENDPOINT = os.environ.get("READER_ENDPOINT", PRIMARY_ENDPOINT)
 REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 REDIS_TOKEN = os.environ.get("REDIS_TOKEN")
 REDIS_SSL = os.environ.get("REDIS_SSL")
+MAX_EXPIRATION_HOURS = 4320
+INDEX_EXPIRATION = 3600 * MAX_EXPIRATION_HOURS
+DEDUP_RATIO_KEY = b"stats:dedup_ratio"
+CACHED_OBJECTS_KEY = b"stats:cached_objects"
+# Keys read at once, in a single round trip, when going through all of them
+BATCH_SIZE = 1000
+# Drops a body unless it was written since the given remaining time to live,
+# atomically, so a write pointing at it again in between is never lost
+DROP_BODY_SCRIPT = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl ~= -2 and ttl <= tonumber(ARGV[1]) then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+def _batched(iterable, size=BATCH_SIZE):
+    """Split an iterable in lists of up to size items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _get_connection(host):
+    parameters = {"host": host, "port": REDIS_PORT}
+    if REDIS_TOKEN is not None:
+        parameters["password"] = REDIS_TOKEN
+    if REDIS_SSL is not None and REDIS_SSL.lower() == "true":
+        parameters["ssl"] = True
+    return redis.Redis(**parameters)
 
 
 class RedisCache:
-    """Dictionary-like implementation for caching requests in Redis."""
+    """Dictionary-like implementation for caching requests in Redis.
+
+    The bodies of the responses are stored once, addressed by the hash of
+    their content, the cached responses pointing at them. Each write gives
+    the body the longest expiration of the responses, so it outlives all
+    the ones pointing at it, and collect_bodies drops the bodies no longer
+    pointed at before that.
+    """
 
     def __init__(self):
-        self.wr_cache = self._get_connection(PRIMARY_ENDPOINT)
-        self.ro_cache = self._get_connection(READER_ENDPOINT)
+        self.wr_cache = _get_connection(PRIMARY_ENDPOINT)
+        self.ro_cache = _get_connection(READER_ENDPOINT)
 
     def __contains__(self, item):
+        """Check whether a response is cached under item, along with its body
+
+        Responses whose body is gone, evicted by Redis, are dropped.
+        """
         sr_key = self._serialize_key(item)
-        return self.ro_cache.exists(sr_key)
+        sr_value = self.ro_cache.get(sr_key)
+        if sr_value is None:
+            return False
+        digest = json.loads(sr_value).get("body")
+        if digest is None or self.ro_cache.exists(self._serialize_body_key(digest)):
+            return True
+        self.wr_cache.delete(sr_key)
+        return False
 
     def __getitem__(self, item):
         sr_key = self._serialize_key(item)
         sr_value = self.ro_cache.get(sr_key)
         if sr_value is None:
             raise KeyError(item)
-        return self._deserialize_response(sr_value)
+        payload = json.loads(sr_value)
+        if "body" not in payload:
+            # Entry written by a previous version, holding its body
+            content = base64.b64decode(payload["content"])
+        else:
+            content = self.ro_cache.get(self._serialize_body_key(payload["body"]))
+            if content is None:
+                # Evicted by Redis, the response is dropped along with it
+                self.wr_cache.delete(sr_key)
+                raise KeyError(item)
+        return self._deserialize_response(payload, content)
+
+    def get(self, key):
+        """Get the response cached under key, or None"""
+        try:
+            return self[key]
+        except KeyError:
+            return None
 
     def __setitem__(self, key, value):
         sr_key = self._serialize_key(key)
-        sr_value = self._serialize_response(value)
+        content = value.content or b""
+        digest = hashlib.sha256(content).hexdigest()
+        sr_value = self._serialize_response(value, digest)
         # randomize cache expiration time (1 hr increments) from 1 hr to 6 mon
-        rand_val = randint(1, 4320)
-        self.wr_cache.set(sr_key, sr_value, ex=3600 * rand_val)
+        rand_val = randint(1, MAX_EXPIRATION_HOURS)
+        pipeline = self.wr_cache.pipeline()
+        pipeline.set(self._serialize_body_key(digest), content, ex=INDEX_EXPIRATION)
+        pipeline.set(sr_key, sr_value, ex=3600 * rand_val)
+        pipeline.execute()
+
+    def __delitem__(self, key):
+        """Drop the key, if present"""
+        self.wr_cache.delete(self._serialize_key(key))
 
     def __iter__(self):
         return self._scan_iter()
 
     def __len__(self):
-        return self.ro_cache.dbsize()
+        """Get the number of cached responses
+
+        It is counted by the latest collect_bodies run, as Redis also holds
+        the bodies and the indexes. Before any, all the keys are counted.
+        """
+        value = self.ro_cache.get(CACHED_OBJECTS_KEY)
+        return self.ro_cache.dbsize() if value is None else int(value)
 
     def __sizeof__(self):
         return self.ro_cache.info()["used_memory"]
 
+    def dedup_ratio(self):
+        """Get the bytes of the cached bodies per byte actually stored
+
+        It is computed by the latest collect_bodies run.
+        """
+        value = self.ro_cache.get(DEDUP_RATIO_KEY)
+        return 1.0 if value is None else float(value)
+
+    def collect_bodies(self, grace):
+        """Drop the bodies no cached response points at anymore
+
+        Bodies written less than grace seconds ago are kept, as the
+        responses pointing at them may not be written yet. The cached
+        responses are counted along the way.
+
+        :return: the number of bodies dropped
+        :rtype: int
+        """
+        refs = {}
+        for keys in _batched(self._serialize_key(key) for key in self):
+            pipeline = self.ro_cache.pipeline()
+            for sr_key in keys:
+                pipeline.get(sr_key)
+            for sr_value in pipeline.execute():
+                if sr_value is not None:
+                    digest = json.loads(sr_value).get("body")
+                    refs[digest] = refs.get(digest, 0) + 1
+
+        dropped = 0
+        cached = stored = 0
+        for sr_body_keys in _batched(self._scan_bodies()):
+            pipeline = self.ro_cache.pipeline()
+            for sr_body_key in sr_body_keys:
+                pipeline.strlen(sr_body_key)
+                pipeline.ttl(sr_body_key)
+            results = pipeline.execute()
+            for sr_body_key, size, ttl in zip(
+                sr_body_keys, results[::2], results[1::2], strict=True
+            ):
+                digest = sr_body_key.removeprefix(b"body:").decode()
+                if digest in refs:
+                    cached += refs[digest] * size
+                    stored += size
+                elif ttl <= INDEX_EXPIRATION - grace:
+                    # Checked again along with the deletion, as a response
+                    # may have been written pointing at it meanwhile
+                    dropped += self.wr_cache.eval(
+                        DROP_BODY_SCRIPT, 1, sr_body_key, INDEX_EXPIRATION - grace
+                    )
+        pipeline = self.wr_cache.pipeline()
+        pipeline.set(DEDUP_RATIO_KEY, cached / stored if stored else 1.0)
+        pipeline.set(CACHED_OBJECTS_KEY, sum(refs.values()))
+        pipeline.execute()
+        return dropped
+
+    def rename(self, key, new_key):
+        """Move the entry at key to new_key, keeping its expiration
+
+        When new_key is already taken, the entry at key is dropped instead.
+        """
+        sr_key = self._serialize_key(key)
+        if not self.wr_cache.renamenx(sr_key, self._serialize_key(new_key)):
+            self.wr_cache.delete(sr_key)
+
+    def claim(self, name, max_age=None):
+        """Claim a task to be run once by a single mirror process
+
+        :param max_age: seconds after which the task can be claimed again,
+            or None for never
+        :return: whether it was not claimed before
+        :rtype: bool
+        """
+        sr_name = b"claim:" + json.dumps(name).encode()
+        return bool(self.wr_cache.set(sr_name, b"1", nx=True, ex=max_age))
+
+    def index(self, key, names):
+        """Add the key to each of the named indexes
+
+        The indexes expire along with the longest lived cache entries.
+        """
+        sr_key = self._serialize_key(key)
+        pipeline = self.wr_cache.pipeline()
+        for name in names:
+            sr_name = self._serialize_index_name(name)
+            pipeline.sadd(sr_name, sr_key)
+            pipeline.expire(sr_name, INDEX_EXPIRATION)
+        pipeline.execute()
+
+    def deindex(self, key, names):
+        """Remove the key from each of the named indexes"""
+        sr_key = self._serialize_key(key)
+        pipeline = self.wr_cache.pipeline()
+        for name in names:
+            pipeline.srem(self._serialize_index_name(name), sr_key)
+        pipeline.execute()
+
+    def indexed(self, name):
+        """Get the keys added to the named index
+
+        The keys of the entries that expired on their own are left in the
+        indexes, so some of them may no longer be in the cache.
+        """
+        members = self.ro_cache.smembers(self._serialize_index_name(name))
+        return {tuple(self._deserialize_key(member)) for member in members}
+
     def _scan_iter(self):
         """Make an iterator so that the client doesn't need to remember the cursor position."""
         cursor = "0"
@@ -78,47 +274,130 @@ class RedisCache:
                     # cache. It will expire on its own; skip it.
                     continue
 
-    @staticmethod
-    def _get_connection(host):
-        parameters = {"host": host, "port": REDIS_PORT}
-        if REDIS_TOKEN is not None:
-            parameters["password"] = REDIS_TOKEN
-        if REDIS_SSL is not None and REDIS_SSL.lower() == "true":
-            parameters["ssl"] = True
-        return redis.Redis(**parameters)
+    def _scan_bodies(self):
+        """Iterate over the keys of the bodies"""
+        cursor = "0"
+        while cursor != 0:
+            cursor, data = self.wr_cache.scan(cursor, match=b"body:*")
+            yield from data
 
     @staticmethod
     def _serialize_key(key):
         """Serialize a cache key for storage in Redis"""
         return json.dumps(key).encode()
 
+    @staticmethod
+    def _serialize_index_name(name):
+        """Serialize an index name for storage in Redis
+
+        The prefix makes it invalid JSON, so it is never taken for a cache key.
+        """
+        return b"index:" + json.dumps(name).encode()
+
+    @staticmethod
+    def _serialize_body_key(digest):
+        """Serialize the key of a body for storage in Redis
+
+        The prefix makes it invalid JSON, so it is never taken for a cache key.
+        """
+        return b"body:" + digest.encode()
+
     @staticmethod
     def _deserialize_key(key):
         """Deserialize a cache key stored in Redis"""
         return json.loads(key)
 
     @staticmethod
-    def _serialize_response(response):
+    def _serialize_response(response, digest):
         """Serialize a requests.Response-like object for storage in Redis.
 
         Only the fields needed to rebuild the response are stored (as JSON),
         rather than pickling the object, so reading the cache can never
-        trigger arbitrary code execution.
+        trigger arbitrary code execution. The body is stored apart, the
+        response pointing at it through its digest.
         """
         payload = {
             "status_code": response.status_code,
             "headers": dict(response.headers),
-            "content": base64.b64encode(response.content or b"").decode("ascii"),
+            "body": digest,
         }
         return json.dumps(payload).encode()
 
     @staticmethod
-    def _deserialize_response(item):
-        """Rebuild a requests.Response from its JSON representation"""
-        payload = json.loads(item)
+    def _deserialize_response(payload, content):
+        """Rebuild a requests.Response from its JSON representation and body"""
         response = Response()
         response.status_code = payload["status_code"]
         response.headers = CaseInsensitiveDict(payload["headers"])
         response.encoding = get_encoding_from_headers(response.headers)
-        response._content = base64.b64decode(payload["content"])  # noqa: SLF001
+        response._content = content  # noqa: SLF001
         return response
+
+
+class RedisUsersCache:
+    """Users cache shared by the mirror processes through Redis.
+
+    Only the sha of the tokens is stored, along with the user login, and
+    it expires along with the validation of the token.
+    """
+
+    def __init__(self):
+        self.wr_cache = _get_connection(PRIMARY_ENDPOINT)
+        self.ro_cache = _get_connection(READER_ENDPOINT)
+
+    def add(self, key, value, max_age):
+        """Store the user login of the token key, for max_age seconds"""
+        self.wr_cache.set(
+            self._serialize_key(key),
+            (value or "").encode(),
+            ex=None if math.isinf(max_age) else math.ceil(max_age),
+        )
+
+    def get(self, key):
+        """Get the user login of the token key, or None if not validated"""
+        value = self.ro_cache.get(self._serialize_key(key))
+        return None if value is None else value.decode()
+
+    def discard(self, key):
+        """Drop the user login of the token key, if any"""
+        self.wr_cache.delete(self._serialize_key(key))
+
+    @staticmethod
+    def _serialize_key(key):
+        """Serialize a token for storage in Redis
+
+        The prefix makes it invalid JSON, so it is never taken for a cache key.
+        """
+        return b"user:" + hashlib.sha1(key.encode()).hexdigest().encode()
+
+
+class RedisChannel:
+    """Channel sending messages to all the mirror processes through Redis.
+
+    Messages are only received by the processes listening when they are
+    sent, so the listeners must assume they missed some whenever they stop.
+    """
+
+    def __init__(self, name):
+        self.name = b"channel:" + name.encode()
+        self.wr_cache = _get_connection(PRIMARY_ENDPOINT)
+
+    def publish(self, message):
+        """Send a JSON serializable message to the listening processes"""
+        self.wr_cache.publish(self.name, json.dumps(message))
+
+    def listen(self):
+        """Iterate over the messages sent from now on
+
+        It stops when the connection to Redis is lost.
+        """
+        pubsub = self.wr_cache.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.name)
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield json.loads(message["data"])
+        except redis.exceptions.RedisError as error:
+            LOG.warning("CHANNEL %s lost: %s", self.name.decode(), error)
+        finally:
+            pubsub.close()
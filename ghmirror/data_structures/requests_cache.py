@@ -14,12 +14,27 @@
 
 """Implements caching backend"""
 
+import logging
+import math
 import os
+import threading
+import time
+
+import redis
 
 from ghmirror.data_structures.monostate import InMemoryCache
-from ghmirror.data_structures.redis_data_structures import RedisCache
+from ghmirror.data_structures.redis_data_structures import (
+    RedisCache,
+    RedisChannel,
+    RedisUsersCache,
+)
 
 CACHE_TYPE = os.environ.get("CACHE_TYPE", "in-memory")
+# Seconds between the runs dropping the bodies no longer used from Redis,
+# 0 for never
+BODIES_GC_INTERVAL = float(os.environ.get("GITHUB_MIRROR_BODIES_GC_INTERVAL", "3600"))
+
+LOG = logging.getLogger(__name__)
 
 
 class RequestsCache:
@@ -39,9 +54,15 @@ class RequestsCache:
     def __getitem__(self, item):  # pragma: no cover
         pass
 
+    def get(self, key):  # pragma: no cover
+        pass
+
     def __setitem__(self, key, value):  # pragma: no cover
         pass
 
+    def __delitem__(self, key):  # pragma: no cover
+        pass
+
     def __iter__(self):  # pragma: no cover
         pass
 
@@ -50,3 +71,69 @@ class RequestsCache:
 
     def __sizeof__(self):  # pragma: no cover
         pass
+
+    def index(self, key, names):  # pragma: no cover
+        pass
+
+    def deindex(self, key, names):  # pragma: no cover
+        pass
+
+    def indexed(self, name):  # pragma: no cover
+        pass
+
+    def dedup_ratio(self):  # pragma: no cover
+        pass
+
+
+def shared_users_cache():
+    """Get the users cache shared by the mirror processes, if any
+
+    :rtype: RedisUsersCache, optional
+    """
+    if CACHE_TYPE == "redis":
+        return RedisUsersCache()
+    return None
+
+
+def shared_channel(name):
+    """Get the named channel to the other mirror processes, if any
+
+    :rtype: RedisChannel, optional
+    """
+    if CACHE_TYPE == "redis":
+        return RedisChannel(name)
+    return None
+
+
+def start_bodies_collector():
+    """Start dropping the bodies no longer used from Redis, periodically
+
+    In memory, bodies are dropped along with their last response instead.
+
+    :return: the thread dropping them, or None when not using Redis
+    :rtype: threading.Thread, optional
+    """
+    if CACHE_TYPE != "redis" or not BODIES_GC_INTERVAL:
+        return None
+    thread = threading.Thread(target=_collect_bodies, name="bodies-gc", daemon=True)
+    thread.start()
+    return thread
+
+
+def _collect_bodies():
+    """Drop the bodies no longer used every BODIES_GC_INTERVAL seconds
+
+    Each run is claimed by a single mirror process, the others skipping it.
+    """
+    while True:
+        time.sleep(BODIES_GC_INTERVAL)
+        try:
+            cache = RedisCache()
+            # Run by one mirror process at a time, for most of the interval
+            if not cache.claim("bodies-gc", math.ceil(BODIES_GC_INTERVAL * 0.9)):
+                continue
+            dropped = cache.collect_bodies(grace=BODIES_GC_INTERVAL)
+        except redis.exceptions.RedisError as error:
+            LOG.warning("BODIES collection failed: %s", error)
+            continue
+        LOG.info("COLLECTED %s unused bodies", dropped)
@@ -14,18 +14,47 @@
 
 """Contains all the required verification"""
 
+import hashlib
+import hmac
+import logging
+import math
 import os
+import threading
+import time
 from functools import wraps
 
 import flask
+import requests
 
 from ghmirror.core.constants import GH_API
-from ghmirror.core.mirror_requests import conditional_request
+from ghmirror.core.mirror_requests import (
+    conditional_request,
+    online_request,
+)
+from ghmirror.core.scheduler import (
+    SingleFlight,
+    mark_background,
+)
 from ghmirror.data_structures.monostate import UsersCache
+from ghmirror.data_structures.requests_cache import shared_users_cache
 from ghmirror.utils.extensions import session
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+LOG = logging.getLogger(__name__)
+
 AUTHORIZED_USERS = os.environ.get("GITHUB_USERS")
+# Seconds after which a token is validated upstream again, 0 for never
+USERS_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_USERS_MAX_AGE", "3600")) or math.inf
+# Seconds during which a token found in the shared users cache is trusted
+# without looking it up there again
+USERS_LOCAL_MAX_AGE = float(os.environ.get("GITHUB_MIRROR_USERS_LOCAL_MAX_AGE", "60"))
 DOC_URL = "https://github.com/app-sre/github-mirror#user-validation"
+WEBHOOK_SECRET = os.environ.get("GITHUB_MIRROR_WEBHOOK_SECRET")
+WEBHOOK_DOC_URL = "https://github.com/app-sre/github-mirror#webhooks"
+# Validations of the tokens in flight, shared by the requests using them
+USER_VALIDATIONS = SingleFlight()
+# Users validated by all the mirror processes, None without a shared cache
+SHARED_USERS = shared_users_cache()
 
 
 def check_user(function):
@@ -36,7 +65,7 @@ def check_user(function):
     """
 
     @wraps(function)
-    def wrapper(*args, **kwargs):
+    def wrapper(*args, **kwargs):  # noqa: PLR0911
         # Need to check if the Authorization header is present
         # in the request to support anonymous user access
         authorization = flask.request.headers.get("Authorization")
@@ -62,10 +91,20 @@ def check_user(function):
         if authorization in users_cache:
             return function(*args, **kwargs)
 
-        # Using the Authorization header to get the user information
-        user_url = f"{GH_API}/user"
-        resp = conditional_request(
-            session=session, method="GET", url=user_url, auth=authorization
+        # Users validated by the other mirror processes
+        if SHARED_USERS is not None:
+            user_login = SHARED_USERS.get(authorization)
+            if user_login is not None and _is_authorized(user_login):
+                users_cache.add(
+                    authorization, user_login, min(USERS_LOCAL_MAX_AGE, USERS_MAX_AGE)
+                )
+                return function(*args, **kwargs)
+
+        # Using the Authorization header to get the user information,
+        # once for all the requests using the same token meanwhile
+        resp = USER_VALIDATIONS.do(
+            hashlib.sha1(authorization.encode()).hexdigest(),
+            lambda: _validate_user(authorization),
         )
 
         # Fail early when Github API tells something is wrong
@@ -73,13 +112,11 @@ def check_user(function):
             return flask.Response(resp.content, resp.status_code)
 
         user_login = resp.json()["login"]
-        authorized_users = AUTHORIZED_USERS.split(":") if AUTHORIZED_USERS else []
 
         # If GITHUB_USERS is not set or the user login from GitHub
-        # is in the authorized_users list, we cache the user for
-        # future use and return the decorated function
-        if not authorized_users or user_login in authorized_users:
-            users_cache.add(authorization, user_login)
+        # is in the authorized_users list, the user was cached for
+        # future use and we return the decorated function
+        if _is_authorized(user_login):
             return function(*args, **kwargs)
 
         # No match means user is forbidden
@@ -92,3 +129,152 @@ def check_user(function):
         )
 
     return wrapper
+
+
+def _validate_user(authorization):
+    """Get the user of a token upstream, caching it when authorized
+
+    :return: the response for the /user request
+    :rtype: requests.Response
+    """
+    resp = conditional_request(
+        session=session, method="GET", url=f"{GH_API}/user", auth=authorization
+    )
+    if resp.status_code == 200:  # noqa: PLR2004
+        user_login = resp.json()["login"]
+        if _is_authorized(user_login):
+            _add_user(authorization, user_login)
+    return resp
+
+
+def _is_authorized(user_login):
+    """Check whether the user is one of AUTHORIZED_USERS, if set"""
+    authorized_users = AUTHORIZED_USERS.split(":") if AUTHORIZED_USERS else []
+    return not authorized_users or user_login in authorized_users
+
+
+def _add_user(authorization, user_login):
+    """Cache the user of a token just validated, in the shared cache too
+
+    With a shared cache, the token is looked up there again after
+    USERS_LOCAL_MAX_AGE seconds, so revoking it in one process is seen by
+    the others.
+    """
+    if SHARED_USERS is None:
+        UsersCache().add(authorization, user_login, USERS_MAX_AGE)
+        return
+    SHARED_USERS.add(authorization, user_login, USERS_MAX_AGE)
+    UsersCache().add(authorization, user_login, min(USERS_LOCAL_MAX_AGE, USERS_MAX_AGE))
+
+
+class UsersRevalidator:
+    """Validates upstream again the tokens in use, before they expire.
+
+    Every interval seconds, the tokens used by the clients since the
+    previous round are validated through the requests cache, so the ones
+    not changed are conditional requests answered with a 304. Tokens no
+    longer valid, or of users no longer authorized, are dropped.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.since = time.monotonic()
+
+    def start(self):
+        """Starting a daemon thread to validate the tokens.
+
+        daemon is required so the thread is killed when the main
+        thread completes.
+        """
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        """Method to be called in a thread, validating every interval seconds."""
+        mark_background()
+        while True:
+            time.sleep(self.interval)
+            self.revalidate()
+
+    def revalidate(self):
+        """Validate again the tokens used since the previous round
+
+        :return: the number of tokens dropped
+        :rtype: int
+        """
+        since, self.since = self.since, time.monotonic()
+        dropped = 0
+        for authorization in UsersCache().used_since(since):
+            try:
+                resp = online_request(session, "GET", f"{GH_API}/user", authorization)
+            except requests.exceptions.RequestException as error:
+                LOG.warning("USERS validation failed: %s", error)
+                continue
+
+            if resp.status_code == 200:  # noqa: PLR2004
+                # Responses served from the cache on upstream errors are
+                # not current
+                if not resp.headers["X-Cache"].startswith("ONLINE_"):
+                    continue
+                user_login = resp.json()["login"]
+                if _is_authorized(user_login):
+                    _add_user(authorization, user_login)
+                    continue
+            elif resp.status_code != 401:  # noqa: PLR2004
+                continue
+
+            UsersCache().discard(authorization)
+            if SHARED_USERS is not None:
+                SHARED_USERS.discard(authorization)
+            dropped += 1
+        return dropped
+
+
+def start_users_revalidator():
+    """Start validating the tokens in use again, if they expire.
+
+    :return: the revalidator, or None when the tokens never expire
+    :rtype: UsersRevalidator, optional
+    """
+    if math.isinf(USERS_MAX_AGE):
+        return None
+    revalidator = UsersRevalidator(interval=USERS_MAX_AGE / 2)
+    revalidator.start()
+    return revalidator
+
+
+def check_signature(function):
+    """Check if the request is a webhook delivery signed with the secret.
+
+    GitHub signs the payload of the deliveries with the webhook secret, in
+    the X-Hub-Signature-256 header. Without a secret configured, webhooks
+    are disabled.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if WEBHOOK_SECRET is None:
+            return (
+                flask.jsonify(
+                    message="Webhooks are not enabled",
+                    documentation_url=WEBHOOK_DOC_URL,
+                ),
+                404,
+            )
+
+        digest = hmac.new(
+            WEBHOOK_SECRET.encode(), flask.request.get_data(), hashlib.sha256
+        ).hexdigest()
+        signature = flask.request.headers.get("X-Hub-Signature-256", "")
+        if not hmac.compare_digest(signature, f"sha256={digest}"):
+            return (
+                flask.jsonify(
+                    message="Invalid webhook signature",
+                    documentation_url=WEBHOOK_DOC_URL,
+                ),
+                401,
+            )
+
+        return function(*args, **kwargs)
+
+    return wrapper
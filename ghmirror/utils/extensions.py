@@ -1,5 +1,87 @@
 """Module to create a requests session that will be used to make all the requests to the GitHub API."""
 
+import os
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+from ghmirror.data_structures.monostate import StatsCache
+
+# Connections kept open to the GitHub API. Requests beyond that wait for one
+# of them to be released, so it should match the concurrency of the mirror:
+# the client threads plus the collection, prefetch and hedge workers
+POOL_SIZE = int(os.environ.get("GITHUB_MIRROR_POOL_SIZE", "32"))
+# Seconds after which an idle connection is closed instead of being reused,
+# as the other end may have closed it meanwhile, 0 for never
+POOL_MAX_IDLE = float(os.environ.get("GITHUB_MIRROR_POOL_MAX_IDLE", "60"))
+
+
+class PoolTimeoutError(requests.exceptions.Timeout):
+    """No connection to the upstream was released in time"""
+
+
+class MeteredHTTPSConnectionPool(HTTPSConnectionPool):
+    """Connection pool recording the time waited for its connections.
+
+    The wait is observed along with whether the connection is reused or a
+    new one, with a new TLS handshake, has to be opened. Requests never give
+    a pool timeout, so requests wait for a connection at most for their
+    connect timeout instead of forever.
+    """
+
+    def urlopen(self, method, url, *args, pool_timeout=None, **kwargs):
+        """Open the url, waiting for a connection for the connect timeout"""
+        if pool_timeout is None:
+            connect_timeout = getattr(kwargs.get("timeout"), "connect_timeout", None)
+            if isinstance(connect_timeout, (int, float)):
+                pool_timeout = connect_timeout
+        return super().urlopen(method, url, *args, pool_timeout=pool_timeout, **kwargs)
+
+    def _get_conn(self, timeout=None):
+        start = time.monotonic()
+        conn = super()._get_conn(timeout=timeout)
+        released = getattr(conn, "released", None)
+        if (
+            POOL_MAX_IDLE
+            and released is not None
+            and time.monotonic() - released > POOL_MAX_IDLE
+        ):
+            conn.close()
+        StatsCache().observe_pool_wait(
+            time.monotonic() - start, reused=getattr(conn, "sock", None) is not None
+        )
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.released = time.monotonic()
+        super()._put_conn(conn)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """HTTPAdapter pooling POOL_SIZE metered connections per host"""
+
+    def __init__(self):
+        super().__init__(pool_maxsize=POOL_SIZE, pool_block=True)
+
+    def send(self, request, *args, **kwargs):
+        """Send the request, raising PoolTimeoutError when no connection was free"""
+        try:
+            return super().send(request, *args, **kwargs)
+        except EmptyPoolError as error:
+            raise PoolTimeoutError(error, request=request) from error
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create the pool manager, with metered pools for HTTPS"""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            "https": MeteredHTTPSConnectionPool,
+        }
+
 
 session = requests.Session()
+session.mount("https://", UpstreamAdapter())
@@ -1,10 +1,17 @@
 import pytest
 
+from ghmirror.core.mirror_requests import UPSTREAM_HEALTH
+from ghmirror.core.scheduler import _BACKGROUND  # noqa: PLC2701
 from ghmirror.data_structures.monostate import (
+    CollectionsCacheBorg,
     GithubStatus,
     InMemoryCacheBorg,
+    NegativesCacheBorg,
+    PrefetchesCacheBorg,
     StatsCacheBorg,
     UsersCacheBorg,
+    ValidationsCacheBorg,
+    WebhooksCacheBorg,
 )
 
 
@@ -20,4 +27,11 @@ def _reset_singletons():
     InMemoryCacheBorg._state.clear()  # noqa: SLF001
     UsersCacheBorg._state.clear()  # noqa: SLF001
     StatsCacheBorg._state.clear()  # noqa: SLF001
+    ValidationsCacheBorg._state.clear()  # noqa: SLF001
+    PrefetchesCacheBorg._state.clear()  # noqa: SLF001
+    CollectionsCacheBorg._state.clear()  # noqa: SLF001
+    WebhooksCacheBorg._state.clear()  # noqa: SLF001
+    NegativesCacheBorg._state.clear()  # noqa: SLF001
     GithubStatus._instance = None  # noqa: SLF001
+    _BACKGROUND.__dict__.clear()
+    UPSTREAM_HEALTH.reset()
@@ -1,19 +1,47 @@
 # ruff: noqa: PLR2004
+import hashlib
+import hmac
+import io
+import json
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 from unittest.mock import ANY
 
 import pytest
 import requests
+from urllib3 import HTTPResponse
 
 from ghmirror.app import APP
+from ghmirror.core import mirror_requests
 from ghmirror.core.constants import (
+    GH_API,
     PER_PAGE_ELEMENTS,
     REQUESTS_TIMEOUT,
 )
+from ghmirror.core.health import UpstreamHealth
+from ghmirror.core.pagination import (
+    query_parameters,
+    replace_query_parameters,
+)
+from ghmirror.core.retries import Latencies
+from ghmirror.core.scheduler import UpstreamScheduler
+from ghmirror.data_structures.disk_cache import DiskCache
 from ghmirror.data_structures.monostate import (
+    CollectionsCache,
     GithubStatus,
+    InMemoryCache,
+    InMemoryCacheBorg,
+    PrefetchesCache,
+    StatsCache,
     UsersCache,
+    UsersCacheBorg,
+    ValidationsCacheBorg,
 )
+from ghmirror.decorators.checks import UsersRevalidator
 from ghmirror.utils.wait import wait_for
 
 
@@ -119,6 +147,94 @@ def mocked_requests_api_corner_case_with_links(*_args, **kwargs):
     )
 
 
+def mocked_requests_api_corner_case_empty_probe(*_args, **kwargs):
+    if kwargs["url"].endswith("per_page=1"):
+        if "If-None-Match" in kwargs["headers"]:
+            return MockResponse("", {}, 304)
+        return MockResponse("[]", {"ETag": "empty"}, 200, json_content=[])
+
+    return mocked_requests_api_corner_case(*_args, **kwargs)
+
+
+COLLECTION = [{"id": i} for i in range(10)]
+
+
+def mocked_requests_collection(*_args, **kwargs):
+    """Serve COLLECTION honoring the 'page' and 'per_page' parameters"""
+    url = kwargs["url"]
+    parameters = {**query_parameters(url), **(kwargs.get("params") or {})}
+    page = int(parameters.get("page", 1))
+    per_page = int(parameters.get("per_page", PER_PAGE_ELEMENTS))
+    elements = COLLECTION[(page - 1) * per_page : page * per_page]
+    etag = f"{page}-{per_page}"
+    if kwargs["headers"].get("If-None-Match") == etag:
+        return MockResponse("", {}, 304)
+
+    last_page = math.ceil(len(COLLECTION) / per_page)
+    links = {}
+    if page < last_page:
+        for rel, target in (("next", page + 1), ("last", last_page)):
+            target_url = replace_query_parameters(url, {**parameters, "page": target})
+            links[rel] = {"url": target_url, "rel": rel}
+    headers = {"ETag": etag, "Content-Type": "application/json"}
+    if links:
+        headers["Link"] = ", ".join(
+            f'<{link["url"]}>; rel="{rel}"' for rel, link in links.items()
+        )
+    return MockResponse(
+        json.dumps(elements), headers, 200, links=links, json_content=elements
+    )
+
+
+def issues_collection():
+    return [
+        {
+            "id": i,
+            "created_at": f"2024-01-{i + 1:02d}T00:00:00Z",
+            "updated_at": f"2024-02-{i + 1:02d}T00:00:00Z",
+        }
+        for i in range(10)
+    ]
+
+
+def mocked_requests_issues(issues):
+    """Serve issues honoring the 'since', 'state', 'page' and 'per_page' parameters"""
+
+    def _mocked_request(*_args, **kwargs):
+        url = kwargs["url"]
+        parameters = {**query_parameters(url), **(kwargs.get("params") or {})}
+        page = int(parameters.get("page", 1))
+        per_page = int(parameters.get("per_page", PER_PAGE_ELEMENTS))
+        since = parameters.get("since", "")
+        state = parameters.get("state", "open")
+        updated = [
+            issue
+            for issue in issues
+            if issue["updated_at"] >= since
+            and state in {"all", issue.get("state", "open")}
+        ]
+        elements = updated[(page - 1) * per_page : page * per_page]
+        etag = hashlib.sha1(json.dumps(elements).encode()).hexdigest()
+        if kwargs["headers"].get("If-None-Match") == etag:
+            return MockResponse("", {}, 304)
+
+        links = {}
+        if page * per_page < len(updated):
+            next_url = replace_query_parameters(url, {**parameters, "page": page + 1})
+            links["next"] = {"url": next_url, "rel": "next"}
+        headers = {"ETag": etag, "Content-Type": "application/json"}
+        if links:
+            headers["Link"] = f'<{links["next"]["url"]}>; rel="next"'
+        return MockResponse(
+            json.dumps(elements), headers, 200, links=links, json_content=elements
+        )
+
+    return _mocked_request
+
+
+AUTH_SHA = hashlib.sha1(b"foo").hexdigest()
+
+
 @pytest.fixture(name="client")
 def fixture_client():
     APP.config["TESTING"] = True
@@ -429,6 +545,7 @@ def test_mirror_auth_error(mock_monitor_session, _mocked_cond_request, client):
     assert response.status_code == 500
 
 
+@mock.patch("ghmirror.data_structures.monostate.STATUS_SLEEP_TIME", 1)
 @mock.patch(
     "ghmirror.utils.extensions.session.request",
     side_effect=mocked_requests_get_etag,
@@ -493,6 +610,7 @@ def test_offline_mode(mock_monitor_session, _mock_request, client):
     ) in str(response.data)
 
 
+@mock.patch("ghmirror.data_structures.monostate.STATUS_SLEEP_TIME", 1)
 @mock.patch(
     "ghmirror.utils.extensions.session.request",
     side_effect=mocked_requests_get_etag,
@@ -1015,3 +1133,1500 @@ def test_mirror_request_connection_error_miss(mock_monitor_session, mock_get, cl
     mock_get.side_effect = requests.exceptions.ConnectionError
     response = client.get("/repos/app-sre/github-mirror", follow_redirects=True)
     assert response.status_code == 502
+
+
+@mock.patch("ghmirror.core.mirror_requests.PER_PAGE_ELEMENTS", 2)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_api_corner_case_empty_probe,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_pagination_corner_case_empty_probe(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    response = client.get("/repos/app-sre/github-mirror/pulls?page=3")
+    assert response.status_code == 200
+
+    # The page is full and has no 'next' link, but the probe for the element
+    # right after it comes back empty, so the cached page is served
+    for _ in range(2):
+        response = client.get("/repos/app-sre/github-mirror/pulls?page=3")
+        assert response.status_code == 200
+
+    response = client.get("/metrics", follow_redirects=True)
+    assert (
+        'request_latency_seconds_count{cache="ONLINE_HIT",'
+        'method="GET",status="200",user="None"} 2.0'
+    ) in str(response.data)
+
+    probe_urls = [
+        call.kwargs["url"]
+        for call in mock_get.call_args_list
+        if call.kwargs["url"].endswith("per_page=1")
+    ]
+    assert (
+        probe_urls
+        == [
+            "https://api.github.com/repos/app-sre/github-mirror/pulls?page=7&per_page=1"
+        ]
+        * 2
+    )
+    # The second probe is a conditional request
+    assert "If-None-Match" in mock_get.call_args_list[-1].kwargs["headers"]
+
+
+@mock.patch("ghmirror.core.mirror_requests.UPSTREAM_PER_PAGE", 4)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_collection,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_page_coalescing(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    pages = []
+    url = "/repos/app-sre/github-mirror/issues?per_page=3"
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([element["id"] for element in response.json])
+        next_link = [
+            link
+            for link in response.headers.get("Link", "").split(", ")
+            if 'rel="next"' in link
+        ]
+        url = next_link[0][1:].split(">")[0] if next_link else None
+        if url:
+            assert url.startswith("http://localhost/")
+            assert 'page=4>; rel="last"' in response.headers["Link"]
+
+    assert pages == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert 'rel="first"' in response.headers["Link"]
+    # With a validator of their own, changing along with the page
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=3&page=4")
+    assert response.headers["ETag"] == etag
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=3&page=3")
+    assert response.headers["ETag"] != etag
+
+    # The three upstream pages of 4 elements were fetched only once
+    upstream_pages = sorted(
+        call.kwargs["params"]["page"] for call in mock_get.call_args_list
+    )
+    assert upstream_pages == ["1", "2", "3"]
+    assert all(
+        call.kwargs["params"]["per_page"] == "4" for call in mock_get.call_args_list
+    )
+
+
+@mock.patch("ghmirror.core.mirror_requests.UPSTREAM_PER_PAGE", 100)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_get_etag,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_page_coalescing_not_a_list(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    # Unpaginated resources are served as they are
+    response = client.get("/repos/app-sre/github-mirror")
+    assert response.status_code == 200
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.kwargs["params"] == {"page": "1", "per_page": "100"}
+
+    # Anything else is requested as the client did
+    response = client.get("/repos/app-sre/github-mirror?page=5")
+    assert response.status_code == 200
+    assert mock_get.call_args.kwargs["params"] == {
+        "page": "5",
+        "per_page": PER_PAGE_ELEMENTS,
+    }
+
+    # So are invalid pages
+    for page in ("abc", "0"):
+        response = client.get(f"/repos/app-sre/github-mirror?page={page}")
+        assert mock_get.call_args.kwargs["params"] == {
+            "page": page,
+            "per_page": PER_PAGE_ELEMENTS,
+        }
+
+    # Routes wrapping their elements in an object are never coalesced
+    mock_get.reset_mock()
+    response = client.get("/search/issues?q=mirror&page=2")
+    assert response.status_code == 200
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.kwargs["params"] == {
+        "q": "mirror",
+        "page": "2",
+        "per_page": PER_PAGE_ELEMENTS,
+    }
+
+
+@mock.patch("ghmirror.core.mirror_requests.UPSTREAM_PER_PAGE", 4)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_page_coalescing_without_last_link(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+
+    def mocked_requests_collection_without_last(*args, **kwargs):
+        resp = mocked_requests_collection(*args, **kwargs)
+        if resp.links:
+            resp.links.pop("last")
+            resp.headers["Link"] = resp.headers["Link"].split(", ")[0]
+        return resp
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_collection_without_last,
+    ):
+        response = client.get("/repos/app-sre/github-mirror/issues?per_page=3")
+    assert response.status_code == 200
+    assert response.json == COLLECTION[:3]
+    assert response.headers["Link"].endswith('page=2>; rel="next"')
+
+    # Revalidating upstream pages
+    ValidationsCacheBorg._state.clear()  # noqa: SLF001
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_collection_without_last,
+    ) as mock_get:
+        response = client.get("/repos/app-sre/github-mirror/issues?per_page=3")
+    assert response.json == COLLECTION[:3]
+    assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": "1-4"}
+
+    # Upstream errors are served as they are
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_error,
+    ):
+        response = client.get("/repos/app-sre/github-mirror/issues?page=3&per_page=3")
+    assert response.status_code == 500
+
+
+@mock.patch("ghmirror.core.mirror_requests.COLLECTION_MAX_PAGES", 4)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_collection,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_collection(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    response = client.get("/mirror/collection/repos/app-sre/github-mirror/issues")
+    assert response.status_code == 200
+    assert response.json == COLLECTION
+    # Without an explicit page size, the largest one is used
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.kwargs["params"]["per_page"] == "100"
+
+    response = client.get(
+        "/mirror/collection/repos/app-sre/github-mirror/issues?per_page=3"
+    )
+    assert response.status_code == 200
+    assert response.json == COLLECTION
+    assert "Link" not in response.headers
+    requested_pages = sorted(
+        call.kwargs["params"].get("page") or "1" for call in mock_get.call_args_list[1:]
+    )
+    assert requested_pages == ["1", "2", "3", "4"]
+
+    # Too many pages
+    response = client.get(
+        "/mirror/collection/repos/app-sre/github-mirror/issues?per_page=2"
+    )
+    assert response.status_code == 422
+
+
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_get_error,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_collection_error(mock_monitor_session, _mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    response = client.get("/mirror/collection/repos/app-sre/github-mirror/issues")
+    assert response.status_code == 500
+
+
+def mocked_requests_cursor(*_args, **kwargs):
+    """Serve COLLECTION paginated with the 'since' cursor, 4 elements a time"""
+    since = int(query_parameters(kwargs["url"]).get("since", -1))
+    elements = [element for element in COLLECTION if element["id"] > since][:4]
+    links = {}
+    if elements and elements[-1] != COLLECTION[-1]:
+        next_url = f"https://api.github.com/users?since={elements[-1]['id']}"
+        links["next"] = {"url": next_url, "rel": "next"}
+    return MockResponse(
+        json.dumps(elements),
+        {"ETag": str(since)},
+        200,
+        links=links,
+        json_content=elements,
+    )
+
+
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_cursor,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_collection_cursor(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    response = client.get("/mirror/collection/users")
+    assert response.status_code == 200
+    assert response.json == COLLECTION
+    assert mock_get.call_count == 3
+
+    with mock.patch("ghmirror.core.mirror_requests.COLLECTION_MAX_PAGES", 2):
+        response = client.get("/mirror/collection/users")
+    assert response.status_code == 422
+
+    # A failing page fails the whole collection
+    def mocked_requests_cursor_error(*args, **kwargs):
+        if "since=3" in kwargs["url"]:
+            return mocked_requests_get_error(*args, **kwargs)
+        return mocked_requests_cursor(*args, **kwargs)
+
+    mock_get.side_effect = mocked_requests_cursor_error
+    InMemoryCacheBorg._state.clear()  # noqa: SLF001
+    response = client.get("/mirror/collection/users")
+    assert response.status_code == 500
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.PREFETCH_EXECUTOR",
+    ThreadPoolExecutor(max_workers=1),
+)
+@mock.patch(
+    "ghmirror.core.mirror_requests.PREFETCH_SLOTS", threading.BoundedSemaphore(1)
+)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_collection,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_prefetch(mock_monitor_session, mock_get, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+    assert response.status_code == 200
+    next_key = (
+        "https://api.github.com/repos/app-sre/github-mirror/issues?page=2&per_page=4",
+        None,
+    )
+    assert wait_for(lambda: PrefetchesCache().is_fresh(next_key, 10), timeout=5)
+    assert mock_get.call_count == 2
+
+    # The next page is served from the cache
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=4&page=2")
+    assert response.status_code == 200
+    assert response.json == COLLECTION[4:8]
+    assert response.headers["X-Cache"] == "PREFETCH_HIT"
+    assert wait_for(lambda: mock_get.call_count == 3, timeout=5)
+
+    # The last page, prefetched as well, has nothing to prefetch
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=4&page=3")
+    assert response.json == COLLECTION[8:]
+    assert response.headers["X-Cache"] == "PREFETCH_HIT"
+
+    # Pages already prefetched are not prefetched again
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+    assert wait_for(lambda: PrefetchesCache().is_fresh(next_key, 10), timeout=5)
+    response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+
+    response = client.get("/metrics")
+    assert 'github_mirror_prefetch_total{result="scheduled"} 3.0' in str(response.data)
+    assert 'github_mirror_prefetch_total{result="used"} 2.0' in str(response.data)
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.PREFETCH_EXECUTOR",
+    ThreadPoolExecutor(max_workers=1),
+)
+@mock.patch(
+    "ghmirror.core.mirror_requests.PREFETCH_SLOTS", threading.BoundedSemaphore(1)
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_prefetch_guards(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+
+    def mocked_requests_collection_low_quota(*args, **kwargs):
+        resp = mocked_requests_collection(*args, **kwargs)
+        resp.headers["X-RateLimit-Remaining"] = "10"
+        resp.headers["X-RateLimit-Reset"] = str(2**32)
+        return resp
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_collection_low_quota,
+    ) as mock_get:
+        response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+    assert response.status_code == 200
+    assert mock_get.call_count == 1
+
+    StatsCache().quotas.clear()
+    with (
+        mock.patch(
+            "ghmirror.utils.extensions.session.request",
+            side_effect=mocked_requests_collection,
+        ),
+        mock.patch(
+            "ghmirror.core.mirror_requests.PREFETCH_SLOTS",
+            threading.BoundedSemaphore(1),
+        ) as slots,
+    ):
+        slots.acquire()
+        response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+    assert response.status_code == 200
+
+    # Failing prefetches are just logged
+    def mocked_requests_collection_failing_prefetch(*args, **kwargs):
+        if "page=2" in kwargs["url"]:
+            raise requests.exceptions.ConnectionError
+        return mocked_requests_collection(*args, **kwargs)
+
+    InMemoryCacheBorg._state.clear()  # noqa: SLF001
+    with (
+        mock.patch(
+            "ghmirror.utils.extensions.session.request",
+            side_effect=mocked_requests_collection_failing_prefetch,
+        ),
+        mock.patch("ghmirror.core.mirror_requests.LOG") as mock_log,
+    ):
+        response = client.get("/repos/app-sre/github-mirror/issues?per_page=4")
+        assert wait_for(lambda: mock_log.info.call_count == 2, timeout=5)
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert 'github_mirror_prefetch_total{result="throttled"} 1.0' in str(response.data)
+    assert 'github_mirror_prefetch_total{result="dropped"} 1.0' in str(response.data)
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.INCREMENTAL_ROUTES",
+    [re.compile(r"/repos/[^/]+/[^/]+/issues")],
+)
+@mock.patch("ghmirror.core.mirror_requests.INCREMENTAL_MAX_AGE", 0)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_incremental(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    issues = issues_collection()
+    url = "/repos/app-sre/github-mirror/issues"
+
+    # The whole collection is fetched first
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ) as mock_get:
+        response = client.get(f"{url}?sort=updated&per_page=4")
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "INCREMENTAL_MISS"
+    assert [issue["id"] for issue in response.json] == [9, 8, 7, 6]
+    assert 'page=2>; rel="next"' in response.headers["Link"]
+    assert 'page=3>; rel="last"' in response.headers["Link"]
+    assert mock_get.call_count == 1
+    assert "since" not in query_parameters(mock_get.call_args.kwargs["url"])
+
+    # Then only the elements updated since the latest one seen
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ) as mock_get:
+        response = client.get(f"{url}?sort=updated&direction=asc&page=3&per_page=4")
+        assert response.headers["X-Cache"] == "INCREMENTAL_MISS"
+        assert [issue["id"] for issue in response.json] == [8, 9]
+        assert "next" not in response.headers["Link"]
+        response = client.get(f"{url}?sort=updated&direction=asc&page=3&per_page=4")
+        assert response.headers["X-Cache"] == "INCREMENTAL_HIT"
+    assert mock_get.call_count == 2
+    assert mock_get.call_args.kwargs["headers"]["If-None-Match"]
+    assert (
+        query_parameters(mock_get.call_args.kwargs["url"])["since"]
+        == "2024-02-10T00:00:00Z"
+    )
+
+    # Updated elements are patched into the collection
+    issues[0]["updated_at"] = "2024-03-01T00:00:00Z"
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ):
+        response = client.get(f"{url}?sort=updated&per_page=4")
+        assert [issue["id"] for issue in response.json] == [0, 9, 8, 7]
+        response = client.get(f"{url}?sort=created&page=3&per_page=4")
+        assert response.json == [issues[1], issues[0]]
+
+    # Recently refreshed collections are served without requesting upstream
+    with (
+        mock.patch("ghmirror.core.mirror_requests.INCREMENTAL_MAX_AGE", 60),
+        mock.patch("ghmirror.utils.extensions.session.request") as mock_get,
+    ):
+        response = client.get(f"{url}?sort=created&per_page=4")
+    assert response.headers["X-Cache"] == "INCREMENTAL_HIT"
+    assert [issue["id"] for issue in response.json] == [9, 8, 7, 6]
+    mock_get.assert_not_called()
+
+    # Deleted elements are only noticed when resyncing the whole collection
+    del issues[9]
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ):
+        response = client.get(f"{url}?sort=created&per_page=4")
+        assert [issue["id"] for issue in response.json] == [9, 8, 7, 6]
+        with mock.patch("ghmirror.core.mirror_requests.INCREMENTAL_RESYNC", 0):
+            response = client.get(f"{url}?sort=created&per_page=4")
+        assert [issue["id"] for issue in response.json] == [8, 7, 6, 5]
+
+    # Other requests are served as usual
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ):
+        response = client.get(f"{url}?per_page=4")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.json == issues[:4]
+        response = client.get(f"{url}?sort=updated&since=2024-02-09T00:00:00Z")
+        assert response.json == [issues[0], issues[8]]
+        response = client.get(f"{url}?sort=updated&labels=bug")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.INCREMENTAL_ROUTES",
+    [re.compile(r"/repos/[^/]+/[^/]+/issues")],
+)
+@mock.patch("ghmirror.core.mirror_requests.INCREMENTAL_MAX_AGE", 0)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_incremental_state(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    issues = [{**issue, "state": "open"} for issue in issues_collection()]
+    url = "/repos/app-sre/github-mirror/issues"
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_issues(issues),
+    ) as mock_get:
+        response = client.get(f"{url}?sort=updated&per_page=4")
+        assert [issue["id"] for issue in response.json] == [9, 8, 7, 6]
+        assert query_parameters(mock_get.call_args.kwargs["url"])["state"] == "all"
+
+        # Closed elements are in the deltas, and leave the open ones
+        issues[9] = {**issues[9], "state": "closed", "updated_at": "2024-03-01"}
+        response = client.get(f"{url}?sort=updated&per_page=4")
+        assert response.headers["X-Cache"] == "INCREMENTAL_MISS"
+        assert [issue["id"] for issue in response.json] == [8, 7, 6, 5]
+        # From the same collection, updated with a delta
+        response = client.get(f"{url}?sort=updated&state=closed")
+        assert "since" in query_parameters(mock_get.call_args.kwargs["url"])
+        assert [issue["id"] for issue in response.json] == [9]
+        response = client.get(f"{url}?sort=updated&state=all&per_page=4")
+        assert [issue["id"] for issue in response.json] == [9, 8, 7, 6]
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.INCREMENTAL_ROUTES",
+    [re.compile(r"/repos/[^/]+/[^/]+/issues")],
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_incremental_fallback(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    url = "/repos/app-sre/github-mirror/issues?sort=updated&per_page=4"
+
+    # Elements that can not be merged
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_collection,
+    ):
+        response = client.get(url)
+    assert response.headers["X-Cache"] == "ONLINE_MISS"
+    assert response.json == COLLECTION[:4]
+
+    # Invalid pages, requested as the client did
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ) as mock_get:
+        response = client.get(f"{url}&page=abc")
+    assert response.status_code == 200
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.kwargs["params"]["page"] == "abc"
+
+    # Responses that are not lists
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ):
+        response = client.get(url.replace("github-mirror", "qontract-reconcile"))
+    assert response.status_code == 200
+
+    # Upstream errors
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_error,
+    ):
+        response = client.get(url)
+        assert response.headers["X-Cache"] == "API_ERROR_HIT"
+        response = client.get(url.replace("github-mirror", "qontract-schemas"))
+        assert response.status_code == 500
+
+
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_get_etag,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_mutation_invalidates(mock_monitor_session, mock_request, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    urls = [
+        "/repos/app-sre/github-mirror",
+        "/repos/app-sre/github-mirror/issues?state=all",
+        "/repos/app-sre/github-mirror/issues/1",
+        "/repos/app-sre/github-mirror/issues/1/comments",
+        "/repos/app-sre/github-mirror/issues/10",
+        "/repos/app-sre/github-mirror/issues/2/comments",
+    ]
+    for url in urls:
+        client.get(url, headers={"Authorization": "foo"})
+    client.get(urls[2])
+    CollectionsCache().set(
+        (f"{GH_API}/repos/app-sre/github-mirror/issues", AUTH_SHA), {}
+    )
+    CollectionsCache().set((f"{GH_API}/repos/app-sre/github-mirror", AUTH_SHA), {})
+
+    # Failed mutations do not invalidate anything
+    mock_request.side_effect = mocked_requests_get_error
+    client.patch(urls[2], data=b"foo", headers={"Authorization": "foo"})
+    assert len(InMemoryCache()) == 8
+
+    # The resource, what is under it and its parent collection are dropped,
+    # only for the user that mutated it
+    mock_request.side_effect = mocked_requests_get_etag
+    response = client.patch(urls[2], data=b"foo", headers={"Authorization": "foo"})
+    assert response.status_code == 200
+    assert set(InMemoryCache()) == {
+        (f"{GH_API}/user", AUTH_SHA),
+        (f"{GH_API}{urls[0]}", AUTH_SHA),
+        (f"{GH_API}{urls[4]}", AUTH_SHA),
+        (f"{GH_API}{urls[5]}", AUTH_SHA),
+        (f"{GH_API}{urls[2]}", None),
+    }
+    # And removed from the indexes
+    assert InMemoryCache().indexed("/repos/app-sre/github-mirror/issues/1") == {
+        (f"{GH_API}{urls[2]}", None)
+    }
+    assert set(InMemoryCache().indexed("/repos/app-sre/github-mirror")) == set(
+        InMemoryCache()
+    ) - {(f"{GH_API}/user", AUTH_SHA)}
+    assert list(CollectionsCache()) == [
+        (f"{GH_API}/repos/app-sre/github-mirror", AUTH_SHA)
+    ]
+
+    response = client.get(urls[2], headers={"Authorization": "foo"})
+    assert response.headers["X-Cache"] == "ONLINE_MISS"
+
+
+def deliver(client, event, payload, key=b"secret"):
+    body = json.dumps(payload).encode()
+    digest = hmac.new(key, body, hashlib.sha256).hexdigest()
+    return client.post(
+        "/mirror/webhook",
+        data=body,
+        content_type="application/json",
+        headers={"X-GitHub-Event": event, "X-Hub-Signature-256": f"sha256={digest}"},
+    )
+
+
+@mock.patch("ghmirror.decorators.checks.WEBHOOK_SECRET", "secret")
+@mock.patch("ghmirror.core.mirror_requests.WEBHOOK_MAX_AGE", 60)
+@mock.patch(
+    "ghmirror.utils.extensions.session.request",
+    side_effect=mocked_requests_get_etag,
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_webhook(mock_monitor_session, mock_request, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    urls = [
+        "/repos/app-sre/github-mirror",
+        "/repos/App-SRE/github-mirror/issues/1",
+        "/repos/app-sre/github-mirror/issues?state=all",
+        "/repos/app-sre/github-mirror/pulls/2",
+    ]
+    for url in urls:
+        client.get(url)
+        client.get(url, headers={"Authorization": "foo"})
+    assert len(InMemoryCache()) == 9
+
+    # Repositories not sending webhooks are always revalidated
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "ONLINE_HIT"
+
+    # The resources in the event are dropped for all the users
+    response = deliver(
+        client,
+        "issues",
+        {"repository": {"full_name": "app-sre/github-mirror"}, "issue": {"number": 1}},
+    )
+    assert response.status_code == 200
+    assert response.json == {"invalidated": 4}
+    assert len(InMemoryCache()) == 5
+
+    # Not shared with the other mirror processes, the repository is still
+    # revalidated, as they would not learn about the next deliveries
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "ONLINE_HIT"
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "ONLINE_HIT"
+
+    # Shared, the repository responses are served without revalidating them
+    channel = mock.Mock()
+    channel.publish.side_effect = mirror_requests._notified  # noqa: SLF001
+    with mock.patch("ghmirror.core.mirror_requests.WEBHOOKS_CHANNEL", channel):
+        response = deliver(
+            client, "star", {"repository": {"full_name": "app-sre/github-mirror"}}
+        )
+    channel.publish.assert_called_once_with("app-sre/github-mirror")
+    mock_request.reset_mock()
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "ONLINE_HIT"
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "FRESH_HIT"
+    assert mock_request.call_count == 1
+
+    # Until the next delivery, which also drops the merged collections
+    CollectionsCache().set((f"{GH_API}/repos/app-sre/github-mirror/issues", None), {})
+    CollectionsCache().set((f"{GH_API}/repos/app-sre/qontract-reconcile", None), {})
+    response = deliver(
+        client, "star", {"repository": {"full_name": "app-sre/github-mirror"}}
+    )
+    assert response.json == {"invalidated": 0}
+    response = client.get(urls[0])
+    assert response.headers["X-Cache"] == "ONLINE_HIT"
+    assert list(CollectionsCache()) == [
+        (f"{GH_API}/repos/app-sre/qontract-reconcile", None)
+    ]
+
+    # Deliveries without the expected resources
+    with mock.patch("ghmirror.core.mirror_requests.LOG") as mock_log:
+        response = deliver(
+            client, "issues", {"repository": {"full_name": "app-sre/github-mirror"}}
+        )
+    assert response.json == {"invalidated": 0}
+    mock_log.info.assert_called_once()
+    response = deliver(client, "ping", {"zen": "Keep it logically awesome."})
+    assert response.json == {"invalidated": 0}
+
+    # Deliveries must be signed with the secret
+    response = deliver(client, "ping", {}, key=b"foo")
+    assert response.status_code == 401
+    with mock.patch("ghmirror.decorators.checks.WEBHOOK_SECRET", None):
+        response = deliver(client, "ping", {})
+    assert response.status_code == 404
+
+
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_cooldown(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ):
+        client.get("/repos/app-sre/github-mirror")
+
+    # Secondary rate limits tell how long to wait for
+    def mocked_requests_secondary_rate_limited(*_args, **_kwargs):
+        return MockResponse(
+            "You have exceeded a secondary rate limit", {"Retry-After": "60"}, 403
+        )
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_secondary_rate_limited,
+    ) as mock_request:
+        response = client.get("/repos/app-sre/github-mirror/pulls")
+        assert response.status_code == 403
+        assert response.headers["X-Cache"] == "RATE_LIMITED_MISS"
+        assert response.headers["Retry-After"] == "60"
+
+        # Then requests are not sent upstream until the cooldown is over
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "COOLDOWN_HIT"
+        response = client.get("/repos/app-sre/github-mirror/pulls")
+        assert response.status_code == 429
+        assert response.headers["X-Cache"] == "COOLDOWN_MISS"
+        assert 0 < int(response.headers["Retry-After"]) <= 60
+        assert "rate limit" in response.json["message"]
+        response = client.patch("/repos/app-sre/github-mirror", data=b"foo")
+        assert response.status_code == 429
+    assert mock_request.call_count == 1
+
+    response = client.get("/metrics")
+    cooldown = re.search(
+        rb'github_mirror_cooldown_seconds_total{user="None"} ([0-9.]+)',
+        response.data,
+    )
+    assert 59 < float(cooldown[1]) <= 60
+
+    # Tokens with no requests left are held back until the rate limit reset,
+    # and so are their users, when known
+    StatsCache().cooldowns.clear()
+
+    def mocked_requests_exhausted(*_args, **kwargs):
+        resp = mocked_requests_get_etag(**kwargs)
+        resp.headers["X-RateLimit-Remaining"] = "0"
+        resp.headers["X-RateLimit-Reset"] = str(int(time.time()) + 600)
+        return resp
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_exhausted,
+    ) as mock_request:
+        response = client.get("/repos/app-sre/github-mirror/issues")
+        assert response.status_code == 200
+        response = client.get("/repos/app-sre/github-mirror/issues")
+        assert response.headers["X-Cache"] == "COOLDOWN_HIT"
+    assert mock_request.call_count == 1
+
+    UsersCache().add("foo", "app-sre-bot")
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=lambda **_: MockResponse("", {"Retry-After": "30"}, 429),
+    ):
+        response = client.get("/user/repos", headers={"Authorization": "foo"})
+    assert response.status_code == 429
+    assert response.headers["X-Cache"] == "RATE_LIMITED_MISS"
+    response = client.get("/metrics")
+    assert 'github_mirror_cooldown_seconds_total{user="app-sre-bot"}' in str(
+        response.data
+    )
+
+
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_cooldown_resources(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ):
+        client.get("/repos/app-sre/github-mirror/issues")
+
+    def mocked_requests_search_exhausted(*_args, **kwargs):
+        resp = mocked_requests_get_etag(**kwargs)
+        if "/search/" in kwargs["url"]:
+            resp.headers["X-RateLimit-Resource"] = "search"
+            resp.headers["X-RateLimit-Remaining"] = "0"
+            resp.headers["X-RateLimit-Reset"] = str(int(time.time()) + 60)
+        return resp
+
+    # A token out of search requests can still send core ones
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_search_exhausted,
+    ) as mock_request:
+        response = client.get("/search/issues?q=mirror")
+        assert response.status_code == 200
+        response = client.get("/search/issues?q=mirror")
+        assert response.headers["X-Cache"] == "COOLDOWN_HIT"
+        response = client.get("/repos/app-sre/github-mirror/issues")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+    assert mock_request.call_count == 2
+
+
+SCHEDULER = UpstreamScheduler(concurrency=1, queue_size=0, timeout=0)
+
+
+@mock.patch("ghmirror.core.mirror_requests.UPSTREAM_SCHEDULER", SCHEDULER)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_upstream_busy(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ) as mock_request:
+        client.get("/repos/app-sre/github-mirror")
+
+        # While the token slot is taken, requests are not sent upstream
+        mock_request.reset_mock()
+        with SCHEDULER.slot(None):
+            response = client.get("/repos/app-sre/github-mirror")
+            assert response.status_code == 200
+            assert response.headers["X-Cache"] == "BUSY_HIT"
+            response = client.get("/repos/app-sre/github-mirror/pulls")
+            assert response.status_code == 429
+            assert response.headers["X-Cache"] == "BUSY_MISS"
+            assert response.headers["Retry-After"] == "1"
+            assert "concurrent requests" in response.json["message"]
+            response = client.patch("/repos/app-sre/github-mirror", data=b"foo")
+            assert response.status_code == 429
+        assert mock_request.call_count == 0
+
+        # Released, they are again
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert mock_request.call_count == 1
+
+
+@mock.patch("ghmirror.core.mirror_requests.QUOTA_RESERVE", 0.1)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_quota_reserve(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    remaining = {"value": "4000"}
+
+    def mocked_requests_quota(*_args, **kwargs):
+        resp = mocked_requests_get_etag(**kwargs)
+        resp.headers.update({
+            "X-RateLimit-Remaining": remaining["value"],
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": str(int(time.time()) + 600),
+        })
+        return resp
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_quota,
+    ) as mock_request:
+        client.get("/repos/app-sre/github-mirror")
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+
+        # Below the reserve, the cached responses are no longer revalidated
+        remaining["value"] = "499"
+        client.get("/repos/app-sre/github-mirror/pulls")
+        mock_request.reset_mock()
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "LOW_QUOTA_HIT"
+        assert mock_request.call_count == 0
+
+        # The others are still requested upstream
+        response = client.get("/repos/app-sre/github-mirror/issues")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert mock_request.call_count == 1
+
+        # Until the reset
+        StatsCache().quotas.clear()
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+
+
+@mock.patch("ghmirror.decorators.checks.AUTHORIZED_USERS", "app-sre-bot")
+@mock.patch("ghmirror.core.mirror_requests.NEGATIVE_MAX_AGE", 60)
+@mock.patch(
+    "ghmirror.core.mirror_requests.NEGATIVE_EXCLUDED_ROUTES",
+    [re.compile(r"/repos/[^/]+/[^/]+/actions/.*")],
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_negative_caching(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+
+    def mocked_requests_not_found(*_args, **kwargs):
+        if kwargs["headers"]["Authorization"] == "revoked":
+            return MockResponse('{"message": "Bad credentials"}', {}, 401)
+        if kwargs["url"].endswith("/user"):
+            return mocked_requests_get_user_orgs_auth()
+        return MockResponse('{"message": "Not Found"}', {}, 404)
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_not_found,
+    ) as mock_request:
+        # Tokens failing the validation are not validated upstream again
+        for _ in range(2):
+            response = client.get(
+                "/repos/app-sre/github-mirror", headers={"Authorization": "revoked"}
+            )
+            assert response.status_code == 401
+        assert mock_request.call_count == 1
+
+        url = "/repos/app-sre/github-mirror/contents/missing"
+        response = client.get(url, headers={"Authorization": "foo"})
+        assert response.status_code == 404
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        mock_request.reset_mock()
+        response = client.get(url, headers={"Authorization": "foo"})
+        assert response.status_code == 404
+        assert response.headers["X-Cache"] == "NEGATIVE_HIT"
+        assert mock_request.call_count == 0
+
+        # Excluded routes are always requested upstream
+        url = "/repos/app-sre/github-mirror/actions/runs/1"
+        for _ in range(2):
+            response = client.get(url, headers={"Authorization": "foo"})
+            assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert mock_request.call_count == 2
+
+        # Creating the resource drops the failure
+        mock_request.side_effect = mocked_requests_get_etag
+        client.put(
+            "/repos/app-sre/github-mirror/contents/missing",
+            data=b"foo",
+            headers={"Authorization": "foo"},
+        )
+        response = client.get(
+            "/repos/app-sre/github-mirror/contents/missing",
+            headers={"Authorization": "foo"},
+        )
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+
+
+class MockSharedUsers:
+    def __init__(self):
+        self.users = {}
+
+    def add(self, key, value, _max_age):
+        self.users[key] = value
+
+    def get(self, key):
+        return self.users.get(key)
+
+    def discard(self, key):
+        self.users.pop(key, None)
+
+
+@mock.patch("ghmirror.decorators.checks.AUTHORIZED_USERS", "app-sre-bot")
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_shared_users(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    shared_users = MockSharedUsers()
+    status = {"user": 200}
+
+    def mocked_requests_user(*_args, **kwargs):
+        if kwargs["url"].endswith("/user"):
+            if status["user"] == 401:
+                return MockResponse('{"message": "Bad credentials"}', {}, 401)
+            if "If-None-Match" in kwargs["headers"]:
+                return MockResponse("", {}, 304)
+            return MockResponse("", {"ETag": "bar"}, 200, "app-sre-bot")
+        return mocked_requests_get_etag(**kwargs)
+
+    def user_requests(mock_request):
+        return [
+            call
+            for call in mock_request.call_args_list
+            if call.kwargs["url"].endswith("/user")
+        ]
+
+    with (
+        mock.patch("ghmirror.decorators.checks.SHARED_USERS", shared_users),
+        mock.patch(
+            "ghmirror.utils.extensions.session.request",
+            side_effect=mocked_requests_user,
+        ) as mock_request,
+    ):
+        client.get("/repos/app-sre/github-mirror", headers={"Authorization": "foo"})
+        assert shared_users.get("foo") == "app-sre-bot"
+        assert len(user_requests(mock_request)) == 1
+
+        # Another process finds the token validated in the shared cache
+        UsersCacheBorg._state.clear()  # noqa: SLF001
+        response = client.get(
+            "/repos/app-sre/github-mirror", headers={"Authorization": "foo"}
+        )
+        assert response.status_code == 200
+        assert len(user_requests(mock_request)) == 1
+
+        # Tokens in use are validated again, with a conditional request
+        revalidator = UsersRevalidator(interval=60)
+        revalidator.since = 0
+        assert revalidator.revalidate() == 0
+        assert "If-None-Match" in user_requests(mock_request)[-1].kwargs["headers"]
+        assert "foo" in UsersCache()
+
+        # Until they are revoked
+        status["user"] = 401
+        revalidator.since = 0
+        assert revalidator.revalidate() == 1
+        assert "foo" not in UsersCache()
+        assert shared_users.get("foo") is None
+        response = client.get(
+            "/repos/app-sre/github-mirror", headers={"Authorization": "foo"}
+        )
+        assert response.status_code == 401
+
+
+@pytest.mark.usefixtures("client")
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_user_validation_single_flight(mock_monitor_session):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    release = threading.Event()
+
+    def mocked_requests_slow_user(*_args, **kwargs):
+        if kwargs["url"].endswith("/user"):
+            release.wait(1)
+            return MockResponse("", {}, 200, "app-sre-bot")
+        return mocked_requests_get_etag(**kwargs)
+
+    def _get(_):
+        with APP.test_client() as parallel_client:
+            return parallel_client.get(
+                "/repos/app-sre/github-mirror", headers={"Authorization": "foo"}
+            ).status_code
+
+    with (
+        mock.patch(
+            "ghmirror.utils.extensions.session.request",
+            side_effect=mocked_requests_slow_user,
+        ) as mock_request,
+        ThreadPoolExecutor(max_workers=4) as executor,
+    ):
+        statuses = executor.map(_get, range(4))
+        time.sleep(0.1)
+        release.set()
+        assert list(statuses) == [200] * 4
+
+    user_requests = [
+        call
+        for call in mock_request.call_args_list
+        if call.kwargs["url"].endswith("/user")
+    ]
+    assert len(user_requests) == 1
+    assert UsersCache().get("foo") == "app-sre-bot"
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.UPSTREAM_HEALTH",
+    UpstreamHealth(
+        window=4, min_requests=2, threshold=0.5, slow=5, min_probe=0, max_probe=0
+    ),
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_passive_offline_mode(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ):
+        client.get("/repos/app-sre/github-mirror")
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=requests.exceptions.Timeout,
+    ):
+        for _ in range(2):
+            response = client.get("/repos/app-sre/github-mirror")
+            assert response.headers["X-Cache"] == "API_TIMEOUT_HIT"
+
+    # The failed requests made the mirror go offline, with no status page
+    mock_monitor_session.return_value.get.assert_not_called()
+    with mock.patch(
+        "ghmirror.core.mirror_requests.UPSTREAM_HEALTH.available", return_value=False
+    ):
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "OFFLINE_HIT"
+
+    # Until a probe succeeds
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ):
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+
+
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_forwarded_headers(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+
+    def mocked_requests_representations(*_args, **kwargs):
+        accept = kwargs["headers"].get("Accept", "application/json")
+        if not accept.endswith(".raw"):
+            accept = "application/json"
+        if kwargs["headers"].get("If-None-Match") == accept:
+            return MockResponse("", {}, 304)
+        headers = {"ETag": accept, "Content-Type": accept, "Vary": "Accept"}
+        if kwargs["url"].endswith("/random"):
+            headers["Vary"] = "*"
+        return MockResponse(accept, headers, 200)
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_representations,
+    ):
+        response = client.get("/repos/app-sre/github-mirror/contents/README.md")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.data == b"application/json"
+
+        # Other representations are cached apart
+        raw = {"Accept": "application/vnd.github.raw"}
+        response = client.get(
+            "/repos/app-sre/github-mirror/contents/README.md", headers=raw
+        )
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.headers["Content-Type"] == "application/vnd.github.raw"
+        assert response.headers["Vary"] == "Accept"
+        assert response.data == b"application/vnd.github.raw"
+        response = client.get(
+            "/repos/app-sre/github-mirror/contents/README.md", headers=raw
+        )
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert response.data == b"application/vnd.github.raw"
+
+        # The default one is shared by the headers asking for it
+        response = client.get(
+            "/repos/app-sre/github-mirror/contents/README.md",
+            headers={"Accept": "application/vnd.github.v3+json"},
+        )
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert response.data == b"application/json"
+
+        # Responses varying on anything are not cached
+        for _ in range(2):
+            response = client.get("/repos/app-sre/github-mirror/random")
+            assert response.headers["X-Cache"] == "ONLINE_MISS"
+
+
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_disk_cache(mock_monitor_session, client, tmp_path):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    body = b"archive of https://api.github.com"
+    sha = "a" * 40
+
+    def mocked_requests_download(*_args, **kwargs):
+        assert kwargs["stream"]
+        if kwargs["headers"].get("If-None-Match") == '"foo"':
+            return MockResponse("", {}, 304)
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.headers.update({"ETag": '"foo"', "Content-Type": "application/x-gzip"})
+        resp.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+        return resp
+
+    with (
+        mock.patch(
+            "ghmirror.core.mirror_requests.DISK_CACHE",
+            DiskCache(tmp_path, max_size=1000),
+        ),
+        mock.patch(
+            "ghmirror.utils.extensions.session.request",
+            side_effect=mocked_requests_download,
+        ) as mock_request,
+    ):
+        # Served as is
+        response = client.get(f"/repos/app-sre/github-mirror/tarball/{sha}")
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.headers["Content-Type"] == "application/x-gzip"
+        assert response.data == body
+
+        # Downloads of a commit are never revalidated
+        response = client.get(
+            f"/repos/app-sre/github-mirror/tarball/{sha}",
+            headers={"Range": "bytes=0-6"},
+        )
+        assert response.status_code == 206
+        assert response.headers["X-Cache"] == "DISK_HIT"
+        assert response.data == b"archive"
+        assert mock_request.call_count == 1
+
+        # The others are, once read in full
+        response = client.get("/repos/app-sre/github-mirror/zipball/main")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.data == body
+        response = client.get("/repos/app-sre/github-mirror/zipball/main")
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert response.data == body
+        assert mock_request.call_count == 3
+
+        # Clients revalidate them too
+        response = client.get(
+            "/repos/app-sre/github-mirror/zipball/main",
+            headers={"If-None-Match": '"foo"'},
+        )
+        assert response.status_code == 304
+
+
+@mock.patch("ghmirror.app.MAX_BUFFERED_BODY", 3)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_streamed_request_body(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    bodies = []
+
+    def mocked_requests_read_body(*_args, **kwargs):
+        data = kwargs["data"]
+        if isinstance(data, bytes):
+            bodies.append(data)
+        elif hasattr(data, "len"):
+            bodies.append((data.len, data.read()))
+        else:
+            bodies.append((None, b"".join(data)))
+        return MockResponse("", {}, 201)
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_read_body,
+    ):
+        response = client.post("/repos/app-sre/github-mirror/issues", data=b"foo")
+        assert response.status_code == 201
+        response = client.post("/repos/app-sre/github-mirror/issues", data=b"foobar")
+        assert response.status_code == 201
+        response = client.post(
+            "/repos/app-sre/github-mirror/issues",
+            input_stream=io.BytesIO(b"fo"),
+            headers={"Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},
+        )
+        assert response.status_code == 201
+
+    # Only the larger body and the one of unknown size are streamed
+    assert bodies == [b"foo", (6, b"foobar"), (None, b"fo")]
+
+
+@mock.patch("ghmirror.core.mirror_requests.STREAM_MIN_SIZE", 10)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_streaming(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    body = b'{"url": "https://api.github.com/repos/app-sre/github-mirror"}'
+
+    def mocked_requests_stream(*_args, **kwargs):
+        if "If-None-Match" in kwargs["headers"]:
+            return MockResponse("", {}, 304)
+        headers = {"ETag": "foo"}
+        if kwargs["url"].endswith("/small"):
+            headers["Content-Length"] = "2"
+        elif kwargs["url"].endswith("/uncached"):
+            headers = {}
+        assert kwargs["stream"]
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.headers.update(headers)
+        resp.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+        return resp
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_stream,
+    ):
+        response = client.get("/repos/app-sre/github-mirror")
+        assert "Content-Length" not in response.headers
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        assert response.data == body.replace(
+            b"https://api.github.com", b"http://localhost"
+        )
+
+        # Cached once sent
+        response = client.get("/repos/app-sre/github-mirror")
+        assert "Content-Length" in response.headers
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert response.data == body.replace(
+            b"https://api.github.com", b"http://localhost"
+        )
+
+        # Small responses are read in full first
+        response = client.get("/repos/app-sre/github-mirror/small")
+        assert "Content-Length" in response.headers
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+
+        # Streamed but not cached
+        response = client.get("/repos/app-sre/github-mirror/uncached")
+        assert "Content-Length" not in response.headers
+        assert response.data == body.replace(
+            b"https://api.github.com", b"http://localhost"
+        )
+        assert (
+            "https://api.github.com/repos/app-sre/github-mirror/uncached",
+            None,
+        ) not in InMemoryCache()
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.UPSTREAM_LATENCIES",
+    Latencies(size=10, min_samples=1),
+)
+@mock.patch(
+    "ghmirror.core.mirror_requests.DEADLINE_ROUTES",
+    [(re.compile(r"/repos/[^/]+/[^/]+"), 5)],
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_deadline(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_get_etag,
+    ) as mock_request:
+        response = client.get("/repos/app-sre/github-mirror")
+        assert response.headers["X-Cache"] == "ONLINE_MISS"
+        # Upstream timeouts are bound by the route deadline
+        assert mock_request.call_args.kwargs["timeout"] <= 5
+
+        # And by the one asked for by the client
+        response = client.get(
+            "/repos/app-sre/github-mirror", headers={"X-Mirror-Timeout": "2"}
+        )
+        assert response.headers["X-Cache"] == "ONLINE_HIT"
+        assert mock_request.call_args.kwargs["timeout"] <= 2
+
+        # Deadlines upstream usually misses are not even tried
+        for _ in range(10):
+            mirror_requests.UPSTREAM_LATENCIES.add(3)
+        mock_request.reset_mock()
+        response = client.get(
+            "/repos/app-sre/github-mirror", headers={"X-Mirror-Timeout": "2"}
+        )
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "DEADLINE_HIT"
+        mock_request.assert_not_called()
+
+        # Failing without a cached response
+        response = client.get(
+            "/repos/app-sre/github-mirror/pulls", headers={"X-Mirror-Timeout": "2"}
+        )
+        assert response.status_code == 502
+        mock_request.assert_not_called()
+
+    # The status of the upstream is not affected
+    assert mirror_requests.UPSTREAM_HEALTH.online
+
+
+@mock.patch(
+    "ghmirror.core.mirror_requests.UPSTREAM_LATENCIES",
+    Latencies(size=10, min_samples=100),
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_deadline_timeouts(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=requests.exceptions.Timeout(),
+    ) as mock_request:
+        # Timeouts shortened by the client deadline are not upstream failures
+        for _ in range(12):
+            client.get(
+                "/repos/app-sre/github-mirror", headers={"X-Mirror-Timeout": "2"}
+            )
+        assert mock_request.call_count == 12
+        assert mirror_requests.UPSTREAM_HEALTH.online
+
+        for _ in range(12):
+            client.get("/repos/app-sre/github-mirror")
+        assert not mirror_requests.UPSTREAM_HEALTH.online
+
+
+@mock.patch("ghmirror.core.mirror_requests.RETRY_ATTEMPTS", 2)
+@mock.patch("ghmirror.core.mirror_requests.RETRY_BACKOFF", 0)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_retries(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    responses = [
+        requests.exceptions.ConnectionError(),
+        MockResponse("", {}, 503),
+        MockResponse("", {"ETag": "foo"}, 200),
+    ]
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request", side_effect=responses
+    ) as mock_request:
+        response = client.get("/repos/app-sre/github-mirror")
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "ONLINE_MISS"
+    assert mock_request.call_count == 3
+
+    # Non-GETs are never retried
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=lambda **_: MockResponse("", {}, 503),
+    ) as mock_request:
+        response = client.post("/repos/app-sre/github-mirror/issues", data=b"foo")
+    assert response.status_code == 503
+    assert mock_request.call_count == 1
+
+    response = client.get("/metrics")
+    assert (
+        'github_mirror_extra_requests_total{kind="retry",result="sent"} 2.0'
+    ) in str(response.data)
+
+
+@mock.patch("ghmirror.core.mirror_requests.HEDGE_QUANTILE", 0.5)
+@mock.patch(
+    "ghmirror.core.mirror_requests.HEDGE_EXECUTOR", ThreadPoolExecutor(max_workers=2)
+)
+@mock.patch(
+    "ghmirror.core.mirror_requests.UPSTREAM_LATENCIES",
+    Latencies(size=10, min_samples=1),
+)
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+def test_hedging(mock_monitor_session, client):
+    setup_mocked_requests_session_get(
+        mock_monitor_session, mocked_requests_monitor_good
+    )
+    hedged = threading.Event()
+    calls = []
+
+    def mocked_requests_slow_first(*_args, **_kwargs):
+        calls.append(len(calls))
+        if len(calls) == 1:
+            hedged.wait(1)
+            return MockResponse("slow", {"ETag": "slow"}, 200)
+        hedged.set()
+        return MockResponse("fast", {"ETag": "fast"}, 200)
+
+    with mock.patch(
+        "ghmirror.utils.extensions.session.request",
+        side_effect=mocked_requests_slow_first,
+    ):
+        mirror_requests.UPSTREAM_LATENCIES.add(0.01)
+        response = client.get("/repos/app-sre/github-mirror")
+    assert response.status_code == 200
+    assert response.data == b"fast"
+    assert len(calls) == 2
+
+    response = client.get("/metrics")
+    assert ('github_mirror_extra_requests_total{kind="hedge",result="won"} 1.0') in str(
+        response.data
+    )
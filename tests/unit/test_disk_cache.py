@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from ghmirror.data_structures.disk_cache import STALE_TEMP_AGE, DiskCache
+
+
+def _read(download):
+    file, headers = download
+    with file:
+        return file.read(), headers
+
+
+def _store(cache, key, chunks, headers):
+    return b"".join(cache.store(key, chunks, headers))
+
+
+def test_store_and_open(tmp_path):
+    cache = DiskCache(tmp_path, max_size=10)
+    assert cache.open("foo") is None
+
+    download = cache.store("foo", [b"foo", b"bar"], {"ETag": "1"})
+    # Sent as it is written, and stored once read in full
+    assert next(download) == b"foo"
+    assert cache.open("foo") is None
+    assert list(download) == [b"bar"]
+    assert _read(cache.open("foo")) == (b"foobar", {"ETag": "1"})
+    assert cache.size == len(b"foobar")
+
+    # Stored again
+    assert _store(cache, "foo", [b"baz"], {"ETag": "2"}) == b"baz"
+    assert _read(cache.open("foo")) == (b"baz", {"ETag": "2"})
+    assert cache.size == len(b"baz")
+
+    # Kept across restarts
+    assert _read(DiskCache(tmp_path, max_size=10).open("foo"))[0] == b"baz"
+
+
+def test_not_read_in_full(tmp_path):
+    cache = DiskCache(tmp_path, max_size=10)
+    chunks = iter([b"foo", b"bar"])
+    download = cache.store("foo", (chunk for chunk in chunks), {})
+    assert next(download) == b"foo"
+    download.close()
+
+    assert cache.open("foo") is None
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(OSError, match="gone"):
+        _store(cache, "foo", _failing(), {})
+    assert list(tmp_path.iterdir()) == []
+
+
+def _failing():
+    yield b"foo"
+    raise OSError("gone")
+
+
+def test_stale_temporary_files(tmp_path):
+    stale = tmp_path / "tmpstale"
+    stale.write_bytes(b"foo")
+    old = stale.stat().st_mtime - STALE_TEMP_AGE - 1
+    os.utime(stale, (old, old))
+    written = tmp_path / "tmpwritten"
+    written.write_bytes(b"foo")
+
+    DiskCache(tmp_path, max_size=10)
+    # Only the ones no longer written are removed
+    assert list(tmp_path.iterdir()) == [written]
+
+
+def test_eviction(tmp_path):
+    cache = DiskCache(tmp_path, max_size=10)
+    _store(cache, "foo", [b"foo"], {})
+    _store(cache, "bar", [b"bar"], {})
+    cache.open("foo")[0].close()
+    _store(cache, "baz", [b"bazbaz"], {})
+
+    # The least recently used one is evicted
+    assert cache.open("bar") is None
+    assert _read(cache.open("foo"))[0] == b"foo"
+    assert _read(cache.open("baz"))[0] == b"bazbaz"
+    assert len(cache) == len(["foo", "baz"])
+
+    # Too large to be stored, but still sent
+    assert _store(cache, "qux", [b"quxqux", b"quxqux"], {}) == b"quxquxquxqux"
+    assert cache.open("qux") is None
+    assert len(cache) == len(["foo", "baz"])
+    assert len(list(tmp_path.iterdir())) == len(["foo", "baz"]) * 2
@@ -0,0 +1,196 @@
+# ruff: noqa: PLR2004
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+from ghmirror.core.events import (
+    EventsPoller,
+    _webhook_event,  # noqa: PLC2701
+    start_events_poller,
+)
+from ghmirror.core.mirror_requests import (
+    _listen_webhooks,  # noqa: PLC2701
+    _webhook_max_age,  # noqa: PLC2701
+)
+from ghmirror.data_structures.monostate import WebhooksCache
+
+
+def issue_event(event_id, number):
+    return {
+        "id": str(event_id),
+        "type": "IssuesEvent",
+        "repo": {"name": "app-sre/github-mirror"},
+        "payload": {"action": "closed", "issue": {"number": number}},
+    }
+
+
+def events_response(events, headers=None, status_code=200):
+    resp = requests.models.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(events).encode()  # noqa: SLF001
+    resp.headers.update({"ETag": str(len(events)), **(headers or {})})
+    return resp
+
+
+def mocked_events(events, **kwargs):
+    def _mocked_request(*_args, **request_kwargs):
+        if request_kwargs["headers"].get("If-None-Match") == str(len(events)):
+            return events_response([], status_code=304)
+        return events_response(events, **kwargs)
+
+    return _mocked_request
+
+
+@pytest.mark.parametrize(
+    "event_type,expected",
+    [
+        ("PushEvent", "push"),
+        ("IssueCommentEvent", "issue_comment"),
+        ("PullRequestReviewCommentEvent", "pull_request_review_comment"),
+    ],
+)
+def test_webhook_event(event_type, expected):
+    assert _webhook_event(event_type) == expected
+
+
+@mock.patch("ghmirror.core.events.webhook_request")
+@mock.patch("ghmirror.utils.extensions.session.request")
+def test_poll(mock_request, mock_webhook_request):
+    poller = EventsPoller(sources=["orgs/app-sre"], auth="foo", interval=60)
+    events = [issue_event(2, 20), issue_event(1, 10)]
+
+    # The first poll only records the latest event
+    mock_request.side_effect = mocked_events(events)
+    assert poller.poll("orgs/app-sre") == 0
+    assert "/orgs/app-sre" in WebhooksCache()
+    assert mock_request.call_args.kwargs["url"].startswith(
+        "https://api.github.com/orgs/app-sre/events"
+    )
+    assert mock_request.call_args.kwargs["headers"] == {"Authorization": "foo"}
+
+    # The next ones handle the new events, the oldest first
+    events = [issue_event(4, 40), issue_event(3, 30), *events]
+    mock_request.side_effect = mocked_events(events, headers={"X-Poll-Interval": "90"})
+    assert poller.poll("orgs/app-sre") == 2
+    assert [call.args for call in mock_webhook_request.call_args_list] == [
+        (
+            "issues",
+            {
+                "action": "closed",
+                "issue": {"number": number},
+                "repository": {"full_name": "app-sre/github-mirror"},
+            },
+        )
+        for number in (30, 40)
+    ]
+    assert poller.poll_interval == 90
+
+    # Polls without new events are conditional
+    assert poller.poll("orgs/app-sre") == 0
+    assert "If-None-Match" in mock_request.call_args.kwargs["headers"]
+    assert mock_webhook_request.call_count == 2
+
+    # Events may be missed when too many happen between polls
+    events = [issue_event(event_id, 1) for event_id in range(200, 100, -1)]
+    mock_request.side_effect = mocked_events(events)
+    with mock.patch("ghmirror.core.events.LOG") as mock_log:
+        assert poller.poll("orgs/app-sre") == 100
+    mock_log.warning.assert_called_once()
+
+
+@mock.patch("ghmirror.utils.extensions.session.request")
+def test_poll_failed(mock_request):
+    poller = EventsPoller(
+        sources=["repos/app-sre/github-mirror"], auth=None, interval=1
+    )
+    mock_request.side_effect = mocked_events([])
+    poller.poll("repos/app-sre/github-mirror")
+    assert "/repos/app-sre/github-mirror" in WebhooksCache()
+
+    # Sources failing to be polled are no longer considered notifying changes,
+    # even when the events are served from the cache
+    mock_request.side_effect = requests.exceptions.ConnectionError
+    assert poller.poll("repos/app-sre/github-mirror") == 0
+    assert "/repos/app-sre/github-mirror" not in WebhooksCache()
+
+    assert poller.poll("repos/app-sre/qontract-reconcile") == 0
+    assert "/repos/app-sre/qontract-reconcile" not in WebhooksCache()
+
+    mock_request.side_effect = mocked_events([], status_code=404)
+    assert poller.poll("repos/app-sre/qontract-reconcile") == 0
+    assert "/repos/app-sre/qontract-reconcile" not in WebhooksCache()
+
+
+@mock.patch("ghmirror.core.mirror_requests.WEBHOOK_MAX_AGE", 60)
+def test_webhook_max_age():
+    url = "https://api.github.com/repos/App-SRE/github-mirror/pulls?state=all"
+    assert _webhook_max_age(url) == 0
+
+    WebhooksCache().add("/orgs/app-sre")
+    assert _webhook_max_age(url) == 60
+    assert _webhook_max_age("https://api.github.com/user/repos") == 0
+    assert _webhook_max_age("https://api.github.com/repos/app-sre/foo/events") == 0
+
+
+@mock.patch("ghmirror.core.mirror_requests._notified")
+def test_listen_webhooks(mock_notified):
+    channel = mock.Mock()
+    channel.listen.return_value = iter(["app-sre/github-mirror"])
+    WebhooksCache().add("/orgs/app-sre")
+    with (
+        mock.patch("ghmirror.core.mirror_requests.WEBHOOKS_CHANNEL", channel),
+        mock.patch(
+            "ghmirror.core.mirror_requests.time.sleep", side_effect=StopIteration
+        ),
+        pytest.raises(StopIteration),
+    ):
+        _listen_webhooks()
+    mock_notified.assert_called_once_with("app-sre/github-mirror")
+    # Deliveries may have been missed while not listening
+    assert "/orgs/app-sre" not in WebhooksCache()
+
+
+@mock.patch("ghmirror.core.events.threading.Thread")
+def test_start_events_poller(mock_thread):
+    assert start_events_poller() is None
+
+    with (
+        mock.patch("ghmirror.core.events.EVENTS_SOURCES", ["orgs/app-sre"]),
+        mock.patch("ghmirror.core.events.EVENTS_TOKEN", "foo"),
+    ):
+        poller = start_events_poller()
+    assert poller.sources == ["orgs/app-sre"]
+    assert poller.auth == "Bearer foo"
+    mock_thread.return_value.start.assert_called_once()
+
+
+@mock.patch("ghmirror.core.events.time.sleep", side_effect=InterruptedError)
+def test_run(mock_sleep):
+    poller = EventsPoller(sources=["orgs/app-sre", "orgs/foo"], auth=None, interval=5)
+    with (
+        mock.patch.object(poller, "poll") as mock_poll,
+        pytest.raises(InterruptedError),
+    ):
+        poller.run()
+    assert mock_poll.call_count == 2
+    mock_sleep.assert_called_once_with(5)
+
+
+@mock.patch("ghmirror.core.events.time.sleep", side_effect=InterruptedError)
+def test_run_failed(_mock_sleep):
+    poller = EventsPoller(sources=["orgs/app-sre", "orgs/foo"], auth=None, interval=5)
+    WebhooksCache().add("/orgs/app-sre")
+    with (
+        mock.patch.object(
+            poller, "poll", side_effect=[KeyError("repo"), 0]
+        ) as mock_poll,
+        mock.patch("ghmirror.core.events.LOG") as mock_log,
+        pytest.raises(InterruptedError),
+    ):
+        poller.run()
+    # Failed polls are logged, the source no longer considered as notifying
+    assert mock_poll.call_count == 2
+    mock_log.exception.assert_called_once()
+    assert "/orgs/app-sre" not in WebhooksCache()
@@ -0,0 +1,67 @@
+from unittest import mock
+
+import pytest
+import requests
+from urllib3.exceptions import EmptyPoolError
+
+from ghmirror.data_structures.monostate import StatsCache
+from ghmirror.utils.extensions import (
+    POOL_SIZE,
+    MeteredHTTPSConnectionPool,
+    PoolTimeoutError,
+    UpstreamAdapter,
+    session,
+)
+
+
+def pool_waits(connection):
+    return StatsCache().registry.get_sample_value(
+        "github_mirror_pool_wait_seconds_count", {"connection": connection}
+    )
+
+
+def test_session_pool():
+    pool = session.get_adapter(
+        "https://api.github.com"
+    ).poolmanager.connection_from_url("https://api.github.com/user")
+    assert isinstance(pool, MeteredHTTPSConnectionPool)
+    assert pool.pool.maxsize == POOL_SIZE
+    assert pool.block
+
+
+@mock.patch("urllib3.connectionpool.is_connection_dropped", return_value=False)
+@mock.patch("ghmirror.utils.extensions.time.monotonic")
+def test_metered_pool(mock_monotonic, _mock_dropped):
+    mock_monotonic.return_value = 100
+    pool = MeteredHTTPSConnectionPool("api.github.com", maxsize=1, block=True)
+
+    conn = pool._get_conn()  # noqa: SLF001
+    assert pool_waits("new") == 1
+    conn.sock = mock.Mock()
+    pool._put_conn(conn)  # noqa: SLF001
+    assert pool._get_conn() is conn  # noqa: SLF001
+    assert pool_waits("reused") == 1
+
+    # Idle connections are not reused
+    pool._put_conn(conn)  # noqa: SLF001
+    mock_monotonic.return_value = 200
+    assert pool._get_conn() is conn  # noqa: SLF001
+    assert conn.sock is None
+    assert pool_waits("new") == 2  # noqa: PLR2004
+
+
+def test_pool_timeout():
+    adapter = UpstreamAdapter()
+    request = requests.Request("GET", "https://api.github.com/user").prepare()
+    # Waiting for a connection is bound by the connect timeout
+    with (
+        mock.patch.object(
+            MeteredHTTPSConnectionPool,
+            "_get_conn",
+            side_effect=EmptyPoolError(None, "Pool is empty"),
+        ) as mock_get_conn,
+        pytest.raises(PoolTimeoutError),
+    ):
+        adapter.send(request, timeout=0.5)
+    mock_get_conn.assert_called_once_with(timeout=0.5)
+    assert issubclass(PoolTimeoutError, requests.exceptions.Timeout)
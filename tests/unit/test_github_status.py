@@ -24,9 +24,9 @@ def test_create_github_status_singleton(_mock_thread):
 @pytest.mark.parametrize(
     "env,expected_sleep_time,expected_timeout",
     [
-        ({}, 1, 10),
+        ({"GITHUB_STATUS_SLEEP_TIME": "1"}, 1, 10),
         ({"GITHUB_STATUS_SLEEP_TIME": "3"}, 3, 10),
-        ({"GITHUB_STATUS_TIMEOUT": "2"}, 1, 2),
+        ({"GITHUB_STATUS_SLEEP_TIME": "1", "GITHUB_STATUS_TIMEOUT": "2"}, 1, 2),
     ],
 )
 @mock.patch("ghmirror.data_structures.monostate.HTTPAdapter")
@@ -56,6 +56,17 @@ def test_create_github_status_with_sleep_time(
     )
 
 
+@mock.patch("ghmirror.data_structures.monostate.requests.Session")
+@mock.patch("ghmirror.data_structures.monostate.threading.Thread")
+def test_create_github_status_disabled(mock_thread, _mock_session):
+    with mock.patch.dict("ghmirror.data_structures.monostate.os.environ", {}):
+        github_status = _GithubStatus.create()
+
+    assert github_status.online is True
+    assert github_status.sleep_time == 0
+    mock_thread.assert_not_called()
+
+
 def build_github_status_response_builder(status):
     return {
         "page": {
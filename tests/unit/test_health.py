@@ -0,0 +1,93 @@
+from unittest import mock
+
+from ghmirror.core.health import UpstreamHealth
+
+
+def build_health(**kwargs):
+    parameters = {
+        "window": 4,
+        "min_requests": 2,
+        "threshold": 0.5,
+        "slow": 5,
+        "min_probe": 1,
+        "max_probe": 3,
+    }
+    parameters.update(kwargs)
+    return UpstreamHealth(**parameters)
+
+
+def test_opens_on_failures():
+    health = build_health()
+    health.record(success=False)
+    assert health.online
+
+    health.record(success=True)
+    assert not health.online
+    assert not health.available()
+
+
+def test_slow_responses_are_failures():
+    health = build_health()
+    health.record(success=True, elapsed=5)
+    health.record(success=True, elapsed=1)
+    assert not health.online
+
+    health = build_health(slow=0)
+    health.record(success=True, elapsed=5)
+    health.record(success=True, elapsed=1)
+    assert health.online
+
+
+def test_window():
+    health = build_health(min_requests=4)
+    # The first failure is out of the window by the time of the third one
+    for success in (False, True, True, True, True, False):
+        health.record(success=success)
+    assert health.online
+    health.record(success=False)
+    assert not health.online
+
+
+def test_disabled():
+    health = build_health(min_requests=0)
+    for _ in range(10):
+        health.record(success=False)
+    assert health.online
+    assert health.available()
+
+
+@mock.patch("ghmirror.core.health.time.monotonic")
+def test_probes(mock_monotonic):
+    mock_monotonic.return_value = 100
+    health = build_health()
+    health.record(success=False)
+    health.record(success=False)
+    assert not health.available()
+
+    # One probe per interval
+    mock_monotonic.return_value = 101
+    assert health.available()
+    assert not health.available()
+
+    # Doubled with each failed probe, up to max_probe
+    health.record(success=False)
+    mock_monotonic.return_value = 102.5
+    assert not health.available()
+    mock_monotonic.return_value = 103
+    assert health.available()
+    health.record(success=False)
+    mock_monotonic.return_value = 105.5
+    assert not health.available()
+    mock_monotonic.return_value = 106
+    assert health.available()
+
+    # Closed by the first success
+    health.record(success=True)
+    assert health.online
+    assert health.available()
+    health.record(success=False)
+    assert health.online
+
+    health.reset()
+    health.record(success=False)
+    assert health.online
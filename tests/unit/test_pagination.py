@@ -0,0 +1,82 @@
+from unittest import TestCase
+
+from ghmirror.core.pagination import (
+    build_link_header,
+    canonical_url,
+    is_page_based,
+    link_page,
+    query_parameters,
+    replace_query_parameters,
+)
+
+URL = "https://api.github.com/repos/foo/bar/issues?state=open&page=2"
+
+
+class TestQueryParameters(TestCase):
+    def test_query_parameters(self):
+        self.assertEqual(query_parameters(URL), {"state": "open", "page": "2"})
+        self.assertEqual(query_parameters("https://api.github.com/user"), {})
+
+    def test_replace_query_parameters(self):
+        self.assertEqual(
+            replace_query_parameters(URL, {"page": 3, "per_page": 100}),
+            "https://api.github.com/repos/foo/bar/issues?page=3&per_page=100",
+        )
+
+    def test_canonical_url(self):
+        self.assertEqual(
+            canonical_url(f"{URL}&state=open&per_page=30&labels=", {"per_page": "30"}),
+            "https://api.github.com/repos/foo/bar/issues?labels=&page=2&state=open",
+        )
+        self.assertEqual(
+            canonical_url("https://api.github.com/user?page=1#accept=x", {"page": "1"}),
+            "https://api.github.com/user#accept=x",
+        )
+
+    def test_canonical_url_repeated(self):
+        # Only the exact duplicates are dropped, the order of the values of
+        # a repeated parameter being kept
+        self.assertEqual(
+            canonical_url("https://api.github.com/user?b=1&a=2&a=1&a=2&b=1"),
+            "https://api.github.com/user?a=2&a=1&b=1",
+        )
+        self.assertNotEqual(
+            canonical_url("https://api.github.com/user?a=1&a=2"),
+            canonical_url("https://api.github.com/user?a=2&a=1"),
+        )
+
+
+class TestLinks(TestCase):
+    def test_link_page(self):
+        links = {
+            "next": {"url": f"{URL[:-1]}3"},
+            "last": {"url": "https://api.github.com/users?since=42"},
+        }
+        self.assertEqual(link_page(links, "next"), 3)
+        self.assertIsNone(link_page(links, "last"))
+        self.assertIsNone(link_page(links, "prev"))
+        self.assertIsNone(link_page(None, "next"))
+
+    def test_is_page_based(self):
+        self.assertTrue(is_page_based(None))
+        self.assertTrue(is_page_based({"next": {"url": URL}}))
+        self.assertFalse(
+            is_page_based({"next": {"url": "https://api.github.com/users?since=42"}})
+        )
+
+    def test_build_link_header_first_page(self):
+        self.assertEqual(
+            build_link_header(URL, 1, 4, has_next=True),
+            '<https://api.github.com/repos/foo/bar/issues?state=open&page=2>; rel="next", '
+            '<https://api.github.com/repos/foo/bar/issues?state=open&page=4>; rel="last"',
+        )
+
+    def test_build_link_header_last_page(self):
+        self.assertEqual(
+            build_link_header(URL, 4, 4, has_next=False),
+            '<https://api.github.com/repos/foo/bar/issues?state=open&page=3>; rel="prev", '
+            '<https://api.github.com/repos/foo/bar/issues?state=open&page=1>; rel="first"',
+        )
+
+    def test_build_link_header_single_page(self):
+        self.assertIsNone(build_link_header(URL, 1, 1, has_next=False))
@@ -1,6 +1,14 @@
-from unittest import TestCase
+import io
+from unittest import TestCase, mock
 
-from ghmirror.core.mirror_response import MirrorResponse
+import requests
+from urllib3 import HTTPResponse
+
+from ghmirror.core.mirror_response import (
+    MirrorCollectionResponse,
+    MirrorResponse,
+    StreamedBody,
+)
 
 
 class MockResponse:
@@ -80,3 +88,115 @@ class TestResponse(TestCase):
 
         # No status code change
         self.assertEqual(response.status_code, 200)
+
+
+class TestStreamedResponse(TestCase):
+    @mock.patch("ghmirror.core.mirror_response.STREAM_CHUNK_SIZE", 5)
+    def test_content(self):
+        body = b'{"url": "foo/1", "urls": ["foo/2", "foofoo"]}'
+        completed = []
+        upstream_response = requests.models.Response()
+        upstream_response.status_code = 200
+        upstream_response.raw = StreamedBody(
+            HTTPResponse(body=io.BytesIO(body), preload_content=False),
+            completed.append,
+        )
+
+        response = MirrorResponse(
+            original_response=upstream_response,
+            gh_api_url="foo",
+            gh_mirror_url="barbar",
+        )
+
+        # Urls are replaced even when split across chunks
+        chunks = list(response.content)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), body.replace(b"foo", b"barbar"))
+        # The whole body is handed over once read
+        self.assertEqual(completed, [body])
+
+    def test_max_size(self):
+        completed = []
+        body = StreamedBody(
+            HTTPResponse(body=io.BytesIO(b"foobarbaz"), preload_content=False),
+            completed.append,
+            max_size=6,
+        )
+        self.assertEqual(body.read(4), b"foob")
+        self.assertEqual(body.read(4), b"arba")
+        # Past max_size, the chunks are dropped and never handed over
+        self.assertEqual(body._chunks, [])  # noqa: SLF001
+        self.assertEqual(body.read(4), b"z")
+        self.assertEqual(body.read(4), b"")
+        self.assertEqual(completed, [])
+
+
+class TestCollectionResponse(TestCase):
+    def test_merge_pages(self):
+        pages = [
+            MockResponse(
+                content='[{"url": "foo/1"}]',
+                headers={"Link": "foo", "ETag": "1", "X-Cache": "ONLINE_HIT"},
+                status_code=200,
+            ),
+            MockResponse(
+                content="[]", headers={"X-Cache": "ONLINE_HIT"}, status_code=200
+            ),
+            MockResponse(
+                content='[{"url": "foo/2"}]',
+                headers={"X-Cache": "ONLINE_MISS"},
+                status_code=200,
+            ),
+        ]
+        response = MirrorCollectionResponse(
+            original_responses=pages, gh_api_url="foo", gh_mirror_url="bar"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        # Page specific headers are dropped and one miss makes it a miss
+        self.assertEqual(
+            response.headers,
+            {
+                "X-Cache": "ONLINE_MISS",
+                "Content-Type": "application/json; charset=utf-8",
+            },
+        )
+        self.assertEqual(
+            b"".join(response.content), b'[{"url": "bar/1"},{"url": "bar/2"}]'
+        )
+
+    def test_not_a_collection(self):
+        pages = [MockResponse(content='{"foo": "bar"}', headers={}, status_code=200)]
+        response = MirrorCollectionResponse(
+            original_responses=pages, gh_api_url="foo", gh_mirror_url="bar"
+        )
+        self.assertEqual(response.content, b'{"bar": "bar"}')
+
+        pages = [MockResponse(content="[]", headers={"ETag": "1"}, status_code=404)]
+        response = MirrorCollectionResponse(
+            original_responses=pages, gh_api_url="foo", gh_mirror_url="bar"
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers, {"ETag": "1"})
+        self.assertEqual(response.content, b"[]")
+
+    def test_failed_page(self):
+        pages = [
+            MockResponse(content='[{"url": "foo/1"}]', headers={}, status_code=200),
+            MockResponse(content='{"message": "foo"}', headers={}, status_code=200),
+            MockResponse(content="[]", headers={"ETag": "3"}, status_code=502),
+        ]
+        response = MirrorCollectionResponse(
+            original_responses=pages, gh_api_url="foo", gh_mirror_url="bar"
+        )
+        # A later page that is not an array is served instead of the merge
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'{"message": "bar"}')
+
+        response = MirrorCollectionResponse(
+            original_responses=[pages[0], pages[2]],
+            gh_api_url="foo",
+            gh_mirror_url="bar",
+        )
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.headers, {"ETag": "3"})
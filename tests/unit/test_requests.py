@@ -1,5 +1,8 @@
 # ruff: noqa: SLF001
+import hashlib
 import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 from unittest import (
     TestCase,
@@ -7,14 +10,40 @@ from unittest import (
 )
 
 import pytest
+import redis
+import requests
 
 from ghmirror.core.mirror_requests import (
+    _cache_key,  # noqa: PLC2701
+    _cache_response,  # noqa: PLC2701
+    _collection_pages,  # noqa: PLC2701
+    _collection_total,  # noqa: PLC2701
     _get_elements_per_page,  # noqa: PLC2701
+    _is_followed_by_elements,  # noqa: PLC2701
+    _is_last_full_page,  # noqa: PLC2701
     _is_rate_limit_error,  # noqa: PLC2701
+    _mark_collection_worker,  # noqa: PLC2701
     _should_error_response_be_served_from_cache,  # noqa: PLC2701
+    migrate_cache_keys,
+)
+from ghmirror.data_structures.monostate import (
+    CollectionsCache,
+    InMemoryCache,
+    InMemoryCacheBorg,
+    NegativesCache,
+    PrefetchesCache,
+    StatsCache,
+    UsersCache,
+    ValidationsCache,
+    WebhooksCache,
+)
+from ghmirror.data_structures.redis_data_structures import RedisCache
+from ghmirror.data_structures.requests_cache import (
+    RequestsCache,
+    _collect_bodies,  # noqa: PLC2701
+    shared_channel,
+    shared_users_cache,
 )
-from ghmirror.data_structures.monostate import StatsCache
-from ghmirror.data_structures.requests_cache import RequestsCache
 
 RAND_CACHE_SIZE = randint(100, 1000)
 
@@ -42,6 +71,87 @@ class TestStatsCache(TestCase):
         self.assertEqual(stats_cache_02.counter._value._value, 4)
 
 
+class TestStatsCacheQuotas(TestCase):
+    @mock.patch("ghmirror.data_structures.monostate.time.time", return_value=100)
+    def test_quotas(self, _mock_time):
+        stats_cache = StatsCache()
+        self.assertIsNone(stats_cache.get_quota("foo"))
+
+        stats_cache.set_quota("foo", {})
+        self.assertIsNone(stats_cache.get_quota("foo"))
+
+        stats_cache.set_quota(
+            "foo", {"X-RateLimit-Remaining": "42", "X-RateLimit-Reset": "200"}
+        )
+        self.assertEqual(StatsCache().get_quota("foo"), 42)
+
+        stats_cache.set_quota(
+            "foo", {"X-RateLimit-Remaining": "42", "X-RateLimit-Reset": "100"}
+        )
+        self.assertIsNone(stats_cache.get_quota("foo"))
+
+    @mock.patch("ghmirror.data_structures.monostate.time.time", return_value=100)
+    def test_quota_shortage(self, _mock_time):
+        stats_cache = StatsCache()
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 0)
+
+        # Without a limit, the reserve is unknown
+        stats_cache.set_quota(
+            "foo", {"X-RateLimit-Remaining": "42", "X-RateLimit-Reset": "200"}
+        )
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 0)
+
+        headers = {
+            "X-RateLimit-Remaining": "500",
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Reset": "200",
+        }
+        stats_cache.set_quota("foo", headers)
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 0)
+
+        stats_cache.set_quota("foo", {**headers, "X-RateLimit-Remaining": "499"})
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 100)
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0), 0)
+
+        # Other rate limit resources do not change the core quota
+        stats_cache.set_quota(
+            "foo",
+            {**headers, "X-RateLimit-Remaining": "0", "X-RateLimit-Resource": "search"},
+        )
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 100)
+        self.assertEqual(stats_cache.get_quota("foo"), 499)
+        self.assertEqual(stats_cache.get_quota("foo", "search"), 0)
+
+        stats_cache.set_quota(
+            "foo",
+            {**headers, "X-RateLimit-Remaining": "499", "X-RateLimit-Reset": "50"},
+        )
+        self.assertEqual(stats_cache.get_quota_shortage("foo", 0.1), 0)
+
+
+class TestStatsCacheCooldowns(TestCase):
+    @mock.patch("ghmirror.data_structures.monostate.time.time", return_value=100)
+    def test_cooldowns(self, _mock_time):
+        stats_cache = StatsCache()
+        self.assertEqual(stats_cache.get_cooldown("foo"), 0)
+
+        stats_cache.set_cooldown("foo", 160, user="bar")
+        stats_cache.set_cooldown("foo", 130, user="bar")
+        self.assertEqual(StatsCache().get_cooldown("foo"), 60)
+        stats_cache.set_cooldown("foo", 190, user="bar")
+        self.assertEqual(stats_cache.get_cooldown("foo"), 90)
+        self.assertEqual(stats_cache.get_cooldown("bar"), 0)
+        self.assertEqual(
+            stats_cache.counter_cooldown.labels(user="bar")._value.get(), 90
+        )
+
+        # Each rate limit resource has its own cooldown
+        self.assertEqual(stats_cache.get_cooldown("foo", "search"), 0)
+        stats_cache.set_cooldown("foo", 130, user="bar", resource="search")
+        self.assertEqual(stats_cache.get_cooldown("foo", "search"), 30)
+        self.assertEqual(stats_cache.get_cooldown("foo"), 90)
+
+
 class MockResponse:
     def __init__(self, content, headers, status_code, text):
         self.content = content.encode()
@@ -50,8 +160,26 @@ class MockResponse:
         self.text = text
 
 
+class MockPipeline:
+    def __init__(self, redis_cache):
+        self.redis_cache = redis_cache
+        self.commands = []
+
+    def __getattr__(self, item):
+        def _command(*args, **kwargs):
+            self.commands.append((getattr(self.redis_cache, item), args, kwargs))
+
+        return _command
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
 class MockRedis:
     cache = {}
+    ttls = {}
 
     def __init__(self, size=0):
         self.size = size
@@ -64,14 +192,53 @@ class MockRedis:
             return self.cache[item]
         return None
 
-    def set(self, key, value, **_):
+    def set(self, key, value, ex=None, *, nx=False):
+        if nx and key in self.cache:
+            return None
         self.cache[key] = value
+        self.ttls[key] = ex
+        return True
+
+    def ttl(self, key):
+        return self.ttls.get(key, -1)
+
+    def strlen(self, key):
+        return len(self.cache[key])
+
+    def delete(self, key):
+        return int(self.cache.pop(key, None) is not None)
+
+    def eval(self, _script, _numkeys, key, ttl):
+        # DROP_BODY_SCRIPT
+        if key in self.cache and self.ttl(key) <= ttl:
+            return self.delete(key)
+        return 0
+
+    def pipeline(self):
+        return MockPipeline(self)
+
+    def sadd(self, key, value):
+        self.cache.setdefault(key, set()).add(value)
+
+    def srem(self, key, value):
+        self.cache.get(key, set()).discard(value)
+
+    def smembers(self, key):
+        return self.cache.get(key, set())
+
+    def expire(self, *_args):
+        pass
 
     def _scan_iter(self):
         return iter(self.cache)
 
-    def scan(self, *_args):
-        return 0, iter(self.cache)
+    def scan(self, *_args, match=None):
+        prefix = b"" if match is None else match.rstrip(b"*")
+        return 0, [
+            key
+            for key in self.cache
+            if not prefix or (isinstance(key, bytes) and key.startswith(prefix))
+        ]
 
     def dbsize(self):
         return len(self.cache)
@@ -130,6 +297,179 @@ class TestRequestsCache(TestCase):
         self.assertIn("foo", keys)
         self.assertNotIn("legacy-value", keys)
 
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "redis")
+    @mock.patch(
+        "ghmirror.data_structures.redis_data_structures.redis.Redis",
+        side_effect=mocked_redis_cache,
+    )
+    def test_index_redis(self, _mock_cache):
+        requests_cache_01 = RequestsCache()
+        requests_cache_01["foo", None] = MockResponse(
+            content="bar", headers={}, status_code=200, text=""
+        )
+        requests_cache_01.index(("foo", None), ["/foo", "/"])
+        self.assertEqual(requests_cache_01.indexed("/foo"), {("foo", None)})
+        self.assertEqual(requests_cache_01.indexed("/bar"), set())
+        self.assertNotIn(b'index:"/foo"', list(requests_cache_01))
+        requests_cache_01.deindex(("foo", None), ["/foo"])
+        self.assertEqual(requests_cache_01.indexed("/foo"), set())
+        self.assertEqual(requests_cache_01.indexed("/"), {("foo", None)})
+
+        del requests_cache_01["foo", None]
+        del requests_cache_01["foo", None]
+        self.assertNotIn(("foo", None), requests_cache_01)
+
+    @mock.patch.object(MockRedis, "cache", {})
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "redis")
+    @mock.patch(
+        "ghmirror.data_structures.redis_data_structures.redis.Redis",
+        side_effect=mocked_redis_cache,
+    )
+    def test_bodies_redis(self, _mock_cache):
+        requests_cache_01 = RequestsCache()
+        for key in ("foo", "bar"):
+            requests_cache_01[key] = MockResponse(
+                content="baz", headers={}, status_code=200, text=""
+            )
+        bodies = [key for key in MockRedis.cache if key.startswith(b"body:")]
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(requests_cache_01["foo"].content, b"baz")
+        self.assertEqual(requests_cache_01.collect_bodies(grace=0), 0)
+        self.assertEqual(requests_cache_01.dedup_ratio(), 2)
+        # Only the responses are counted, not their bodies
+        self.assertEqual(len(requests_cache_01), 2)
+
+        # Bodies no longer used are dropped once older than the grace period
+        for key in ("foo", "bar"):
+            del requests_cache_01[key]
+        self.assertEqual(requests_cache_01.collect_bodies(grace=60), 0)
+        self.assertEqual(requests_cache_01.collect_bodies(grace=0), 1)
+        self.assertNotIn(bodies[0], MockRedis.cache)
+        self.assertEqual(requests_cache_01.dedup_ratio(), 1)
+        self.assertEqual(len(requests_cache_01), 0)
+
+    @mock.patch.object(MockRedis, "cache", {})
+    @mock.patch(
+        "ghmirror.data_structures.redis_data_structures.redis.Redis",
+        side_effect=mocked_redis_cache,
+    )
+    def test_claim_redis(self, _mock_cache):
+        cache = RedisCache()
+        self.assertTrue(cache.claim("bodies-gc", 60))
+        self.assertFalse(cache.claim("bodies-gc", 60))
+        self.assertEqual(MockRedis.ttls[b'claim:"bodies-gc"'], 60)
+
+    @mock.patch("ghmirror.data_structures.requests_cache.BODIES_GC_INTERVAL", 60)
+    @mock.patch("ghmirror.data_structures.requests_cache.RedisCache")
+    def test_collect_bodies_claimed(self, mock_cache):
+        # Only the mirror process claiming a run collects the bodies
+        mock_cache.return_value.claim.side_effect = [False, True]
+        with (
+            mock.patch(
+                "ghmirror.data_structures.requests_cache.time.sleep",
+                side_effect=[None, None, InterruptedError],
+            ),
+            self.assertRaises(InterruptedError),
+        ):
+            _collect_bodies()
+        mock_cache.return_value.claim.assert_called_with("bodies-gc", 54)
+        mock_cache.return_value.collect_bodies.assert_called_once_with(grace=60)
+
+    @mock.patch.object(MockRedis, "cache", {})
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "redis")
+    @mock.patch(
+        "ghmirror.data_structures.redis_data_structures.redis.Redis",
+        side_effect=mocked_redis_cache,
+    )
+    def test_evicted_body_redis(self, _mock_cache):
+        requests_cache_01 = RequestsCache()
+        for key in ("foo", "bar"):
+            requests_cache_01[key] = MockResponse(
+                content=key, headers={}, status_code=200, text=""
+            )
+        for key in [key for key in MockRedis.cache if key.startswith(b"body:")]:
+            del MockRedis.cache[key]
+
+        # Responses whose body was evicted are dropped, as cache misses
+        self.assertNotIn("foo", requests_cache_01)
+        self.assertIsNone(requests_cache_01.get("bar"))
+        self.assertEqual(MockRedis.cache, {})
+
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "redis")
+    @mock.patch(
+        "ghmirror.data_structures.redis_data_structures.redis.Redis",
+        side_effect=mocked_redis_cache,
+    )
+    def test_shared_users_redis(self, _mock_cache):
+        cache_keys = list(RequestsCache())
+        shared_users = shared_users_cache()
+        self.assertIsNone(shared_users.get("token"))
+        shared_users.add("token", "app-sre-bot", 60)
+        self.assertEqual(shared_users_cache().get("token"), "app-sre-bot")
+        self.assertNotIn(b"token", b"".join(shared_users.wr_cache.cache))
+
+        # Never taken for a cache key
+        self.assertEqual(list(RequestsCache()), cache_keys)
+
+        shared_users.discard("token")
+        self.assertIsNone(shared_users.get("token"))
+
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "in-memory")
+    def test_shared_users_in_memory(self):
+        self.assertIsNone(shared_users_cache())
+        self.assertIsNone(shared_channel("webhooks"))
+
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "redis")
+    @mock.patch("ghmirror.data_structures.redis_data_structures.redis.Redis")
+    def test_channel_redis(self, mock_redis):
+        channel = shared_channel("webhooks")
+        channel.publish("app-sre/github-mirror")
+        mock_redis.return_value.publish.assert_called_once_with(
+            b"channel:webhooks", '"app-sre/github-mirror"'
+        )
+
+        def _messages():
+            yield {"type": "subscribe", "data": 1}
+            yield {"type": "message", "data": b'"app-sre/github-mirror"'}
+            raise redis.exceptions.ConnectionError
+
+        # Listening stops when the connection is lost
+        pubsub = mock_redis.return_value.pubsub.return_value
+        pubsub.listen.return_value = _messages()
+        self.assertEqual(list(channel.listen()), ["app-sre/github-mirror"])
+        pubsub.subscribe.assert_called_once_with(b"channel:webhooks")
+        pubsub.close.assert_called_once_with()
+
+    def test_state_in_memory(self):
+        barrier = threading.Barrier(8)
+
+        def _first_use():
+            barrier.wait()
+            return InMemoryCache()._lock, InMemoryCache()._bodies
+
+        # Threads using the state first all get the same one
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            states = list(executor.map(lambda _: _first_use(), range(8)))
+        self.assertEqual({id(lock) for lock, _ in states}, {id(states[0][0])})
+        self.assertEqual({id(bodies) for _, bodies in states}, {id(states[0][1])})
+
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "in-memory")
+    def test_index_in_memory(self):
+        requests_cache_01 = RequestsCache()
+        requests_cache_01["foo"] = MockResponse(
+            content="bar", headers={}, status_code=200, text=""
+        )
+        requests_cache_01.index("foo", ["/foo", "/"])
+        self.assertEqual(RequestsCache().indexed("/"), {"foo"})
+        self.assertEqual(RequestsCache().indexed("/bar"), set())
+        requests_cache_01.deindex("foo", ["/", "/bar"])
+        self.assertEqual(RequestsCache().indexed("/"), set())
+        self.assertEqual(RequestsCache().indexed("/foo"), {"foo"})
+
+        del requests_cache_01["foo"]
+        del requests_cache_01["foo"]
+        self.assertNotIn("foo", requests_cache_01)
+
     @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "in-memory")
     def test_interface_in_memory(self):
         requests_cache_01 = RequestsCache()
@@ -139,6 +479,28 @@ class TestRequestsCache(TestCase):
         self.assertTrue(list(requests_cache_01))
         self.assertIn("foo", requests_cache_01)
 
+    @mock.patch.dict(InMemoryCacheBorg._state, clear=True)
+    @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "in-memory")
+    def test_bodies_in_memory(self):
+        requests_cache_01 = RequestsCache()
+        for key, content in (("foo", b"baz"), ("bar", b"baz"), ("qux", b"baz!")):
+            resp = requests.models.Response()
+            # A copy, so the bodies are equal but not the same object
+            resp._content = bytes(bytearray(content))
+            requests_cache_01[key] = resp
+        self.assertIs(
+            requests_cache_01["foo"].content, requests_cache_01["bar"].content
+        )
+        self.assertEqual(requests_cache_01.dedup_ratio(), (2 * 3 + 4) / (3 + 4))
+
+        # Bodies are dropped along with their last response
+        digest = hashlib.sha256(b"baz").digest()
+        del requests_cache_01["foo"]
+        self.assertIn(digest, requests_cache_01._bodies)
+        requests_cache_01["bar"] = requests_cache_01["qux"]
+        self.assertNotIn(digest, requests_cache_01._bodies)
+        self.assertEqual(requests_cache_01.dedup_ratio(), 2)
+
     @mock.patch("ghmirror.data_structures.requests_cache.CACHE_TYPE", "in-memory")
     def test_shared_state(self):
         requests_cache_01 = RequestsCache()
@@ -165,6 +527,72 @@ class TestParseUrlParameters(TestCase):
         self.assertEqual(_get_elements_per_page(url_params), 2)
 
 
+class TestCacheKey(TestCase):
+    def test_default_representation(self):
+        for headers in (
+            {},
+            {"Authorization": "foo"},
+            {"Accept": "application/vnd.github.v3+json"},
+            {"Accept": "Application/JSON", "X-GitHub-Api-Version": "2022-11-28"},
+        ):
+            self.assertEqual(_cache_key("foo", headers, "bar"), ("foo", "bar"))
+
+    def test_variants(self):
+        self.assertEqual(
+            _cache_key("foo", {"Accept": "application/vnd.github.raw"}, "bar"),
+            ("foo#accept=application/vnd.github.raw", "bar"),
+        )
+        # Normalized
+        self.assertEqual(
+            _cache_key(
+                "foo",
+                {
+                    "Accept": "text/plain, Application/vnd.github.diff",
+                    "X-GitHub-Api-Version": "2026-03-10",
+                },
+                "bar",
+            ),
+            _cache_key(
+                "foo",
+                {
+                    "Accept": "application/vnd.github.diff,text/plain",
+                    "X-GitHub-Api-Version": "2026-03-10",
+                },
+                "bar",
+            ),
+        )
+
+    def test_canonical_query_string(self):
+        self.assertEqual(
+            _cache_key("foo?per_page=30&state=all&page=1&state=all", {}, "bar"),
+            ("foo?state=all", "bar"),
+        )
+
+    def test_migrate_cache_keys(self):
+        cache = mock.MagicMock()
+        cache.__iter__.return_value = [
+            ["https://api.github.com/repos/foo/bar/issues?state=all&page=2", "bar"],
+            ["https://api.github.com/repos/foo/bar/issues?page=2", "bar"],
+        ]
+        self.assertEqual(migrate_cache_keys(cache), 1)
+        new_key = (
+            "https://api.github.com/repos/foo/bar/issues?page=2&state=all",
+            "bar",
+        )
+        cache.rename.assert_called_once_with(
+            ["https://api.github.com/repos/foo/bar/issues?state=all&page=2", "bar"],
+            new_key,
+        )
+        cache.index.assert_called_once_with(
+            new_key,
+            ["/repos/foo/bar/issues", "/repos/foo/bar", "/repos/foo"],
+        )
+        cache.deindex.assert_called_once_with(
+            ("https://api.github.com/repos/foo/bar/issues?state=all&page=2", "bar"),
+            ["/repos/foo/bar/issues", "/repos/foo/bar", "/repos/foo"],
+        )
+
+
 class TestIsRateLimitCondition(TestCase):
     def test_is_rate_limit_error_true(self):
         text = "You have triggered an abuse detection mechanism."
@@ -195,3 +623,292 @@ class TestServeFromCacheCondition(TestCase):
         resp = MockResponse(content="bar", headers={}, status_code=200, text=text)
         header = _should_error_response_be_served_from_cache(resp)
         self.assertIsNone(header)
+
+
+class MockPageResponse:
+    def __init__(self, body, headers=None, status_code=200, links=None):
+        self.body = body
+        self.content = repr(body).encode()
+        self.headers = headers if headers is not None else {"ETag": "foo"}
+        self.status_code = status_code
+        self.links = links or {}
+
+    def json(self):
+        if isinstance(self.body, Exception):
+            raise self.body
+        return self.body
+
+
+class TestCacheResponse(TestCase):
+    def test_records_page_info(self):
+        cache = InMemoryCache()
+        foo_key = ("https://api.github.com/repos/foo?page=2", "sha")
+        resp = MockPageResponse([1, 2], links={"next": {"url": "foo"}})
+        _cache_response(resp, cache, foo_key)
+        self.assertEqual(resp.headers["X-Mirror-Page-Elements"], "2")
+        self.assertEqual(resp.headers["X-Mirror-Page-Next"], "true")
+
+        bar_key = ("https://api.github.com/repos/foo/bar", "sha")
+        resp = MockPageResponse(ValueError("not json"))
+        _cache_response(resp, cache, bar_key)
+        self.assertEqual(resp.headers["X-Mirror-Page-Elements"], "")
+        self.assertEqual(resp.headers["X-Mirror-Page-Next"], "false")
+        self.assertEqual(set(cache), {foo_key, bar_key})
+
+        self.assertEqual(cache.indexed("/repos"), set())
+        self.assertEqual(cache.indexed("/repos/foo"), {foo_key, bar_key})
+        self.assertEqual(cache.indexed("/repos/foo/bar"), {bar_key})
+        self.assertEqual(cache.indexed("/repos/bar"), set())
+
+    def test_no_validators(self):
+        cache = InMemoryCache()
+        _cache_response(MockPageResponse([1], headers={}), cache, ("foo", None))
+        self.assertFalse(cache)
+
+
+class TestIsLastFullPage(TestCase):
+    def test_recorded(self):
+        resp = MockPageResponse(
+            ValueError("should not be parsed"),
+            headers={"X-Mirror-Page-Elements": "2", "X-Mirror-Page-Next": "false"},
+        )
+        self.assertTrue(_is_last_full_page(resp, 2))
+        self.assertFalse(_is_last_full_page(resp, 3))
+
+        resp.headers["X-Mirror-Page-Next"] = "true"
+        self.assertFalse(_is_last_full_page(resp, 2))
+
+        resp.headers["X-Mirror-Page-Elements"] = ""
+        self.assertFalse(_is_last_full_page(resp, 2))
+
+    def test_not_recorded(self):
+        resp = MockPageResponse([1, 2])
+        self.assertTrue(_is_last_full_page(resp, 2))
+        resp.links = {"next": {"url": "foo"}}
+        self.assertFalse(_is_last_full_page(resp, 2))
+
+
+class TestIsFollowedByElements(TestCase):
+    URL = "https://api.github.com/repos/foo/bar/pulls?state=open"
+    PARAMETERS = {"state": "open", "per_page": 2}
+
+    def _probe(self, session, cache=None):
+        return _is_followed_by_elements(
+            session,
+            {"Authorization": "foo", "If-None-Match": "bar"},
+            self.URL,
+            self.PARAMETERS,
+            2,
+            InMemoryCache() if cache is None else cache,
+            "sha",
+        )
+
+    def test_probe(self):
+        session = mock.Mock()
+        session.request.return_value = MockPageResponse([])
+        cache = InMemoryCache()
+        self.assertFalse(self._probe(session, cache))
+        session.request.assert_called_once_with(
+            method="GET",
+            url="https://api.github.com/repos/foo/bar/pulls?state=open&per_page=1&page=3",
+            headers={"Authorization": "foo"},
+            timeout=10,
+        )
+        self.assertEqual(len(cache), 1)
+
+        session.request.return_value = MockPageResponse(None, status_code=304)
+        self.assertFalse(self._probe(session, cache))
+        self.assertEqual(
+            session.request.call_args.kwargs["headers"],
+            {"Authorization": "foo", "If-None-Match": "foo"},
+        )
+
+        session.request.return_value = MockPageResponse([1])
+        self.assertTrue(self._probe(session, cache))
+
+    def test_inconclusive(self):
+        session = mock.Mock()
+        session.request.side_effect = requests.exceptions.Timeout
+        self.assertIsNone(self._probe(session))
+
+        session.request.side_effect = None
+        session.request.return_value = MockPageResponse(None, status_code=500)
+        self.assertIsNone(self._probe(session))
+
+        session.request.return_value = MockPageResponse({"message": "foo"})
+        self.assertIsNone(self._probe(session))
+
+        # Pages that are not positive numbers are never probed
+        session.reset_mock()
+        with mock.patch.object(self, "PARAMETERS", {"page": "abc"}):
+            self.assertIsNone(self._probe(session))
+        session.request.assert_not_called()
+
+
+@mock.patch("ghmirror.core.mirror_requests.UPSTREAM_PER_PAGE", 4)
+class TestCollectionTotal(TestCase):
+    NEXT = {"next": {"url": "https://api.github.com/foo?page=3"}}
+    LAST = {"last": {"url": "https://api.github.com/foo?page=5"}}
+
+    def test_last_page_fetched(self):
+        upstream_page = mock.Mock()
+        self.assertEqual(
+            _collection_total(MockPageResponse([1, 2]), 2, 6, upstream_page), 10
+        )
+        self.assertEqual(
+            _collection_total(MockPageResponse([]), 1, 0, upstream_page), 0
+        )
+        # An empty page past the end
+        self.assertIsNone(_collection_total(MockPageResponse([]), 3, 0, upstream_page))
+        upstream_page.assert_not_called()
+
+    def test_last_link(self):
+        upstream_page = mock.Mock(return_value=MockPageResponse([1]))
+        last_resp = MockPageResponse([1, 2, 3, 4], links={**self.NEXT, **self.LAST})
+        self.assertEqual(_collection_total(last_resp, 2, 4, upstream_page), 17)
+        upstream_page.assert_called_once_with(5)
+
+        upstream_page.return_value = MockPageResponse(None, status_code=500)
+        self.assertIsNone(_collection_total(last_resp, 2, 4, upstream_page))
+
+        last_resp.links = self.NEXT
+        self.assertIsNone(_collection_total(last_resp, 2, 4, upstream_page))
+
+
+class TestCollectionPages(TestCase):
+    URL = "https://api.github.com/foo"
+    LINKS = {
+        "next": {"url": f"{URL}?page=2"},
+        "last": {"url": f"{URL}?page=3"},
+    }
+
+    def test_collection_worker(self):
+        executor = ThreadPoolExecutor(
+            max_workers=1, initializer=_mark_collection_worker
+        )
+        page_request = mock.Mock(return_value=MockPageResponse([2]))
+        with mock.patch("ghmirror.core.mirror_requests.COLLECTION_EXECUTOR", executor):
+            # A single worker fetching the pages of a collection must not wait
+            # for itself
+            future = executor.submit(
+                _collection_pages,
+                MockPageResponse([1], links=self.LINKS),
+                self.URL,
+                {},
+                page_request,
+            )
+            responses = future.result(timeout=5)
+        executor.shutdown()
+        self.assertEqual([resp.body for resp in responses], [[1], [2], [2]])
+        page_request.assert_has_calls([
+            mock.call(f"{self.URL}?page=2"),
+            mock.call(f"{self.URL}?page=3"),
+        ])
+
+
+class TestValidationsCache(TestCase):
+    @mock.patch.object(ValidationsCache, "MAX_SIZE", 2)
+    def test_bounded(self):
+        validations = ValidationsCache()
+        for key in ("foo", "bar", "foo", "baz"):
+            validations.mark(key)
+
+        self.assertTrue(validations.is_fresh("foo", 10))
+        self.assertTrue(validations.is_fresh("baz", 10))
+        self.assertFalse(validations.is_fresh("bar", 10))
+        self.assertFalse(ValidationsCache().is_fresh("foo", 0))
+
+        validations.discard("foo")
+        validations.discard("bar")
+        self.assertFalse(validations.is_fresh("foo", 10))
+
+
+class TestPrefetchesCache(TestCase):
+    @mock.patch.object(PrefetchesCache, "MAX_SIZE", 1)
+    def test_prefetches(self):
+        prefetches = PrefetchesCache()
+        prefetches.add("foo")
+        self.assertTrue(prefetches.is_fresh("foo", 10))
+        prefetches.add("bar")
+        self.assertFalse(prefetches.is_fresh("foo", 10))
+
+        self.assertFalse(PrefetchesCache().pop("bar", 0))
+        prefetches.add("bar")
+        self.assertTrue(PrefetchesCache().pop("bar", 10))
+        self.assertFalse(PrefetchesCache().pop("bar", 10))
+
+
+class TestCollectionsCache(TestCase):
+    @mock.patch.object(CollectionsCache, "MAX_SIZE", 2)
+    def test_bounded(self):
+        collections = CollectionsCache()
+        for key in ("foo", "bar", "foo", "baz"):
+            collections.set(key, {"key": key})
+
+        self.assertEqual(collections.get("foo"), {"key": "foo"})
+        self.assertEqual(CollectionsCache().get("baz"), {"key": "baz"})
+        self.assertIsNone(collections.get("bar"))
+
+        collections.discard("foo")
+        collections.discard("bar")
+        self.assertEqual(list(CollectionsCache()), ["baz"])
+
+
+class TestWebhooksCache(TestCase):
+    @mock.patch.object(WebhooksCache, "MAX_SIZE", 1)
+    def test_bounded(self):
+        webhooks = WebhooksCache()
+        webhooks.add("foo")
+        self.assertIn("foo", WebhooksCache())
+        webhooks.add("bar")
+        self.assertNotIn("foo", webhooks)
+        self.assertIn("bar", webhooks)
+
+    @mock.patch("ghmirror.data_structures.monostate.time.monotonic")
+    def test_expiration(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        webhooks = WebhooksCache()
+        webhooks.add("foo", 10)
+        self.assertIn("foo", webhooks)
+        mock_monotonic.return_value = 110
+        self.assertNotIn("foo", webhooks)
+
+
+class TestNegativesCache(TestCase):
+    @mock.patch.object(NegativesCache, "MAX_SIZE", 2)
+    def test_bounded(self):
+        negatives = NegativesCache()
+        for key in ("foo", "bar", "foo", "baz"):
+            negatives.set(key, key.upper(), 10)
+
+        self.assertEqual(negatives.get("foo"), "FOO")
+        self.assertEqual(NegativesCache().get("baz"), "BAZ")
+        self.assertIsNone(negatives.get("bar"))
+
+        negatives.discard("foo")
+        self.assertEqual(list(NegativesCache()), ["baz"])
+
+    def test_expired(self):
+        negatives = NegativesCache()
+        negatives.set("foo", "FOO", 0)
+        self.assertIsNone(negatives.get("foo"))
+
+
+class TestUsersCache(TestCase):
+    @mock.patch("ghmirror.data_structures.monostate.time.monotonic")
+    def test_expiration(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        users = UsersCache()
+        users.add("foo", "app-sre-bot", 60)
+        users.add("bar")
+        self.assertIn("foo", users)
+        self.assertEqual(users.used_since(100), ["foo", "bar"])
+
+        mock_monotonic.return_value = 160
+        self.assertNotIn("foo", UsersCache())
+        self.assertIn("bar", UsersCache())
+        self.assertEqual(users.get("foo"), "app-sre-bot")
+        self.assertEqual(users.used_since(150), ["bar"])
+
+        users.discard("foo")
+        self.assertIsNone(users.get("foo"))
@@ -0,0 +1,40 @@
+# ruff: noqa: PLR2004
+from unittest import mock
+
+from ghmirror.core.retries import (
+    Latencies,
+    RetryBudget,
+)
+
+
+@mock.patch("ghmirror.core.retries.time.monotonic")
+def test_retry_budget(mock_monotonic):
+    mock_monotonic.return_value = 100
+    budget = RetryBudget(ratio=0.5, min_extra=1, window=10)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    for _ in range(4):
+        budget.deposit()
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    # Requests and extra requests out of the window no longer count
+    mock_monotonic.return_value = 110
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_latencies():
+    latencies = Latencies(size=10, min_samples=5)
+    for seconds in range(4):
+        latencies.add(seconds)
+    assert latencies.quantile(0.5) is None
+
+    for seconds in range(4, 14):
+        latencies.add(seconds)
+    assert latencies.quantile(0) == 4
+    assert latencies.quantile(0.5) == 9
+    assert latencies.quantile(0.95) == 13
+    assert latencies.quantile(1) == 13
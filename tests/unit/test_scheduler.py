@@ -0,0 +1,185 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ghmirror.core.scheduler import (
+    DeadlineExceededError,
+    SingleFlight,
+    UpstreamBusyError,
+    UpstreamScheduler,
+    deadline,
+    is_background,
+    mark_background,
+    time_left,
+)
+from ghmirror.utils.wait import wait_for
+
+
+def test_disabled():
+    scheduler = UpstreamScheduler(concurrency=0, queue_size=0, timeout=0)
+    with scheduler.slot("foo"), scheduler.slot("foo"):
+        pass
+    assert not scheduler._in_flight  # noqa: SLF001
+
+
+def test_concurrency_per_token():
+    scheduler = UpstreamScheduler(concurrency=1, queue_size=0, timeout=0)
+    with scheduler.slot("foo"):
+        # Other tokens are not affected
+        with scheduler.slot("bar"):
+            pass
+        with pytest.raises(UpstreamBusyError), scheduler.slot("foo"):
+            pass
+
+    with scheduler.slot("foo"):
+        pass
+    assert not scheduler._in_flight  # noqa: SLF001
+    assert not scheduler._waiting  # noqa: SLF001
+
+
+def test_timeout():
+    scheduler = UpstreamScheduler(concurrency=1, queue_size=1, timeout=0.01)
+    with scheduler.slot("foo"):
+        with pytest.raises(UpstreamBusyError), scheduler.slot("foo"):
+            pass
+        assert not scheduler._waiting  # noqa: SLF001
+
+
+def test_deadline():
+    assert time_left() is None
+    with deadline(1):
+        assert 0 < time_left() <= 1
+        with deadline(None):
+            assert time_left() is None
+        assert time_left() is not None
+    assert time_left() is None
+
+    # Waiting for a slot stops at the deadline
+    scheduler = UpstreamScheduler(concurrency=1, queue_size=1, timeout=10)
+    with scheduler.slot("foo"):
+        with (
+            deadline(0.01),
+            pytest.raises(DeadlineExceededError),
+            scheduler.slot("foo"),
+        ):
+            pass
+        assert not scheduler._waiting  # noqa: SLF001
+
+
+def test_queue_order():
+    scheduler = UpstreamScheduler(concurrency=1, queue_size=3, timeout=5)
+    order = []
+
+    def _request(name, background):
+        if background:
+            mark_background()
+        with scheduler.slot("foo"):
+            order.append(name)
+
+    with ThreadPoolExecutor(max_workers=3) as executor, scheduler.slot("foo"):
+        for queued, (name, background) in enumerate(
+            (("prefetch", True), ("first", False), ("second", False)), 1
+        ):
+            executor.submit(_request, name, background)
+            assert wait_for(
+                lambda queued=queued: (
+                    len(scheduler._waiting["foo"]) == queued  # noqa: SLF001
+                ),
+                timeout=1,
+                first=0,
+                step=0.01,
+            )
+
+        # The queue is full
+        with pytest.raises(UpstreamBusyError), scheduler.slot("foo"):
+            pass
+
+    # Client requests first, in arrival order
+    assert order == ["first", "second", "prefetch"]
+
+
+def test_threads():
+    scheduler = UpstreamScheduler(concurrency=1, queue_size=8, timeout=5, threads=4)
+    release = threading.Event()
+
+    def _request(auth_sha, *, background=False):
+        if background:
+            mark_background()
+        with scheduler.slot(auth_sha):
+            release.wait(1)
+
+    def _waiting():
+        return sum(len(waiting) for waiting in scheduler._waiting.values())  # noqa: SLF001
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        tokens = {"foo", "bar", "baz"}
+        for auth_sha in tokens:
+            executor.submit(_request, auth_sha)
+        assert wait_for(
+            lambda: set(scheduler._in_flight) == tokens,  # noqa: SLF001
+            timeout=1,
+            first=0,
+            step=0.01,
+        )
+        for queued, (auth_sha, background) in enumerate(
+            (("foo", False), ("foo", True), ("bar", False)), 1
+        ):
+            executor.submit(_request, auth_sha, background=background)
+            assert wait_for(
+                lambda queued=queued: _waiting() == queued,
+                timeout=1,
+                first=0,
+                step=0.01,
+            )
+
+        # A token holds at most half of the threads
+        with pytest.raises(UpstreamBusyError), scheduler.slot("foo"):
+            pass
+        # And the client requests waiting at most half of them
+        with pytest.raises(UpstreamBusyError), scheduler.slot("baz"):
+            pass
+        release.set()
+
+    assert not scheduler._in_flight  # noqa: SLF001
+
+
+def test_background():
+    assert not is_background()
+    thread = threading.Thread(target=mark_background)
+    thread.start()
+    thread.join()
+    assert not is_background()
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def _call(key):
+        calls.append(key)
+        release.wait(1)
+        if key == "bar":
+            raise ValueError(key)
+        return key
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(flights.do, key, lambda key=key: _call(key))
+            for key in ("foo", "foo", "bar", "bar")
+        ]
+        assert wait_for(
+            lambda: sorted(calls) == ["bar", "foo"], timeout=1, first=0, step=0.01
+        )
+        release.set()
+
+    assert sorted(calls) == ["bar", "foo"]
+    assert [future.result() for future in futures[:2]] == ["foo", "foo"]
+    for future in futures[2:]:
+        with pytest.raises(ValueError, match="bar"):
+            future.result()
+
+    # Calls not in flight run again
+    assert flights.do("foo", lambda: "baz") == "baz"
+    assert not flights._flights  # noqa: SLF001